@@ -0,0 +1,113 @@
+"""Chooses what to fetch and how to encode it so the upload fits Telegram's limit.
+
+Bots can upload at most 50 MB. The size is estimated from the duration and
+the extracted formats before anything is downloaded. A format that can be
+sent as-is (mp3, or m4a with TRANSCODE_PASSTHROUGH), fits, isn't above
+the user's preferred bitrate and isn't far below what an mp3 encode that
+fits would get is fetched unchanged. Otherwise the smallest
+source that still carries the target bitrate is fetched and encoded to mp3
+at the highest bitrate up to the preference that fits. Telegram only plays
+mp3 and m4a as audio, so opus sources are always re-encoded. A track that
+doesn't fit even at the lowest bitrate is rejected up front.
+"""
+import os
+from typing import Optional
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 50 * 1024 * 1024))
+# Estimates from bitrates are a little off, and the file carries tags
+SIZE_HEADROOM = 0.95
+
+DEFAULT_QUALITY = "standard"
+# Preferred mp3 bitrate (kbps) per user setting
+QUALITY_KBPS = {
+    'low': 128,
+    'standard': int(os.getenv("MP3_BITRATE", "192k").rstrip('k')),
+    'high': 320,
+}
+MP3_BITRATES = (320, 256, 224, 192, 160, 128, 112, 96, 80, 64)
+MIN_MP3_KBPS = int(os.getenv("MIN_MP3_KBPS", 64))
+# AAC sounds about as good as mp3 at some 60% of its bitrate
+PASSTHROUGH_MIN_RATIO = 0.6
+
+
+class TrackTooLarge(Exception):
+    """Even at MIN_MP3_KBPS the track would be above UPLOAD_MAX_BYTES."""
+
+    def __init__(self, duration: float):
+        super().__init__(f"{duration / 60:.0f} min track doesn't fit into {UPLOAD_MAX_BYTES // 2**20} MB")
+        self.duration = duration
+
+
+def mp3_bytes(kbps: int, duration: float) -> int:
+    return int(kbps * 125 * duration)
+
+
+def estimate_bytes(fmt: dict, duration: Optional[float]) -> Optional[int]:
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    kbps = fmt.get('abr') or fmt.get('tbr')
+    if kbps and duration:
+        return mp3_bytes(kbps, duration)
+    return None
+
+
+def pick_mp3_bitrate(duration: Optional[float], preferred_kbps: int, limit: int = UPLOAD_MAX_BYTES) -> int:
+    """Highest bitrate up to ``preferred_kbps`` that fits; raises TrackTooLarge if none does."""
+    for kbps in MP3_BITRATES:
+        if kbps > preferred_kbps or kbps < MIN_MP3_KBPS:
+            continue
+        if not duration or mp3_bytes(kbps, duration) <= limit * SIZE_HEADROOM:
+            return kbps
+    raise TrackTooLarge(duration)
+
+
+def plan_download(info: dict, preferred_kbps: int, passthrough_exts: tuple = ('mp3', 'm4a'),
+                  limit: int = UPLOAD_MAX_BYTES) -> dict:
+    """Picks a format of the extracted ``info`` and what to do with it.
+
+    Returns {'format', 'transcode', 'codec', 'bitrate', 'estimated_bytes', 'source_bytes'};
+    ``codec`` is what gets uploaded: the source extension, or "mp3" when transcoding.
+    """
+    duration = info.get('duration')
+    formats = info.get('formats') or [info]
+    audio = [f for f in formats if f.get('vcodec') == 'none'] or formats
+    try:
+        bitrate = pick_mp3_bitrate(duration, preferred_kbps, limit)
+    except TrackTooLarge:
+        bitrate = None
+
+    fitting = []
+    for fmt in audio:
+        abr, size = fmt.get('abr'), estimate_bytes(fmt, duration)
+        if fmt.get('ext') not in passthrough_exts or (abr or 0) > preferred_kbps * 1.05:
+            continue
+        # Not worth keeping when an encode that fits would sound clearly better
+        if abr and bitrate and abr < bitrate * PASSTHROUGH_MIN_RATIO:
+            continue
+        # Unknown size is only trusted for tracks of unknown length, e.g. direct links
+        if (size is None and not duration) or (size is not None and size <= limit * SIZE_HEADROOM):
+            fitting.append((abr or 0, size, fmt))
+    if fitting:
+        abr, size, fmt = max(fitting, key=lambda item: item[0])
+        return {
+            'format': fmt, 'transcode': False, 'codec': fmt['ext'], 'bitrate': abr,
+            'estimated_bytes': size, 'source_bytes': size,
+        }
+    if bitrate is None:
+        raise TrackTooLarge(duration)
+
+    # Fetching more than the target bitrate only costs bandwidth
+    rich_enough = [f for f in audio if (f.get('abr') or 0) >= bitrate]
+    if rich_enough:
+        source = min(rich_enough, key=lambda f: f.get('abr') or 0)
+    else:
+        source = max(audio, key=lambda f: f.get('abr') or f.get('tbr') or 0)
+    return {
+        'format': source,
+        'transcode': True,
+        'codec': 'mp3',
+        'bitrate': bitrate,
+        'estimated_bytes': mp3_bytes(bitrate, duration) if duration else None,
+        'source_bytes': estimate_bytes(source, duration),
+    }
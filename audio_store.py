@@ -0,0 +1,337 @@
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+# Interrupted downloads in partial/ are kept this long for a retry to resume
+PARTIAL_MAX_AGE = 24 * 3600
+# Finished ones are kept this long for another job that needs the same source
+FINISHED_PARTIAL_AGE = 600
+# Suffixes of unfinished downloads: download_ranged's and yt-dlp's
+UNFINISHED_SUFFIXES = (".part", ".parts", ".ytdl")
+# Other processes sharing the directory are picked up this often (see put)
+RESCAN_INTERVAL = 60
+
+
+class AudioStore:
+    """Size-bounded on-disk cache of finished audio files.
+
+    Files are content-addressed (``objects/<sha256[:2]>/<sha256>.<ext>``) and
+    found by track key through small ref files in ``refs/``, so two keys with
+    identical audio share one object. Every write lands in a ``tmp/``
+    directory of the process's own first and is moved into place with
+    ``os.replace``, which makes it atomic on the same filesystem; the
+    in-memory index is rebuilt from the directory on ``load``.
+
+    When the total size is above ``max_bytes`` the least recently (``lru``)
+    or least frequently (``lfu``) used objects are deleted. Objects used in
+    the last ``grace_seconds`` are kept even then, since they may still be
+    uploading. Several processes may share the directory: ``put`` rescans it
+    every ``RESCAN_INTERVAL`` seconds, so ``max_bytes`` bounds the whole
+    directory rather than what one process wrote. Methods do blocking file
+    I/O; call them from an executor.
+
+    Downloads that may be resumed after a failure live in ``partial/`` under
+    a name that stays the same across attempts (see ``claim_partial``).
+    ``sweep_partials`` removes them once nobody is likely to come back for them.
+    """
+
+    def __init__(self, root: str, max_bytes: int, policy: str = "lru", grace_seconds: float = 300):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"unknown eviction policy: {policy}")
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.grace_seconds = grace_seconds
+        self.objects_dir = os.path.join(root, "objects")
+        self.refs_dir = os.path.join(root, "refs")
+        self.tmp_root = os.path.join(root, "tmp")
+        # Held (flock on the .lock file next to it) for as long as this store is open, so other processes leave it alone
+        self.tmp_dir = os.path.join(self.tmp_root, uuid.uuid4().hex[:12])
+        self._tmp_fd: Optional[int] = None
+        self.partial_dir = os.path.join(root, "partial")
+        self._lock = threading.Lock()
+        self._objects = {}  # object name -> {'size', 'last_used', 'hits'}
+        self._refs = {}  # key -> object name
+        self.total_bytes = 0
+        self.evictions = 0
+        self._next_sweep = 0.0
+        self._next_rescan = 0.0
+
+    def load(self):
+        """(Re)builds the index from disk and removes leftovers of interrupted writes."""
+        for path in (self.objects_dir, self.refs_dir, self.tmp_root, self.partial_dir):
+            os.makedirs(path, exist_ok=True)
+        self._open_tmp_dir()
+        self._remove_dead_tmp_dirs()
+        self.sweep_partials(force=True)
+        with self._lock:
+            for entry in os.scandir(self.tmp_dir):
+                os.remove(entry.path)
+            self._objects.clear()
+            self._refs.clear()
+            self.total_bytes = 0
+            self._rescan()
+            self._evict()
+
+    def close(self):
+        """Gives up this store's tmp dir; the next ``load`` of any store sharing the directory removes it."""
+        if self._tmp_fd is not None:
+            os.close(self._tmp_fd)
+            self._tmp_fd = None
+
+    def _open_tmp_dir(self):
+        if self._tmp_fd is None:
+            os.makedirs(self.tmp_root, exist_ok=True)
+            # Locked before the dir exists, so nobody can find it unlocked
+            self._tmp_fd = os.open(f"{self.tmp_dir}.lock", os.O_CREAT | os.O_WRONLY)
+            fcntl.flock(self._tmp_fd, fcntl.LOCK_EX)
+            os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def _remove_dead_tmp_dirs(self):
+        """Removes the tmp dirs of stores whose process is gone (or that were closed)."""
+        for entry in os.scandir(self.tmp_root):
+            if entry.path == self.tmp_dir or not entry.is_dir():
+                continue
+            lock_path = f"{entry.path}.lock"
+            fd = os.open(lock_path, os.O_CREAT | os.O_WRONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+            os.remove(lock_path)
+            os.close(fd)
+
+    def _rescan(self):
+        """Brings the index in line with the directory; objects already known keep their use counts."""
+        self._next_rescan = time.time() + RESCAN_INTERVAL
+        found = {}
+        for shard in os.scandir(self.objects_dir):
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                found[entry.name] = self._objects.get(entry.name) or {'size': stat.st_size, 'last_used': stat.st_mtime, 'hits': 0}
+        for name in [name for name in self._objects if name not in found]:
+            self._forget(name)
+        self._objects = found
+        self.total_bytes = sum(entry['size'] for entry in found.values())
+        for entry in os.scandir(self.refs_dir):
+            try:
+                with open(entry.path, encoding="utf-8") as f:
+                    name, key = f.read().split("\n", 1)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError):
+                os.remove(entry.path)
+                continue
+            if name in self._objects:
+                self._refs[key] = name
+            else:
+                self._remove_ref_file(key)
+
+    def temp_path(self, suffix: str = "") -> str:
+        """A unique path inside the store's tmp dir, for downloads that will be ``put`` afterwards."""
+        self._open_tmp_dir()
+        return os.path.join(self.tmp_dir, uuid.uuid4().hex + suffix)
+
+    @contextmanager
+    def claim_partial(self, name: str):
+        """Yields the base path of the resumable download ``name``, or None while another download holds it.
+
+        A claim is an flock on a lock file, so it also holds between processes
+        sharing the directory and is released by the OS when its holder dies,
+        however long the download runs.
+        """
+        os.makedirs(self.partial_dir, exist_ok=True)
+        base = os.path.join(self.partial_dir, re.sub(r"[^\w.-]", "_", name))
+        lock_path = f"{base}.lock"
+        fd = os.open(lock_path, os.O_CREAT | os.O_WRONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # The previous holder removes the file before unlocking it; a lock on a removed file claims nothing
+            claimed = os.fstat(fd).st_ino == os.stat(lock_path).st_ino
+        except (BlockingIOError, FileNotFoundError):
+            claimed = False
+        if not claimed:
+            os.close(fd)
+            yield None
+            return
+        try:
+            yield base
+        finally:
+            os.remove(lock_path)
+            os.close(fd)
+
+    def sweep_partials(self, force: bool = False):
+        """Removes old downloads in partial/ and locks left by dead holders; runs at most once a minute."""
+        now = time.time()
+        if not force and now < self._next_sweep:
+            return
+        self._next_sweep = now + 60
+        os.makedirs(self.partial_dir, exist_ok=True)
+        for entry in os.scandir(self.partial_dir):
+            name = entry.name
+            if name.endswith(".lock"):
+                # Left by a holder that died; a live holder removes its own
+                with self.claim_partial(name[:-len(".lock")]):
+                    pass
+                continue
+            unfinished = name.endswith(UNFINISHED_SUFFIXES)
+            try:
+                age = now - entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if age < (PARTIAL_MAX_AGE if unfinished else FINISHED_PARTIAL_AGE):
+                continue
+            base = os.path.splitext(name[:name.rindex(".")] if unfinished else name)[0]
+            with self.claim_partial(base) as claimed:
+                if claimed:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            name = self._refs.get(key)
+            if name is None:
+                return None
+            path = self._object_path(name)
+            if not os.path.exists(path):
+                # Evicted by another process sharing the directory
+                self._forget(name)
+                return None
+            self._touch(name, path)
+            return path
+
+    def contains(self, key: str) -> bool:
+        """Whether ``key`` has a file, without counting it as a use."""
+        with self._lock:
+            name = self._refs.get(key)
+            return name is not None and os.path.exists(self._object_path(name))
+
+    def put(self, key: Optional[str], source_path: str) -> str:
+        """Moves ``source_path`` into the store and returns its final path.
+
+        ``source_path`` should be on the same filesystem (see ``temp_path``).
+        """
+        ext = os.path.splitext(source_path)[1]
+        digest = hashlib.sha256()
+        with open(source_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        name = digest.hexdigest() + ext
+        path = self._object_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with self._lock:
+            if name in self._objects and os.path.exists(path):
+                os.remove(source_path)
+            else:
+                size = os.path.getsize(source_path)
+                if not source_path.startswith(self.tmp_dir):
+                    staged = self.temp_path(ext)
+                    shutil.move(source_path, staged)
+                    source_path = staged
+                os.replace(source_path, path)
+                self._objects[name] = {'size': size, 'last_used': time.time(), 'hits': 0}
+                self.total_bytes += size
+            if key is not None:
+                self._write_ref(key, name)
+            self._touch(name, path)
+            if time.time() >= self._next_rescan:
+                self._rescan()
+            self._evict()
+        return path
+
+    def discard(self, key: str) -> bool:
+        """Forgets ``key``; its object is deleted too unless another key still refers to it."""
+        with self._lock:
+            name = self._refs.pop(key, None)
+            if name is None:
+                return False
+            self._remove_ref_file(key)
+            if name not in self._refs.values():
+                try:
+                    os.remove(self._object_path(name))
+                except FileNotFoundError:
+                    pass
+                self._forget(name)
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'files': len(self._objects),
+                'keys': len(self._refs),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+            }
+
+    def _object_path(self, name: str) -> str:
+        return os.path.join(self.objects_dir, name[:2], name)
+
+    def _ref_path(self, key: str) -> str:
+        return os.path.join(self.refs_dir, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def _write_ref(self, key: str, name: str):
+        staged = self.temp_path()
+        with open(staged, "w", encoding="utf-8") as f:
+            f.write(f"{name}\n{key}")
+        os.replace(staged, self._ref_path(key))
+        self._refs[key] = name
+
+    def _remove_ref_file(self, key: str):
+        try:
+            os.remove(self._ref_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _touch(self, name: str, path: str):
+        entry = self._objects[name]
+        entry['last_used'] = time.time()
+        entry['hits'] += 1
+        # mtime doubles as the persisted last-use time for the index rebuild
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _forget(self, name: str):
+        entry = self._objects.pop(name, None)
+        if entry:
+            self.total_bytes -= entry['size']
+        for key in [key for key, ref in self._refs.items() if ref == name]:
+            del self._refs[key]
+            self._remove_ref_file(key)
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        if self.policy == "lfu":
+            rank = lambda item: (item[1]['hits'], item[1]['last_used'])
+        else:
+            rank = lambda item: item[1]['last_used']
+        protected_after = time.time() - self.grace_seconds
+        for name, entry in sorted(self._objects.items(), key=rank):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if entry['last_used'] > protected_after:
+                continue
+            try:
+                os.remove(self._object_path(name))
+            except FileNotFoundError:
+                pass
+            self._forget(name)
+            self.evictions += 1
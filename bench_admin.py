@@ -0,0 +1,94 @@
+"""Admin operations on a large user base.
+
+Fills a database with --users users and --jobs finished jobs spread over
+the last 30 days, then times:
+  grant     adding downloads to --targets users given by @username: one
+            add_free_downloads_by_username call each, without and with the
+            username index, and one bulk adjust_free_downloads call
+  stats     totals of the last --hours hours: a GROUP BY over job_history,
+            as the stats would be without aggregates, and get_admin_stats,
+            which reads the hourly_stats aggregates
+
+    python bench_admin.py --users 200000 --jobs 500000 --targets 1000
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import database
+
+OUTCOMES = ("ok",) * 9 + ("download_failed",)
+
+
+async def populate(users: int, jobs: int):
+    db = await database._conn()
+    await db.executemany(
+        "INSERT INTO users (user_id, username) VALUES (?, ?)", ((i, f"user{i}") for i in range(users))
+    )
+    now = time.time()
+    rng = random.Random(1)
+    rows = []
+    for _ in range(jobs):
+        finished_at = now - rng.random() * 30 * 86400
+        outcome = rng.choice(OUTCOMES)
+        rows.append((rng.randrange(users), "Artist - Title", outcome, 5.0, finished_at))
+        key = (int(finished_at // 3600), f"jobs:{outcome}")
+        database._pending_stats[key] = database._pending_stats.get(key, 0) + 1
+    await db.executemany(
+        "INSERT INTO job_history (user_id, query, outcome, seconds, finished_at) VALUES (?, ?, ?, ?, ?)", rows
+    )
+    await db.commit()
+    await database.flush_writes()
+
+
+async def timed(label: str, run):
+    started = time.perf_counter()
+    await run()
+    print(f"  {label:<40} {(time.perf_counter() - started) * 1000:9.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200_000)
+    parser.add_argument('--jobs', type=int, default=500_000)
+    parser.add_argument('--targets', type=int, default=1000)
+    parser.add_argument('--hours', type=int, default=24 * 7)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database.DB_PATH = os.path.join(tmp_dir, "bot_data.db")
+        await database.init_db()
+        await populate(args.users, args.jobs)
+        db = await database._conn()
+        targets = [f"@user{i}" for i in random.Random(2).sample(range(args.users), args.targets)]
+
+        async def one_by_one():
+            for target in targets:
+                await database.add_free_downloads_by_username(target, 1)
+
+        print(f"grant to {args.targets} of {args.users} users:")
+        await db.execute("DROP INDEX idx_users_username")
+        await timed("one call per user, no username index", one_by_one)
+        await db.execute("CREATE INDEX idx_users_username ON users(username)")
+        await timed("one call per user, indexed", one_by_one)
+        await timed("adjust_free_downloads, indexed", lambda: database.adjust_free_downloads(targets, 1))
+
+        since = time.time() - args.hours * 3600
+
+        async def scan_history():
+            async with db.execute(
+                "SELECT outcome, COUNT(*) FROM job_history WHERE finished_at >= ? GROUP BY outcome", (since,)
+            ) as cursor:
+                await cursor.fetchall()
+
+        print(f"stats of the last {args.hours} h over {args.jobs} jobs:")
+        await timed("GROUP BY over job_history", scan_history)
+        await timed("get_admin_stats (hourly_stats)", lambda: database.get_admin_stats(args.hours))
+        await database.close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+"""Micro-benchmark of the per-message database path (get_user + free quota check).
+
+"before" reproduces the old code: a fresh aiosqlite connection (and thread)
+per call. "after" goes through database.py's persistent WAL connection and
+user-row cache.
+
+    python bench_database.py --messages 2000 --users 200
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import aiosqlite
+
+import database
+
+
+async def legacy_get_user(user_id: int, username: str = None):
+    async with aiosqlite.connect(database.DB_PATH) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            user = await cursor.fetchone()
+        if not user:
+            await db.execute("INSERT INTO users (user_id, username, is_whitelisted) VALUES (?, ?, ?)", (user_id, username, False))
+            await db.commit()
+            async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+                user = await cursor.fetchone()
+        return user
+
+
+async def legacy_decrement(user_id: int):
+    async with aiosqlite.connect(database.DB_PATH) as db:
+        await db.execute("UPDATE users SET free_downloads = free_downloads - 1 WHERE user_id = ?", (user_id,))
+        await db.commit()
+
+
+async def before(messages: int, users: int):
+    for i in range(messages):
+        user = await legacy_get_user(i % users, f"user{i % users}")
+        if user['free_downloads'] > 0:
+            await legacy_decrement(i % users)
+
+
+async def after(messages: int, users: int):
+    for i in range(messages):
+        await database.get_user(i % users, f"user{i % users}")
+        await database.try_consume_free_download(i % users)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, run in (("before", before), ("after", after)):
+            database.DB_PATH = os.path.join(tmp_dir, f"{name}.db")
+            await database.init_db()
+            started = time.perf_counter()
+            await run(args.messages, args.users)
+            elapsed = time.perf_counter() - started
+            await database.close_db()
+            print(f"{name:>6}: {args.messages / elapsed:8.0f} messages/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+"""Replays typing sessions from fixtures/inline_keystrokes.json against inline search.
+
+Every keystroke is an inline query, sent at its recorded offset (sessions
+overlap). The backend is a stub search over the fixture's catalog whose
+latency follows the fixture's distribution. "naive" calls the backend for
+every keystroke and answers whenever it returns; "inline" goes through
+InlineSearch (memoized prefixes, per-user debounce, --budget). Reported per
+strategy: backend calls, answered queries, answer latency, and for each
+session's last keystroke whether the answer was complete and whether it
+listed the right tracks (a partial answer from a cached prefix often does).
+
+    python bench_inline.py --budget 0.3
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+
+from bench_stats import percentile
+from inline_search import InlineSearch
+from matching import normalize
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "inline_keystrokes.json")
+
+
+class StubBackend:
+    def __init__(self, fixture: dict, seed: int):
+        self.catalog = fixture['catalog']
+        latency = fixture['backend_latency']
+        self.median, self.max = latency['median'], latency['max']
+        self.sigma = math.log(latency['p90'] / latency['median']) / 1.2816
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    async def search(self, text: str) -> list:
+        self.calls += 1
+        await asyncio.sleep(min(self.max, self.rng.lognormvariate(math.log(self.median), self.sigma)))
+        return self.matches(text)
+
+    def matches(self, text: str) -> list:
+        parts = normalize(text).split()
+        return [
+            track for track in self.catalog
+            if all(any(word.startswith(part) for word in normalize(f"{track['artist']} {track['title']}").split()) for part in parts)
+        ]
+
+
+async def replay(sessions: list, answer, expected) -> dict:
+    """Runs every keystroke at its offset; ``answer(user_id, text)`` returns (tracks, complete) or None."""
+    latencies, final_complete, final_correct = [], 0, 0
+    started = time.perf_counter()
+
+    async def keystroke(user_id: int, offset: float, text: str, is_last: bool):
+        nonlocal final_complete, final_correct
+        await asyncio.sleep(max(0.0, offset - (time.perf_counter() - started)))
+        sent = time.perf_counter()
+        result = await answer(user_id, text)
+        if result is None:
+            return
+        latencies.append(time.perf_counter() - sent)
+        if is_last:
+            final_complete += result[1]
+            final_correct += [t['track_id'] for t in result[0]] == [t['track_id'] for t in expected(text)]
+
+    await asyncio.gather(*[
+        keystroke(session['user_id'], offset, text, i == len(session['keystrokes']) - 1)
+        for session in sessions
+        for i, (offset, text) in enumerate(session['keystrokes'])
+    ])
+    return {'latencies': latencies, 'final_complete': final_complete, 'final_correct': final_correct}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=float, default=0.3)
+    parser.add_argument('--debounce', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with open(FIXTURE, encoding='utf-8') as f:
+        fixture = json.load(f)
+    sessions = fixture['sessions']
+    keystrokes = sum(len(session['keystrokes']) for session in sessions)
+
+    naive_backend = StubBackend(fixture, args.seed)
+
+    async def naive(user_id, text):
+        return await naive_backend.search(text), True
+
+    inline_backend = StubBackend(fixture, args.seed)
+    search = InlineSearch(inline_backend.search, budget=args.budget, debounce=args.debounce)
+
+    print(f"{len(sessions)} sessions, {keystrokes} keystrokes, budget {args.budget * 1000:.0f} ms")
+    for name, answer, backend in (("naive", naive, naive_backend), ("inline", search.query, inline_backend)):
+        result = await replay(sessions, answer, backend.matches)
+        latencies = result['latencies']
+        within = sum(latency <= args.budget + 0.01 for latency in latencies) / len(latencies)
+        print(
+            f"{name:>6}: {backend.calls} backend calls, {len(latencies)} answers, "
+            f"p50 {percentile(latencies, 0.5) * 1000:.0f} ms, p99 {percentile(latencies, 0.99) * 1000:.0f} ms, "
+            f"{within:.0%} within budget; last keystroke: {result['final_complete']} complete, "
+            f"{result['final_correct']} correct of {len(sessions)}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
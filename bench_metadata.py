@@ -0,0 +1,77 @@
+"""Benchmark for YandexMusicHandler.get_track_info against a local stub of
+music.yandex.ru/handlers/track.jsx.
+
+Compares three modes per lookup:
+  cold    - new handler (and HTTP session) per lookup, like the old code
+  pooled  - one shared session, metadata cache cleared before every lookup
+  cached  - one shared session, repeated lookups served from the TTL cache
+
+    python bench_metadata.py --lookups 200 --latency 0.02
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from aiohttp import web
+
+from logic import YandexMusicHandler
+
+
+def make_stub_app(latency: float) -> web.Application:
+    async def track_handler(request):
+        await asyncio.sleep(latency)
+        track_id = request.query['track']
+        return web.json_response({
+            'track': {'id': track_id, 'title': f"Title {track_id}", 'artists': [{'name': 'Stub Artist'}]},
+        })
+
+    app = web.Application()
+    app.router.add_get('/handlers/track.jsx', track_handler)
+    return app
+
+
+async def measure(lookups: int, base_url: str, mode: str) -> list:
+    timings = []
+    shared = YandexMusicHandler(base_url=base_url)
+    for i in range(lookups):
+        url = f"https://music.yandex.ru/album/1/track/{i % 20}"
+        started = time.perf_counter()
+        if mode == 'cold':
+            handler = YandexMusicHandler(base_url=base_url)
+            info = await handler.get_track_info(url)
+            await handler.close()
+        else:
+            if mode == 'pooled':
+                shared.metadata_cache.clear()
+            info = await shared.get_track_info(url)
+        timings.append(time.perf_counter() - started)
+        assert info, "stub lookup failed"
+    await shared.close()
+    return timings
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lookups', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help="artificial server latency in seconds")
+    args = parser.parse_args()
+
+    runner = web.AppRunner(make_stub_app(args.latency))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    base_url = f"http://127.0.0.1:{port}"
+
+    print(f"{'mode':>7} {'mean ms':>8} {'p50 ms':>8} {'max ms':>8}")
+    try:
+        for mode in ('cold', 'pooled', 'cached'):
+            timings = [t * 1000 for t in await measure(args.lookups, base_url, mode)]
+            print(f"{mode:>7} {statistics.mean(timings):>8.2f} {statistics.median(timings):>8.2f} {max(timings):>8.2f}")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
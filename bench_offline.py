@@ -0,0 +1,131 @@
+"""End-to-end throughput and latency of process_track_download, offline.
+
+Runs --jobs track link downloads, --concurrency at a time (as WORKER_COUNT
+workers would), against the stand-ins in stubs.py: Yandex metadata, video
+search, extraction and audio transfer take the latencies and bandwidth from
+fixtures/offline_catalog.json and the Bot API is a stub. The catalog's
+tracks are requested in order and then again, so later jobs are served from
+the file_id cache the way popular tracks are. Reported: jobs per second,
+p50/p95 time of the jobs that had to download and p95 of the cached ones.
+
+Results are compared with fixtures/bench_baseline.json for the same jobs
+and concurrency: throughput lower, or p95 higher, than the baseline by more
+than --tolerance is a regression and exits with status 1.
+--update-baseline stores the current numbers instead.
+
+    python bench_offline.py --jobs 32 --concurrency 3
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+import main
+from audio_quality import UPLOAD_MAX_BYTES
+from bench_stats import percentile
+from stubs import load_catalog, offline_bot
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "bench_baseline.json")
+BENCH_TOLERANCE = float(os.getenv("BENCH_TOLERANCE", 0.3))
+
+
+async def run_benchmark(jobs: int, concurrency: int) -> dict:
+    tracks = [
+        track for track in load_catalog()['tracks']
+        if track['duration_ms'] / 1000 * 64 * 125 < UPLOAD_MAX_BYTES  # the oversized ones are rejected early
+    ]
+    slots = asyncio.Semaphore(concurrency)
+    durations, cached_durations = [], []
+
+    async def job(index: int):
+        track = tracks[index % len(tracks)]
+        async with slots:
+            started = time.perf_counter()
+            delivered = await main.process_track_download(
+                index, f"https://music.yandex.ru/track/{track['id']}", index, True
+            )
+            (durations if index < len(tracks) else cached_durations).append(time.perf_counter() - started)
+            if not delivered:
+                raise RuntimeError(f"job {index} delivered nothing")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        async with offline_bot(tmp_dir) as (server, session):
+            started = time.perf_counter()
+            await asyncio.gather(*[job(i) for i in range(jobs)])
+            elapsed = time.perf_counter() - started
+            downloads = server.requests['files']
+    return {
+        'throughput': round(jobs / elapsed, 3),
+        'p50': round(percentile(durations, 0.5), 3),
+        'p95': round(percentile(durations, 0.95), 3),
+        'cached_p95': round(percentile(cached_durations, 0.95), 3),
+        'downloads': downloads,
+    }
+
+
+def baseline_key(jobs: int, concurrency: int) -> str:
+    return f"jobs={jobs},concurrency={concurrency}"
+
+
+def load_baseline() -> dict:
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+    with open(BASELINE_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def find_regressions(result: dict, baseline: dict, tolerance: float = BENCH_TOLERANCE) -> list:
+    """Human-readable regressions of ``result`` against ``baseline`` (empty if none)."""
+    regressions = []
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append(f"throughput {result['throughput']}/s, baseline {baseline['throughput']}/s")
+    if result['p95'] > baseline['p95'] * (1 + tolerance):
+        regressions.append(f"p95 {result['p95']}s, baseline {baseline['p95']}s")
+    if result['downloads'] > baseline['downloads']:
+        regressions.append(f"{result['downloads']} audio downloads, baseline {baseline['downloads']}")
+    return regressions
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=32)
+    parser.add_argument('--concurrency', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=BENCH_TOLERANCE)
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    result = asyncio.run(run_benchmark(args.jobs, args.concurrency))
+    print(
+        f"{args.jobs} jobs, {args.concurrency} at a time: {result['throughput']:.2f} jobs/s, "
+        f"downloading p50 {result['p50']:.2f}s, p95 {result['p95']:.2f}s, cached p95 {result['cached_p95'] * 1000:.0f} ms, "
+        f"{result['downloads']} audio downloads"
+    )
+
+    baselines = load_baseline()
+    key = baseline_key(args.jobs, args.concurrency)
+    if args.update_baseline:
+        baselines[key] = result
+        with open(BASELINE_PATH, "w", encoding='utf-8') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+            f.write("\n")
+        print(f"baseline for {key} updated")
+    elif key not in baselines:
+        print(f"no baseline for {key}; run with --update-baseline to store one")
+    else:
+        regressions = find_regressions(result, baselines[key], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"within {args.tolerance:.0%} of the baseline")
+
+
+if __name__ == "__main__":
+    cli()
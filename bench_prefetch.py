@@ -0,0 +1,93 @@
+"""Share of requests answered without a download, with and without prefetching.
+
+Requests follow a Zipf distribution over the offline catalog (stubs.py):
+--history requests are recorded as yesterday's traffic, then, while the bot
+is idle, a Prefetcher pass with --top-k fetches the most requested tracks.
+A fresh sample of --requests is then served one at a time. Reported per
+run: the share of requests served by a file_id, the disk cache or a shared
+download, the number of audio downloads and the mean request latency.
+
+    python bench_prefetch.py --requests 200 --top-k 5
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+import database
+import main
+import metrics
+from audio_quality import UPLOAD_MAX_BYTES
+from prefetch import Prefetcher
+from stubs import load_catalog, offline_bot
+
+
+def zipf_sample(track_ids: list, count: int, skew: float, rng: random.Random) -> list:
+    weights = [1 / rank ** skew for rank in range(1, len(track_ids) + 1)]
+    return rng.choices(track_ids, weights, k=count)
+
+
+async def never_busy():
+    return False
+
+
+async def run(history: int, requests: int, top_k: int, skew: float, seed: int) -> dict:
+    track_ids = [
+        track['id'] for track in load_catalog()['tracks']
+        if track['duration_ms'] / 1000 * 64 * 125 < UPLOAD_MAX_BYTES
+    ]
+    rng = random.Random(seed)
+    yesterday = zipf_sample(track_ids, history, skew, rng)
+    today = zipf_sample(track_ids, requests, skew, rng)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        async with offline_bot(tmp_dir) as (server, session):
+            for track_id in yesterday:
+                database.record_track_request(f"ym:{track_id}")
+            started = time.perf_counter()
+            prefetched = await Prefetcher(main.ym_handler, never_busy, top_k=top_k).run_once()
+            prefetch_seconds = time.perf_counter() - started
+            prefetch_downloads = server.requests['files']
+
+            metrics.served_counts.clear()
+            started = time.perf_counter()
+            for index, track_id in enumerate(today):
+                await main.process_track_download(index, f"https://music.yandex.ru/track/{track_id}", index, True)
+            elapsed = time.perf_counter() - started
+            return {
+                'prefetched': prefetched,
+                'prefetch_seconds': prefetch_seconds,
+                'without_download': metrics.served_without_download_ratio(),
+                'served': dict(metrics.served_counts),
+                'downloads': server.requests['files'] - prefetch_downloads,
+                'mean_latency': elapsed / requests,
+            }
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--skew', type=float, default=1.2, help="Zipf exponent of track popularity")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    for top_k in (0, args.top_k):
+        result = asyncio.run(run(args.history, args.requests, top_k, args.skew, args.seed))
+        served = ", ".join(f"{name} {count}" for name, count in sorted(result['served'].items()))
+        print(
+            f"top-k {top_k:>2}: {result['prefetched']} prefetched in {result['prefetch_seconds']:.1f}s; "
+            f"{result['without_download']:.0%} of {args.requests} requests without a download ({served}), "
+            f"{result['downloads']} downloads, mean {result['mean_latency'] * 1000:.0f} ms"
+        )
+
+
+if __name__ == "__main__":
+    cli()
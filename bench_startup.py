@@ -0,0 +1,192 @@
+"""Cold start of the web process, as on a sleeping Render instance.
+
+--imports N prints the N modules that take longest to import behind
+`import main` (python -X importtime, cumulative, best of two runs so that
+.pyc compilation doesn't count).
+
+Every run starts a fresh server process with the app's real lifespan and
+measures from the spawn:
+  healthy   the first 200 from /health
+  download  a text message posted to the webhook --delay seconds after
+            the process is healthy, until the Bot API receives its sendAudio
+            (also reported from the moment the message was posted)
+The Bot API is the stub session from stubs.py. Search is stubbed to return
+a direct link to an audio file served by the bench, so the fetch goes
+through the real YoutubeDL pool (with the generic extractor allowed)
+without any network. Configurations compare the background warm-up
+(YDL_WARMUP) and restricting yt-dlp to a few extractors (YDL_EXTRACTORS).
+
+    python bench_startup.py --imports 15 --runs 3 --delay 0
+"""
+import argparse
+import functools
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN = "123456:BENCH"
+RESTRICTED = "youtube,youtube:search,soundcloud,soundcloud:search,generic"
+CONFIGS = (
+    ("warm-up, restricted", {"YDL_WARMUP": "1", "YDL_EXTRACTORS": RESTRICTED}),
+    ("restricted", {"YDL_WARMUP": "0", "YDL_EXTRACTORS": RESTRICTED}),
+    ("all extractors", {"YDL_WARMUP": "0", "YDL_EXTRACTORS": "default"}),
+)
+
+
+def serve(port: int, audio_url: str, tmp_dir: str):
+    """Child process: the app as deployed, with the Bot API and the search stubbed."""
+    import uvicorn
+    from aiogram import Bot
+    from aiogram.methods import SendAudio
+
+    import database
+    import main
+    from stubs import StubSession
+
+    class ReportingSession(StubSession):
+        async def make_request(self, bot, method, timeout=None):
+            result = await super().make_request(bot, method, timeout)
+            if isinstance(method, SendAudio):
+                print("sent", flush=True)
+            return result
+
+    async def direct_link(query, *args):
+        return {'webpage_url': audio_url, 'title': query}
+
+    database.DB_PATH = os.path.join(tmp_dir, "bot_data.db")
+    main.bot = Bot(token=TOKEN, session=ReportingSession(0))
+    main.ym_handler.find_best_match = direct_link
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_file_server(directory: str) -> ThreadingHTTPServer:
+    class QuietHandler(SimpleHTTPRequestHandler):
+        extensions_map = {'.mp3': 'audio/mpeg'}
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def text_update(update_id: int) -> bytes:
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': 4242, 'type': 'private'},
+            'from': {'id': 4242, 'is_bot': False, 'first_name': 'Bench', 'username': 'bench'},
+            'text': f'bench track {update_id}',
+        },
+    }).encode()
+
+
+def cold_start(audio_url: str, env: dict, delay: float, timeout: float) -> tuple:
+    """Returns seconds to healthy, to the first sendAudio and from posting the message to it, for a fresh server process."""
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(
+            os.environ, BOT_TOKEN=TOKEN, WEBHOOK_URL="", WEBHOOK_SECRET="",
+            JOB_DB_PATH=os.path.join(tmp_dir, "jobs.db"), AUDIO_CACHE_DIR=os.path.join(tmp_dir, "audio"), **env
+        )
+        started = time.perf_counter()
+        child = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--serve", str(port), audio_url, tmp_dir],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        )
+        lines = queue.SimpleQueue()
+        threading.Thread(target=lambda: [lines.put(line.strip()) for line in child.stdout], daemon=True).start()
+        try:
+            while True:
+                if time.perf_counter() - started > timeout or child.poll() is not None:
+                    raise RuntimeError("server didn't become healthy")
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                        if response.status == 200:
+                            break
+                except (urllib.error.URLError, ConnectionError):
+                    pass
+                time.sleep(0.01)
+            healthy = time.perf_counter() - started
+            time.sleep(delay)
+
+            request = urllib.request.Request(
+                f"http://127.0.0.1:{port}/bot/{TOKEN}", data=text_update(1),
+                headers={'Content-Type': 'application/json'},
+            )
+            posted = time.perf_counter()
+            urllib.request.urlopen(request, timeout=5).close()
+            while lines.get(timeout=max(0.1, timeout - (time.perf_counter() - started))) != "sent":
+                pass
+            sent = time.perf_counter()
+            return healthy, sent - started, sent - posted
+        finally:
+            child.terminate()
+            child.wait()
+
+
+def import_profile(top: int):
+    runs = []
+    for _ in range(2):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import main"],
+            env=dict(os.environ, BOT_TOKEN=TOKEN), capture_output=True, text=True,
+        )
+        runs.append([line.split("|") for line in result.stderr.splitlines() if line.startswith("import time:")][1:])
+    rows = min(runs, key=lambda rows: sum(int(row[0].split(":")[1]) for row in rows))
+    cumulative = sorted(((int(row[1]), row[2].rstrip()) for row in rows), reverse=True)
+    print("slowest imports behind `import main` (cumulative):")
+    for micros, name in cumulative[:top]:
+        print(f"  {micros / 1e6:6.2f}s {name}")
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--imports', type=int, default=0, help="print this many slowest imports first")
+    parser.add_argument('--delay', type=float, default=0.0, help="seconds between healthy and the first message")
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--serve', nargs=3, metavar=("PORT", "AUDIO_URL", "TMP_DIR"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(int(args.serve[0]), args.serve[1], args.serve[2])
+        return
+
+    if args.imports:
+        import_profile(args.imports)
+
+    with tempfile.TemporaryDirectory() as files:
+        with open(os.path.join(files, "track.mp3"), "wb") as f:
+            f.write(os.urandom(2 * 1024 * 1024))
+        server = start_file_server(files)
+        audio_url = f"http://127.0.0.1:{server.server_address[1]}/track.mp3"
+        for name, env in CONFIGS:
+            results = [cold_start(audio_url, env, args.delay, args.timeout) for _ in range(args.runs)]
+            healthy, download, handled = (sorted(column)[len(results) // 2] for column in zip(*results))
+            print(
+                f"{name:>20}: healthy in {healthy:.2f}s, first download at {download:.2f}s "
+                f"({handled:.2f}s after the message), median of {args.runs}"
+            )
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    cli()
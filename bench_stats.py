@@ -0,0 +1,7 @@
+"""Summary statistics shared by the bench_*.py scripts."""
+
+
+def percentile(values: list, pct: float) -> float:
+    """The ``pct`` (0..1) percentile of ``values``, nearest-rank; 0.0 when there are none."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))] if values else 0.0
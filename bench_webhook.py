@@ -0,0 +1,138 @@
+"""Webhook latency under a burst of updates, as seen by Telegram.
+
+Fires --updates text messages at the webhook concurrently and reports the
+p50/p99 time until each POST got its response. "inline" reproduces the old
+endpoint, which ran the handlers before answering; "fast-ack" is the current
+one, which only buffers the update. Handlers run for real against a
+temporary database, but the Bot API is a stub session that answers every
+call after --api-latency seconds.
+
+    python bench_webhook.py --updates 1000 --api-latency 0.05
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+# The burst would otherwise be mostly rate-limited replies; the buckets are still taken from on every update
+for name in ("USER_RATE_BURST", "GLOBAL_RATE_BURST"):
+    os.environ.setdefault(name, "1e9")
+
+import aiohttp
+import uvicorn
+from aiogram import Bot, types
+
+import database
+import job_store
+import main
+from bench_stats import percentile
+from stubs import StubSession
+
+PORT = 18080
+
+
+@main.app.post("/legacy-webhook")
+async def legacy_webhook(request: main.Request):
+    data = await request.json()
+    update = types.Update.model_validate(data, context={"bot": main.bot})
+    await main.dp.feed_update(main.bot, update)
+    return {"ok": True}
+
+
+def make_update(update_id: int, users: int) -> dict:
+    user_id = 1000 + update_id % users
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'user{user_id}'},
+            'text': f'artist {update_id} - song',
+        },
+    }
+
+
+async def burst(path: str, updates: int, users: int, offset: int, secret: str) -> tuple:
+    url = f"http://127.0.0.1:{PORT}{path}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+    latencies, errors = [], 0
+
+    async def post(session, update):
+        nonlocal errors
+        started = time.perf_counter()
+        async with session.post(url, json=update, headers=headers) as response:
+            await response.read()
+            errors += response.status != 200
+        latencies.append(time.perf_counter() - started)
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[post(session, make_update(offset + i, users)) for i in range(updates)])
+    return latencies, errors
+
+
+def run_burst(*args) -> tuple:
+    return asyncio.run(burst(*args))
+
+
+async def run(args, tmp_dir: str):
+    database.DB_PATH = os.path.join(tmp_dir, "bot_data.db")
+    main.job_store = job_store.SqliteJobStore(database.DB_PATH, maxsize=main.QUEUE_MAXSIZE)
+    await database.init_db()
+    await main.job_store.open()
+    # The rate-limit middleware holds main.token_buckets; point it at the temporary database too
+    main.token_buckets.path = database.DB_PATH
+    await main.token_buckets.open()
+    main.bot = Bot(token=main.API_TOKEN, session=StubSession(args.api_latency))
+
+    server = uvicorn.Server(uvicorn.Config(main.app, port=PORT, lifespan="off", log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    dispatchers = [asyncio.create_task(main.update_dispatcher(i)) for i in range(main.DISPATCHER_COUNT)]
+
+    # The client runs in its own process so that its work doesn't count as server latency
+    client = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(client, int)  # start it before timing anything
+    for offset, (name, path) in enumerate((("inline", "/legacy-webhook"), ("fast-ack", main.WEBHOOK_PATH))):
+        started = time.perf_counter()
+        latencies, errors = await loop.run_in_executor(
+            client, run_burst, path, args.updates, args.users, offset * args.updates, main.WEBHOOK_SECRET or ""
+        )
+        acked = time.perf_counter() - started
+        await main.update_buffer.join()
+        handled = time.perf_counter() - started
+        print(
+            f"{name:>8}: p50 {percentile(latencies, 0.5) * 1000:7.1f} ms, p99 {percentile(latencies, 0.99) * 1000:7.1f} ms, "
+            f"{errors} non-200, all acked in {acked:.2f}s, all handled in {handled:.2f}s"
+        )
+
+    client.shutdown()
+    for task in dispatchers:
+        task.cancel()
+    server.should_exit = True
+    await serving
+    await main.token_buckets.close()
+    await main.job_store.close()
+    await database.close_db()
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--api-latency', type=float, default=0.05, help="seconds per stubbed Bot API call")
+    args = parser.parse_args()
+    main.logging.getLogger().setLevel(main.logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(args, tmp_dir))
+
+
+if __name__ == "__main__":
+    cli()
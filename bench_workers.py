@@ -0,0 +1,113 @@
+"""Load test for the download worker pool.
+
+Runs main.download_worker against the offline stand-ins in stubs.py (Yandex
+metadata, video search, extraction and audio transfer with the latencies of
+fixtures/offline_catalog.json, a stub Bot API) with each job store, and
+reports throughput and queue wait times for different worker counts. One
+user pastes a batch of links, then everyone else shows up:
+
+    python bench_workers.py --jobs-heavy 30 --light-users 10 --workers 1 2 4 8 --stores memory sqlite
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+import main
+from audio_quality import UPLOAD_MAX_BYTES
+from bench_stats import percentile
+from job_store import MemoryJobStore, SqliteJobStore
+from stubs import load_catalog, offline_bot
+
+# Job store name -> factory taking a scratch dir
+STORES = {
+    'memory': lambda tmp_dir: MemoryJobStore(),
+    'sqlite': lambda tmp_dir: SqliteJobStore(os.path.join(tmp_dir, "jobs.db")),
+}
+
+
+async def run(store: str, workers: int, jobs_heavy: int, light_users: int, jobs_light: int) -> dict:
+    tracks = [
+        track for track in load_catalog()['tracks']
+        if track['duration_ms'] / 1000 * 64 * 125 < UPLOAD_MAX_BYTES  # the oversized ones are rejected early
+    ]
+    links = [f"https://music.yandex.ru/track/{track['id']}" for track in tracks]
+    waits = {'heavy': [], 'light': []}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        async with offline_bot(tmp_dir) as (server, session):
+            # offline_bot restores main.job_store afterwards
+            job_store = main.job_store = STORES[store](tmp_dir)
+            await job_store.open()
+            enqueued, kinds = {}, {}
+            lease = job_store.lease
+
+            async def timed_lease(worker_id: str):
+                job = await lease(worker_id)
+                if job is not None:
+                    waits[kinds[job['_id']]].append(time.perf_counter() - enqueued[job['_id']])
+                return job
+
+            job_store.lease = timed_lease
+
+            async def submit(user_id: int, link: str, kind: str):
+                job_id = await job_store.enqueue(main.make_job(user_id, link, len(enqueued) + 1, user_id))
+                enqueued[job_id], kinds[job_id] = time.perf_counter(), kind
+
+            for i in range(jobs_heavy):
+                await submit(1, links[i % len(links)], 'heavy')
+            for user_id in range(2, light_users + 2):
+                for i in range(jobs_light):
+                    await submit(user_id, links[(user_id * jobs_light + i) % len(links)], 'light')
+
+            total = len(enqueued)
+            started = time.perf_counter()
+            tasks = [asyncio.create_task(main.download_worker(i)) for i in range(workers)]
+            while len(waits['heavy']) + len(waits['light']) < total or main.busy_workers:
+                await asyncio.sleep(0.01)
+            elapsed = time.perf_counter() - started
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await job_store.close()
+            downloads = server.requests['files']
+
+    all_waits = waits['heavy'] + waits['light']
+    return {
+        'store': store,
+        'workers': workers,
+        'jobs': total,
+        'downloads': downloads,
+        'throughput': total / elapsed,
+        'p50': percentile(all_waits, 0.5),
+        'p95': percentile(all_waits, 0.95),
+        'light_p95': percentile(waits['light'], 0.95),
+    }
+
+
+async def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--stores', choices=sorted(STORES), nargs='+', default=['memory', 'sqlite'])
+    parser.add_argument('--jobs-heavy', type=int, default=30)
+    parser.add_argument('--light-users', type=int, default=10)
+    parser.add_argument('--jobs-light', type=int, default=2)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"{'store':>6} {'workers':>7} {'jobs':>5} {'fetched':>7} {'jobs/s':>8} {'p50 wait':>9} {'p95 wait':>9} {'light p95':>10}")
+    for store in args.stores:
+        for workers in args.workers:
+            r = await run(store, workers, args.jobs_heavy, args.light_users, args.jobs_light)
+            print(
+                f"{r['store']:>6} {r['workers']:>7} {r['jobs']:>5} {r['downloads']:>7} {r['throughput']:>8.2f} "
+                f"{r['p50']:>8.2f}s {r['p95']:>8.2f}s {r['light_p95']:>9.2f}s"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(cli())
@@ -0,0 +1,27 @@
+import pytest
+
+import database
+
+# Scripts for poking at the live Yandex, DuckDuckGo and yandex-music endpoints by hand.
+# They need the network (and packages outside requirements.txt), so pytest leaves them out.
+collect_ignore = [
+    "geo_test.py",
+    "test_ddg.py",
+    "test_handlers.py",
+    "test_lib_no_token.py",
+    "test_oembed.py",
+    "test_scrape.py",
+]
+
+
+@pytest.fixture(autouse=True)
+def stop_database_thread():
+    """Stops a database connection a test left open.
+
+    aiosqlite runs it on a non-daemon thread, which would keep pytest from exiting.
+    """
+    yield
+    if database._db is not None:
+        database._db.stop()
+        database._db = None
+        database._users.clear()
@@ -1,45 +1,434 @@
 import aiosqlite
+import asyncio
 import os
+import time
+from typing import Optional
+
+import metrics
+from ttl_cache import TTLCache
 
 DB_PATH = "bot_data.db"
+# Hit counters are written in batches instead of one UPDATE per cache lookup
+FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", 5))
+# Finished jobs are kept this long in job_history; hourly_stats is kept forever
+JOB_HISTORY_DAYS = float(os.getenv("JOB_HISTORY_DAYS", 30))
+# Per-hour track request counts (one row per track and hour) are kept this long
+TRACK_HOURS_DAYS = float(os.getenv("TRACK_HOURS_DAYS", 30))
+# Bulk updates go in chunks below SQLite's limit on bound parameters
+BULK_CHUNK = 500
+# Other processes (WEB_CONCURRENCY > 1) also change users, so cached rows are re-read this often
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10_000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 30))
+
+# Process-wide counters for the file_id cache
+cache_stats = {"hits": 0, "misses": 0}
+
+# One connection for the whole process: aiosqlite runs it on a single thread and
+# sqlite3 keeps its prepared statements cached across calls.
+_db: Optional[aiosqlite.Connection] = None
+_flush_task: Optional[asyncio.Task] = None
+# user_id -> user row; every write below updates it as well (write-through)
+_users = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# cache_key -> hits not yet written to audio_cache
+_pending_hits = {}
+# cache_key -> (requests, last request time) not yet written to track_requests
+_pending_requests = {}
+# (hour, cache_key) -> requests not yet written to hourly_track_requests
+_pending_track_hours = {}
+# job_history rows and (hour, metric) -> increment for hourly_stats, not yet written
+_pending_jobs = []
+_pending_stats = {}
+# Writes on the shared connection go one at a time: a commit issued while another
+# coroutine's UPDATE ... RETURNING cursor is still open fails with "SQL statements in progress"
+_write_lock = asyncio.Lock()
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                free_downloads INTEGER DEFAULT 1,
-                is_whitelisted BOOLEAN DEFAULT FALSE
-            )
-        """)
+    global _db, _flush_task
+    if _db is not None:
+        await close_db()
+    _db = await aiosqlite.connect(DB_PATH, cached_statements=256)
+    _db.row_factory = aiosqlite.Row
+    await _db.execute("PRAGMA journal_mode=WAL")
+    await _db.execute("PRAGMA synchronous=NORMAL")
+    await _db.execute("PRAGMA busy_timeout=5000")
+
+    await _db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            free_downloads INTEGER DEFAULT 1,
+            is_whitelisted BOOLEAN DEFAULT FALSE,
+            quality TEXT DEFAULT 'standard'
+        )
+    """)
+    # Databases created before the quality setting existed
+    async with _db.execute("PRAGMA table_info(users)") as cursor:
+        columns = {row['name'] for row in await cursor.fetchall()}
+    if 'quality' not in columns:
+        await _db.execute("ALTER TABLE users ADD COLUMN quality TEXT DEFAULT 'standard'")
+    await _db.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+    await _db.execute("""
+        CREATE TABLE IF NOT EXISTS audio_cache (
+            cache_key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            title TEXT,
+            performer TEXT,
+            hits INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # How often each track was asked for, whatever served it; drives prefetching
+    await _db.execute("""
+        CREATE TABLE IF NOT EXISTS track_requests (
+            cache_key TEXT PRIMARY KEY,
+            requests INTEGER DEFAULT 0,
+            last_requested REAL
+        )
+    """)
+    await _db.execute("CREATE INDEX IF NOT EXISTS idx_track_requests_requests ON track_requests(requests)")
+    await _db.execute("""
+        CREATE TABLE IF NOT EXISTS job_history (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            query TEXT,
+            outcome TEXT,
+            seconds REAL,
+            finished_at REAL
+        )
+    """)
+    await _db.execute("CREATE INDEX IF NOT EXISTS idx_job_history_user ON job_history(user_id, finished_at)")
+    await _db.execute("CREATE INDEX IF NOT EXISTS idx_job_history_finished ON job_history(finished_at)")
+    # Counters per hour (unix time // 3600), updated as jobs and payments happen so
+    # admin stats never scan job_history. Metrics: "jobs:<outcome>", "stars", "stars_refunded".
+    await _db.execute("""
+        CREATE TABLE IF NOT EXISTS hourly_stats (
+            hour INTEGER,
+            metric TEXT,
+            value INTEGER DEFAULT 0,
+            PRIMARY KEY (hour, metric)
+        )
+    """)
+    # track_requests split by hour, for the most requested tracks of a time window
+    await _db.execute("""
+        CREATE TABLE IF NOT EXISTS hourly_track_requests (
+            hour INTEGER,
+            cache_key TEXT,
+            requests INTEGER DEFAULT 0,
+            PRIMARY KEY (hour, cache_key)
+        )
+    """)
+    await _db.commit()
+    _flush_task = asyncio.create_task(_flush_loop())
+
+async def close_db():
+    global _db, _flush_task
+    if _flush_task:
+        _flush_task.cancel()
+        _flush_task = None
+    if _db is not None:
+        await flush_writes()
+        await _db.close()
+        _db = None
+    _users.clear()
+
+async def _conn() -> aiosqlite.Connection:
+    # Scripts and tests may call into the module without going through the app lifespan
+    if _db is None:
+        await init_db()
+    return _db
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush_writes()
+        except Exception as e:
+            print(f"Failed to flush batched writes: {e}")
+
+async def _write(sql: str, params: tuple = ()) -> list:
+    """Runs one write statement in its own transaction and returns the rows it RETURNs."""
+    db = await _conn()
+    async with _write_lock:
+        async with db.execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
         await db.commit()
+    return rows
 
-async def get_user(user_id: int, username: str = None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            user = await cursor.fetchone()
-            
-        if not user:
-            # Check whitelist
-            is_whitelisted = username in ["exsslx", "polya_poela"]
-            await db.execute(
-                "INSERT INTO users (user_id, username, is_whitelisted) VALUES (?, ?, ?)",
-                (user_id, username, is_whitelisted)
+async def flush_writes():
+    """Writes batched counters in a single transaction."""
+    if not _pending_hits and not _pending_requests and not _pending_jobs and not _pending_stats:
+        return
+    hits = list(_pending_hits.items())
+    _pending_hits.clear()
+    requests = [(key, n, last) for key, (n, last) in _pending_requests.items()]
+    _pending_requests.clear()
+    track_hours = [(hour, key, n) for (hour, key), n in _pending_track_hours.items()]
+    _pending_track_hours.clear()
+    jobs = _pending_jobs[:]
+    _pending_jobs.clear()
+    stats = [(hour, metric, n) for (hour, metric), n in _pending_stats.items()]
+    _pending_stats.clear()
+    async with _write_lock:
+        try:
+            await _db.executemany("UPDATE audio_cache SET hits = hits + ? WHERE cache_key = ?", [(n, key) for key, n in hits])
+            await _db.executemany(
+                "INSERT INTO track_requests (cache_key, requests, last_requested) VALUES (?, ?, ?) "
+                "ON CONFLICT(cache_key) DO UPDATE SET requests = requests + excluded.requests, last_requested = excluded.last_requested",
+                requests
+            )
+            if track_hours:
+                await _db.executemany(
+                    "INSERT INTO hourly_track_requests (hour, cache_key, requests) VALUES (?, ?, ?) "
+                    "ON CONFLICT(hour, cache_key) DO UPDATE SET requests = requests + excluded.requests",
+                    track_hours
+                )
+                await _db.execute(
+                    "DELETE FROM hourly_track_requests WHERE hour < ?", (int(time.time() // 3600 - TRACK_HOURS_DAYS * 24),)
+                )
+            if jobs:
+                await _db.executemany(
+                    "INSERT INTO job_history (user_id, query, outcome, seconds, finished_at) VALUES (?, ?, ?, ?, ?)", jobs
+                )
+                await _db.execute("DELETE FROM job_history WHERE finished_at < ?", (time.time() - JOB_HISTORY_DAYS * 86400,))
+            await _db.executemany(
+                "INSERT INTO hourly_stats (hour, metric, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(hour, metric) DO UPDATE SET value = value + excluded.value",
+                stats
             )
-            await db.commit()
-            async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
-                user = await cursor.fetchone()
-        
+            await _db.commit()
+        except Exception:
+            await _db.rollback()
+            # Put the counts back for the next flush instead of losing them
+            for key, n in hits:
+                _pending_hits[key] = _pending_hits.get(key, 0) + n
+            for key, n, last in requests:
+                pending_n, pending_last = _pending_requests.get(key, (0, last))
+                _pending_requests[key] = (pending_n + n, max(pending_last, last))
+            for hour, key, n in track_hours:
+                _pending_track_hours[(hour, key)] = _pending_track_hours.get((hour, key), 0) + n
+            _pending_jobs[:0] = jobs
+            for hour, metric, n in stats:
+                _pending_stats[(hour, metric)] = _pending_stats.get((hour, metric), 0) + n
+            raise
+
+async def get_user(user_id: int, username: str = None):
+    user = _users.get(user_id)
+    if user is not None and (username is None or user['username'] == username):
         return user
 
+    db = await _conn()
+    async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+        row = await cursor.fetchone()
+
+    if not row:
+        # Check whitelist
+        is_whitelisted = username in ["exsslx", "polya_poela"]
+        (row,) = await _write(
+            "INSERT INTO users (user_id, username, is_whitelisted) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET username = excluded.username RETURNING *",
+            (user_id, username, is_whitelisted)
+        )
+    elif username is not None and row['username'] != username:
+        (row,) = await _write("UPDATE users SET username = ? WHERE user_id = ? RETURNING *", (username, user_id))
+
+    user = dict(row)
+    _users.set(user_id, user)
+    return user
+
+def _update_cached_user(user_id: int, column: str, value):
+    user = _users.get(user_id)
+    if user is not None:
+        user[column] = value
+
+async def try_consume_free_download(user_id: int) -> Optional[int]:
+    """Atomically takes one free download. Returns the remaining count, or None if there was none left."""
+    rows = await _write(
+        "UPDATE users SET free_downloads = free_downloads - 1 WHERE user_id = ? AND free_downloads > 0 RETURNING free_downloads",
+        (user_id,)
+    )
+    if not rows:
+        return None
+    row = rows[0]
+    _update_cached_user(user_id, 'free_downloads', row['free_downloads'])
+    return row['free_downloads']
+
+async def add_free_downloads(user_id: int, count: int):
+    rows = await _write(
+        "UPDATE users SET free_downloads = free_downloads + ? WHERE user_id = ? RETURNING free_downloads",
+        (count, user_id)
+    )
+    if rows:
+        _update_cached_user(user_id, 'free_downloads', rows[0]['free_downloads'])
+
+async def set_user_quality(user_id: int, quality: str):
+    rows = await _write("UPDATE users SET quality = ? WHERE user_id = ? RETURNING quality", (quality, user_id))
+    if rows:
+        _update_cached_user(user_id, 'quality', rows[0]['quality'])
+
+async def find_user(target) -> Optional[dict]:
+    """Looks a user up by ID or by username (with or without "@")."""
+    db = await _conn()
+    if isinstance(target, int):
+        sql, param = "SELECT * FROM users WHERE user_id = ?", target
+    else:
+        sql, param = "SELECT * FROM users WHERE username = ?", target.lstrip('@')
+    async with db.execute(sql, (param,)) as cursor:
+        row = await cursor.fetchone()
+    return dict(row) if row else None
+
+async def adjust_free_downloads(targets: list, delta: int) -> int:
+    """Adds ``delta`` (negative to revoke, never going below 0) free downloads to many users at once.
+
+    ``targets`` are user IDs and usernames (with or without "@"). Returns how
+    many users were changed.
+    """
+    user_ids = [target for target in targets if isinstance(target, int)]
+    usernames = [target.lstrip('@') for target in targets if isinstance(target, str)]
+    db = await _conn()
+    changed = []
+    async with _write_lock:
+        for column, values in (("user_id", user_ids), ("username", usernames)):
+            for start in range(0, len(values), BULK_CHUNK):
+                chunk = values[start:start + BULK_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                async with db.execute(
+                    f"UPDATE users SET free_downloads = MAX(free_downloads + ?, 0) WHERE {column} IN ({placeholders}) "
+                    "RETURNING user_id, free_downloads",
+                    (delta, *chunk)
+                ) as cursor:
+                    changed += await cursor.fetchall()
+        await db.commit()
+    for row in changed:
+        _update_cached_user(row['user_id'], 'free_downloads', row['free_downloads'])
+    return len(changed)
+
 async def add_free_downloads_by_username(username: str, count: int):
     # Remove @ if present
     username = username.lstrip('@')
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE users SET free_downloads = free_downloads + ? WHERE username = ?",
-            (count, username)
-        )
-        await db.commit()
+    rows = await _write(
+        "UPDATE users SET free_downloads = free_downloads + ? WHERE username = ? RETURNING user_id, free_downloads",
+        (count, username)
+    )
+    for row in rows:
+        _update_cached_user(row['user_id'], 'free_downloads', row['free_downloads'])
+
+async def get_cached_audio(cache_key: str):
+    db = await _conn()
+    async with db.execute("SELECT * FROM audio_cache WHERE cache_key = ?", (cache_key,)) as cursor:
+        entry = await cursor.fetchone()
+
+    metrics.record_cache_lookup("file_id", entry is not None)
+    if not entry:
+        cache_stats["misses"] += 1
+        return None
+
+    cache_stats["hits"] += 1
+    _pending_hits[cache_key] = _pending_hits.get(cache_key, 0) + 1
+    return dict(entry)
+
+async def get_cached_file_ids(cache_keys: list) -> dict:
+    """cache_key -> file_id for those of ``cache_keys`` that are cached, in one query."""
+    if not cache_keys:
+        return {}
+    db = await _conn()
+    placeholders = ",".join("?" * len(cache_keys))
+    async with db.execute(f"SELECT cache_key, file_id FROM audio_cache WHERE cache_key IN ({placeholders})", cache_keys) as cursor:
+        rows = await cursor.fetchall()
+    return {row['cache_key']: row['file_id'] for row in rows}
+
+async def save_cached_audio(cache_key: str, file_id: str, title: str = None, performer: str = None):
+    await _write(
+        "INSERT OR REPLACE INTO audio_cache (cache_key, file_id, title, performer) VALUES (?, ?, ?, ?)",
+        (cache_key, file_id, title, performer)
+    )
+
+async def invalidate_cached_audio(cache_key: str) -> bool:
+    _pending_hits.pop(cache_key, None)
+    rows = await _write("DELETE FROM audio_cache WHERE cache_key = ? RETURNING cache_key", (cache_key,))
+    return bool(rows)
+
+async def get_cache_stats() -> dict:
+    db = await _conn()
+    async with db.execute("SELECT COUNT(*) FROM audio_cache") as cursor:
+        (entries,) = await cursor.fetchone()
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    return {
+        "entries": entries,
+        "hits": cache_stats["hits"],
+        "misses": cache_stats["misses"],
+        "hit_ratio": cache_stats["hits"] / lookups if lookups else 0.0,
+    }
+
+def record_track_request(cache_key: str):
+    """Counts a request for a track; written with the next batch flush."""
+    now = time.time()
+    count, _ = _pending_requests.get(cache_key, (0, None))
+    _pending_requests[cache_key] = (count + 1, now)
+    key = (int(now // 3600), cache_key)
+    _pending_track_hours[key] = _pending_track_hours.get(key, 0) + 1
+
+async def get_popular_tracks(limit: int, since: float) -> list:
+    """Cache keys requested most often since the ``since`` timestamp, most popular first."""
+    db = await _conn()
+    await flush_writes()
+    async with db.execute(
+        "SELECT cache_key FROM track_requests WHERE last_requested >= ? ORDER BY requests DESC LIMIT ?",
+        (since, limit)
+    ) as cursor:
+        rows = await cursor.fetchall()
+    return [row['cache_key'] for row in rows]
+
+def record_stat(metric: str, value: int = 1):
+    """Adds to this hour's counter in hourly_stats; written with the next batch flush."""
+    key = (int(time.time() // 3600), metric)
+    _pending_stats[key] = _pending_stats.get(key, 0) + value
+
+def record_job(user_id: int, query: str, outcome: str, seconds: float):
+    _pending_jobs.append((user_id, query, outcome, seconds, time.time()))
+    record_stat(f"jobs:{outcome}")
+
+async def get_user_history(user_id: int, limit: int = 10) -> list:
+    """The user's most recent finished jobs, newest first."""
+    db = await _conn()
+    await flush_writes()
+    async with db.execute(
+        "SELECT query, outcome, seconds, finished_at FROM job_history WHERE user_id = ? ORDER BY finished_at DESC LIMIT ?",
+        (user_id, limit)
+    ) as cursor:
+        return [dict(row) for row in await cursor.fetchall()]
+
+async def get_admin_stats(hours: int = 24, top: int = 5) -> dict:
+    """Totals and the most requested tracks of the last ``hours`` hours, from the hourly aggregates.
+
+    Tracks only go back ``TRACK_HOURS_DAYS``.
+    """
+    db = await _conn()
+    await flush_writes()
+    since = int(time.time() // 3600) - hours + 1
+    async with db.execute(
+        "SELECT metric, SUM(value) AS total FROM hourly_stats WHERE hour >= ? GROUP BY metric", (since,)
+    ) as cursor:
+        totals = {row['metric']: row['total'] for row in await cursor.fetchall()}
+    async with db.execute(
+        "SELECT h.cache_key, SUM(h.requests) AS requests, c.title, c.performer FROM hourly_track_requests h "
+        "LEFT JOIN audio_cache c ON c.cache_key = h.cache_key WHERE h.hour >= ? "
+        "GROUP BY h.cache_key ORDER BY requests DESC LIMIT ?",
+        (since, top)
+    ) as cursor:
+        top_tracks = [dict(row) for row in await cursor.fetchall()]
+
+    outcomes = {metric.split(":", 1)[1]: n for metric, n in totals.items() if metric.startswith("jobs:")}
+    jobs = sum(outcomes.values())
+    # Jobs the user cancelled didn't fail
+    failures = {outcome: n for outcome, n in outcomes.items() if outcome not in ("ok", "cancelled")}
+    return {
+        'hours': hours,
+        'jobs': jobs,
+        'jobs_per_hour': jobs / hours,
+        'failure_rate': sum(failures.values()) / jobs if jobs else 0.0,
+        'failures': failures,
+        'cancelled': outcomes.get("cancelled", 0),
+        'stars': totals.get("stars", 0),
+        'stars_refunded': totals.get("stars_refunded", 0),
+        'top_tracks': top_tracks,
+    }
@@ -0,0 +1,74 @@
+"""Offline evaluation of source selection against fixtures/search_eval.json.
+
+Each case holds per-source search results and latencies. The script replays
+them through YandexMusicHandler.find_best_match (concurrent search + scoring)
+and through the old strategy (first YouTube hit, SoundCloud only if YouTube
+returned nothing). For both it reports accuracy and time-to-first-byte, i.e.
+the time until the download of the chosen candidate could start.
+
+    python eval_search.py --speedup 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import logic
+from logic import YandexMusicHandler
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "search_eval.json")
+
+
+class ReplayHandler(YandexMusicHandler):
+    def __init__(self, case: dict, speedup: float):
+        super().__init__()
+        self.case = case
+        self.speedup = speedup
+
+    def _search_source(self, search: str) -> list:
+        source = "YouTube" if search.startswith("ytsearch") else "SoundCloud"
+        recorded = self.case['sources'][source]
+        time.sleep(recorded['latency'] / self.speedup)
+        return recorded['results']
+
+
+def serial_first_hit(case: dict) -> tuple:
+    elapsed = 0.0
+    for source in ("YouTube", "SoundCloud"):
+        recorded = case['sources'][source]
+        elapsed += recorded['latency']
+        if recorded['results']:
+            return recorded['results'][0]['id'], elapsed
+    return None, elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--speedup', type=float, default=10.0, help="divide recorded latencies by this factor")
+    args = parser.parse_args()
+
+    with open(FIXTURE, encoding='utf-8') as f:
+        cases = json.load(f)
+
+    results = {'serial': [], 'racing': []}
+    for case in cases:
+        picked, ttfb = serial_first_hit(case)
+        results['serial'].append((picked in case['acceptable'], ttfb))
+
+        handler = ReplayHandler(case, args.speedup)
+        started = time.perf_counter()
+        candidate = await handler.find_best_match(f"{case['artist']} - {case['title']}", case['artist'], case['title'], case['duration'])
+        ttfb = (time.perf_counter() - started) * args.speedup
+        results['racing'].append(((candidate or {}).get('id') in case['acceptable'], ttfb))
+        handler._fetch_pool.shutdown(wait=True)
+
+    print(f"{len(cases)} cases, GOOD_MATCH_SCORE={logic.GOOD_MATCH_SCORE}")
+    for name, rows in results.items():
+        accuracy = sum(ok for ok, _ in rows) / len(rows)
+        mean_ttfb = sum(t for _, t in rows) / len(rows)
+        print(f"{name:>7}: accuracy {accuracy:.0%}, mean time-to-first-byte {mean_ttfb:.2f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Optional
+
+
+class FairQueue:
+    """Bounded job queue that serves users round-robin.
+
+    Each user gets their own FIFO; ``get`` takes one job from the user at the
+    head of the rotation and moves that user to the back, so a user who pastes
+    30 links only gets every N-th slot instead of blocking everyone else.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self._users = OrderedDict()  # user_id -> deque of jobs, in rotation order
+        self._size = 0
+        self._not_empty = asyncio.Condition()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self._size
+
+    async def put(self, job: dict, force: bool = False):
+        """Add ``job`` to its user's FIFO.
+
+        Raises ``asyncio.QueueFull`` when the queue is at ``maxsize`` unless
+        ``force`` is set (used for jobs that were already paid for).
+        """
+        if self.full() and not force:
+            raise asyncio.QueueFull
+        user_jobs = self._users.get(job['user_id'])
+        if user_jobs is None:
+            user_jobs = self._users[job['user_id']] = deque()
+        user_jobs.append(job)
+        self._size += 1
+        async with self._not_empty:
+            self._not_empty.notify()
+
+    async def get(self) -> dict:
+        async with self._not_empty:
+            await self._not_empty.wait_for(lambda: self._size > 0)
+            user_id, user_jobs = next(iter(self._users.items()))
+            job = user_jobs.popleft()
+            self._size -= 1
+            if user_jobs:
+                self._users.move_to_end(user_id)
+            else:
+                del self._users[user_id]
+            return job
+
+    def remove(self, predicate) -> Optional[dict]:
+        """Takes out and returns the first queued job matching ``predicate``, or None."""
+        for user_id, user_jobs in self._users.items():
+            for job in user_jobs:
+                if predicate(job):
+                    user_jobs.remove(job)
+                    self._size -= 1
+                    if not user_jobs:
+                        del self._users[user_id]
+                    return job
+        return None
+
+    def ordered(self) -> list:
+        """Pending jobs in the order they will be served."""
+        queues = list(self._users.values())
+        result = []
+        depth = 0
+        while len(result) < self._size:
+            for user_jobs in queues:
+                if depth < len(user_jobs):
+                    result.append(user_jobs[depth])
+            depth += 1
+        return result
+
+    def position(self, job: dict) -> int:
+        """1-based position of ``job`` in the service order, 0 if not queued."""
+        for index, queued in enumerate(self.ordered(), start=1):
+            if queued is job:
+                return index
+        return 0
@@ -0,0 +1,78 @@
+import asyncio
+import itertools
+from typing import Awaitable, Callable, Optional, Tuple
+
+from matching import normalize
+from singleflight import SingleFlight
+from ttl_cache import TTLCache
+
+
+class InlineSearch:
+    """Answers per-keystroke inline queries within a fixed time budget.
+
+    Results are memoized by normalized query text. A query from a user who
+    types again within ``debounce`` seconds is dropped in favour of the newer
+    one, and identical queries from different users share one backend call.
+    If the backend doesn't answer within ``budget`` seconds the caller gets
+    a partial result, filtered from the longest cached prefix of the query,
+    while the search keeps running to fill the cache for the next keystroke.
+    """
+
+    def __init__(self, search: Callable[[str], Awaitable[list]], budget: float = 0.3, debounce: float = 0.1,
+                 ttl: float = 600, maxsize: int = 4096, min_length: int = 2):
+        self.search = search
+        self.budget = budget
+        self.debounce = debounce
+        self.min_length = min_length
+        self.results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._flight = SingleFlight()
+        self._latest = TTLCache(maxsize=10_000, ttl=60)  # user_id -> token of their newest query
+        self._tokens = itertools.count()
+        self.backend_calls = 0
+
+    async def query(self, user_id: int, text: str) -> Optional[Tuple[list, bool]]:
+        """Returns ``(tracks, complete)``, or None if a newer query from the same user replaced this one."""
+        key = normalize(text)
+        if len(key) < self.min_length:
+            return [], True
+        cached = self.results.get(key)
+        if cached is not None:
+            return cached, True
+
+        token = next(self._tokens)
+        self._latest.set(user_id, token)
+        await asyncio.sleep(self.debounce)
+        if self._latest.get(user_id) != token:
+            return None
+
+        task = asyncio.ensure_future(self._flight.do(key, lambda: self._search(key)))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        try:
+            tracks, _ = await asyncio.wait_for(asyncio.shield(task), max(0.0, self.budget - self.debounce))
+            return tracks, True
+        except asyncio.TimeoutError:
+            return self.from_prefix(key), False
+        except Exception as e:
+            print(f"Inline search failed for {key!r}: {e}")
+            return self.from_prefix(key), False
+
+    async def _search(self, key: str) -> list:
+        self.backend_calls += 1
+        tracks = await self.search(key)
+        self.results.set(key, tracks)
+        return tracks
+
+    def from_prefix(self, key: str) -> list:
+        """Cached results of the longest shorter query, narrowed down to tracks that still match ``key``."""
+        words = key.split()
+        for end in range(len(key) - 1, self.min_length - 1, -1):
+            cached = self.results.get(key[:end].rstrip())
+            if cached is None:
+                continue
+            matching = []
+            for track in cached:
+                found = normalize(f"{track['artist']} {track['title']}").split()
+                if all(any(word.startswith(part) for word in found) for part in words):
+                    matching.append(track)
+            return matching
+        return []
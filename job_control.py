@@ -0,0 +1,65 @@
+"""Cancellation and progress of the job being worked on.
+
+A worker gives each job a ``JobControl`` and runs it with ``current_job``
+set. Code deep in the pipeline, including yt-dlp progress hooks and the
+ranged downloader running in fetch threads, reads it from there: it reports
+bytes downloaded and calls ``check`` between blocks, which raises
+``JobCancelled`` once the user pressed cancel. Threads only see the
+context if they were started through ``run_in_executor`` below.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import Executor
+from typing import Optional
+
+
+class JobCancelled(Exception):
+    """The user cancelled the job."""
+
+
+class JobControl:
+    def __init__(self, job_id: Optional[int] = None):
+        self.job_id = job_id
+        self.cancelled = threading.Event()
+        self.task: Optional[asyncio.Task] = None
+        # Written by fetch threads, read by the progress reporter
+        self.downloaded = 0
+        self.total: Optional[int] = None
+
+    def cancel(self):
+        """Stops the job: fetch threads at their next ``check``, the job's task right away."""
+        self.cancelled.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise JobCancelled(f"job {self.job_id} cancelled")
+
+    def progress(self, downloaded: int, total: Optional[int]):
+        self.downloaded = downloaded
+        if total:
+            self.total = total
+
+
+current_job: contextvars.ContextVar[Optional[JobControl]] = contextvars.ContextVar("current_job", default=None)
+
+
+def check_cancelled():
+    control = current_job.get()
+    if control is not None:
+        control.check()
+
+
+def report_progress(downloaded: int, total: Optional[int]):
+    control = current_job.get()
+    if control is not None:
+        control.progress(downloaded, total)
+
+
+def run_in_executor(executor: Optional[Executor], fn, *args) -> asyncio.Future:
+    """``loop.run_in_executor`` that runs ``fn`` in the caller's context (current job, trace)."""
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(executor, functools.partial(context.run, fn, *args))
@@ -0,0 +1,412 @@
+import asyncio
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import aiosqlite
+
+from fair_queue import FairQueue
+from ttl_cache import TTLCache
+
+JOB_STORE = os.getenv("JOB_STORE", "sqlite")
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "bot_data.db")
+# A leased job that isn't completed or extended within this time goes back to the queue
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 120))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", 10))
+# Finished, dead and cancelled jobs are deleted after this long (their idempotency keys with them)
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", 7))
+# How often idle workers look for jobs enqueued by other processes
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))
+# A job enqueued with an owner is left to that worker for this long before anyone may take it
+JOB_OWNER_WAIT = float(os.getenv("JOB_OWNER_WAIT", 600))
+
+
+class JobStore(ABC):
+    """Queue of download jobs shared by all workers.
+
+    Jobs are plain JSON-serialisable dicts with a ``user_id``. A worker
+    ``lease``s a job, keeps it alive with ``extend`` while it runs and then
+    either ``complete``s or ``fail``s it. A job whose lease runs out (the
+    worker crashed or the process was redeployed) is handed out again.
+    Leased jobs carry ``_id`` and ``_attempts`` keys. A job whose holders
+    kept dying on it is handed out one last time with ``_dead`` set: the
+    worker must not run it, only refund and report it.
+
+    A job can be enqueued with an ``owner``, the ``worker_id`` that should
+    run it because it holds state for it in memory (an album being
+    assembled). Other workers only lease it once it has waited too long.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self._wakeup = asyncio.Event()
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def wait_for_jobs(self, timeout: float = JOB_POLL_INTERVAL):
+        """Sleeps until a job is enqueued in this process or ``timeout`` passes."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def is_full(self) -> bool:
+        return 0 < self.maxsize <= await self.pending_count()
+
+    @abstractmethod
+    async def enqueue(self, job: dict, idempotency_key: str = None, force: bool = False,
+                      owner: str = None) -> Optional[int]:
+        """Adds a job and returns its id, or None if ``idempotency_key`` was seen before.
+
+        Raises ``asyncio.QueueFull`` when at ``maxsize`` unless ``force`` is set.
+        """
+
+    @abstractmethod
+    async def seen(self, idempotency_key: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def find(self, idempotency_key: str) -> Optional[int]:
+        """Id of the job enqueued under ``idempotency_key``, in whatever state it is."""
+
+    @abstractmethod
+    async def lease(self, worker_id: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def extend(self, job_id: int, worker_id: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def complete(self, job_id: int, worker_id: str) -> bool:
+        """Marks a job done. Returns False if the lease was lost to another worker."""
+
+    @abstractmethod
+    async def fail(self, job_id: int, worker_id: str, error: str) -> Optional[bool]:
+        """Returns True if the job will be retried, False if it was given up on.
+
+        None means the lease had already passed to another worker.
+        """
+
+    @abstractmethod
+    async def cancel(self, job_id: int, user_id: int) -> Optional[dict]:
+        """Cancels a queued or running job of ``user_id``.
+
+        Returns the job with ``_state`` set to the state it was cancelled in
+        ("queued" or "leased"), or None if the user has no such unfinished job.
+        The worker holding a cancelled job can no longer extend or complete it.
+        """
+
+    @abstractmethod
+    async def is_cancelled(self, job_id: int) -> bool:
+        pass
+
+    @abstractmethod
+    async def pending_count(self) -> int:
+        pass
+
+    @abstractmethod
+    async def pending_jobs(self, limit: int) -> list:
+        """Queued jobs in the order they will be served."""
+
+
+class SqliteJobStore(JobStore):
+    """Durable job store in SQLite; safe to share between processes on the same disk.
+
+    Jobs are served round-robin across users: each job gets ``user_seq``, one
+    past the highest of that user's unfinished jobs (and never below the
+    queue's head, so a newcomer does not jump ahead of everyone for several
+    turns), and jobs are leased in (user_seq, id) order.
+    """
+
+    def __init__(self, path: str = JOB_DB_PATH, maxsize: int = 0, lease_seconds: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, retry_backoff: float = JOB_RETRY_BACKOFF,
+                 owner_wait: float = JOB_OWNER_WAIT, retention_days: float = JOB_RETENTION_DAYS):
+        super().__init__(maxsize)
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.owner_wait = owner_wait
+        self.retention_days = retention_days
+        self._next_purge = 0.0
+        self._db: Optional[aiosqlite.Connection] = None
+
+    async def open(self):
+        self._db = await aiosqlite.connect(self.path, isolation_level=None)
+        self._db.row_factory = aiosqlite.Row
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute("PRAGMA busy_timeout=5000")
+        await self._db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT UNIQUE,
+                user_id INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                user_seq INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                lease_until REAL,
+                worker TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        async with self._db.execute("PRAGMA table_info(jobs)") as cursor:
+            columns = {row['name'] for row in await cursor.fetchall()}
+        if 'owner' not in columns:
+            await self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        await self._db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(state, user_seq, id)")
+        await self._db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs(user_id, state)")
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def enqueue(self, job: dict, idempotency_key: str = None, force: bool = False,
+                      owner: str = None) -> Optional[int]:
+        if not force and await self.is_full():
+            raise asyncio.QueueFull
+        now = time.time()
+        async with self._db.execute(
+            """
+            INSERT INTO jobs (idempotency_key, user_id, payload, user_seq, available_at, created_at, owner)
+            VALUES (?, ?, ?, MAX(
+                COALESCE((SELECT MAX(user_seq) + 1 FROM jobs WHERE user_id = ? AND state IN ('queued', 'leased')), 0),
+                COALESCE((SELECT MIN(user_seq) FROM jobs WHERE state = 'queued'), 0)
+            ), ?, ?, ?)
+            ON CONFLICT(idempotency_key) DO NOTHING
+            RETURNING id
+            """,
+            (idempotency_key, job['user_id'], json.dumps(job), job['user_id'], now, now, owner)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        self._wakeup.set()
+        return row['id']
+
+    async def seen(self, idempotency_key: str) -> bool:
+        async with self._db.execute("SELECT 1 FROM jobs WHERE idempotency_key = ?", (idempotency_key,)) as cursor:
+            return await cursor.fetchone() is not None
+
+    async def find(self, idempotency_key: str) -> Optional[int]:
+        async with self._db.execute("SELECT id FROM jobs WHERE idempotency_key = ?", (idempotency_key,)) as cursor:
+            row = await cursor.fetchone()
+        return row['id'] if row else None
+
+    async def lease(self, worker_id: str) -> Optional[dict]:
+        while True:
+            now = time.time()
+            # A single UPDATE ... RETURNING is atomic, so two workers can never lease the same job
+            async with self._db.execute(
+                """
+                UPDATE jobs SET state = 'leased', lease_until = ?, worker = ?, attempts = attempts + 1
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE (
+                        state = 'queued' AND available_at <= ?
+                        AND (owner IS NULL OR owner = ? OR created_at <= ?)
+                    ) OR (state = 'leased' AND lease_until < ?)
+                    ORDER BY user_seq, id LIMIT 1
+                )
+                RETURNING id, payload, attempts
+                """,
+                (now + self.lease_seconds, worker_id, now, worker_id, now - self.owner_wait, now)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                if now >= self._next_purge:
+                    await self.purge()
+                return None
+            job = json.loads(row['payload'])
+            job['_id'] = row['id']
+            job['_attempts'] = row['attempts']
+            if row['attempts'] > self.max_attempts:
+                # Its previous holders kept dying on it
+                await self._db.execute("UPDATE jobs SET state = 'dead', last_error = 'lease expired' WHERE id = ?", (row['id'],))
+                job['_dead'] = True
+            return job
+
+    async def purge(self):
+        """Deletes jobs that ended more than ``retention_days`` ago; idle workers call it about hourly."""
+        self._next_purge = time.time() + 3600
+        await self._db.execute(
+            "DELETE FROM jobs WHERE state IN ('done', 'dead', 'cancelled') AND created_at < ?",
+            (time.time() - self.retention_days * 86400,)
+        )
+
+    async def extend(self, job_id: int, worker_id: str) -> bool:
+        cursor = await self._db.execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (time.time() + self.lease_seconds, job_id, worker_id)
+        )
+        return cursor.rowcount > 0
+
+    async def complete(self, job_id: int, worker_id: str) -> bool:
+        cursor = await self._db.execute(
+            "UPDATE jobs SET state = 'done', lease_until = NULL WHERE id = ? AND worker = ? AND state = 'leased'",
+            (job_id, worker_id)
+        )
+        return cursor.rowcount > 0
+
+    async def fail(self, job_id: int, worker_id: str, error: str) -> Optional[bool]:
+        async with self._db.execute(
+            """
+            UPDATE jobs SET
+                state = CASE WHEN attempts >= ? THEN 'dead' ELSE 'queued' END,
+                available_at = ? + ? * (1 << (attempts - 1)),
+                lease_until = NULL,
+                last_error = ?
+            WHERE id = ? AND worker = ? AND state = 'leased'
+            RETURNING state
+            """,
+            (self.max_attempts, time.time(), self.retry_backoff, error[:500], job_id, worker_id)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        return row['state'] == 'queued'
+
+    async def cancel(self, job_id: int, user_id: int) -> Optional[dict]:
+        async with self._db.execute(
+            "SELECT state FROM jobs WHERE id = ? AND user_id = ? AND state IN ('queued', 'leased')", (job_id, user_id)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        async with self._db.execute(
+            "UPDATE jobs SET state = 'cancelled', lease_until = NULL WHERE id = ? AND state = ? RETURNING payload",
+            (job_id, row['state'])
+        ) as cursor:
+            cancelled = await cursor.fetchone()
+        if cancelled is None:
+            return None
+        return dict(json.loads(cancelled['payload']), _id=job_id, _state=row['state'])
+
+    async def is_cancelled(self, job_id: int) -> bool:
+        async with self._db.execute("SELECT 1 FROM jobs WHERE id = ? AND state = 'cancelled'", (job_id,)) as cursor:
+            return await cursor.fetchone() is not None
+
+    async def pending_count(self) -> int:
+        async with self._db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'") as cursor:
+            (count,) = await cursor.fetchone()
+        return count
+
+    async def pending_jobs(self, limit: int) -> list:
+        async with self._db.execute(
+            "SELECT id, payload FROM jobs WHERE state = 'queued' ORDER BY user_seq, id LIMIT ?", (limit,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        return [dict(json.loads(row['payload']), _id=row['id']) for row in rows]
+
+
+class MemoryJobStore(JobStore):
+    """In-process store on top of FairQueue. Jobs are lost on restart; meant for tests and local runs."""
+
+    def __init__(self, maxsize: int = 0, max_attempts: int = JOB_MAX_ATTEMPTS, retry_backoff: float = JOB_RETRY_BACKOFF):
+        super().__init__(maxsize)
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self._backing_off = {}  # job id -> failed job waiting to be requeued
+        self._requeue_tasks = set()
+        self._queue = FairQueue()
+        self._leased = {}
+        self._keys = TTLCache(maxsize=100_000, ttl=24 * 3600)  # idempotency key -> job id
+        self._cancelled = TTLCache(maxsize=10_000, ttl=24 * 3600)
+        self._next_id = 0
+
+    async def enqueue(self, job: dict, idempotency_key: str = None, force: bool = False,
+                      owner: str = None) -> Optional[int]:
+        # One process runs every job, so owners don't matter
+        if not force and await self.is_full():
+            raise asyncio.QueueFull
+        if idempotency_key:
+            if self._keys.get(idempotency_key):
+                return None
+            self._keys.set(idempotency_key, self._next_id + 1)
+        self._next_id += 1
+        await self._queue.put(dict(job, _id=self._next_id, _attempts=0), force=True)
+        self._wakeup.set()
+        return self._next_id
+
+    async def seen(self, idempotency_key: str) -> bool:
+        return bool(self._keys.get(idempotency_key))
+
+    async def find(self, idempotency_key: str) -> Optional[int]:
+        return self._keys.get(idempotency_key)
+
+    async def lease(self, worker_id: str) -> Optional[dict]:
+        if self._queue.empty():
+            return None
+        job = await self._queue.get()
+        job['_attempts'] += 1
+        self._leased[job['_id']] = job
+        return job
+
+    async def extend(self, job_id: int, worker_id: str) -> bool:
+        return job_id in self._leased
+
+    async def complete(self, job_id: int, worker_id: str) -> bool:
+        return self._leased.pop(job_id, None) is not None
+
+    async def fail(self, job_id: int, worker_id: str, error: str) -> Optional[bool]:
+        job = self._leased.pop(job_id, None)
+        if job is None:
+            return None
+        if job['_attempts'] >= self.max_attempts:
+            return False
+        # Same schedule as SqliteJobStore
+        self._backing_off[job_id] = job
+        task = asyncio.create_task(self._requeue(job_id, self.retry_backoff * (1 << (job['_attempts'] - 1))))
+        self._requeue_tasks.add(task)
+        task.add_done_callback(self._requeue_tasks.discard)
+        return True
+
+    async def _requeue(self, job_id: int, delay: float):
+        await asyncio.sleep(delay)
+        job = self._backing_off.pop(job_id, None)
+        if job is not None:  # not cancelled meanwhile
+            await self._queue.put(job, force=True)
+            self._wakeup.set()
+
+    async def cancel(self, job_id: int, user_id: int) -> Optional[dict]:
+        job = self._leased.get(job_id)
+        if job is not None and job['user_id'] == user_id:
+            del self._leased[job_id]
+            state = "leased"
+        elif job_id in self._backing_off and self._backing_off[job_id]['user_id'] == user_id:
+            job = self._backing_off.pop(job_id)
+            state = "queued"
+        else:
+            job = self._queue.remove(lambda queued: queued['_id'] == job_id and queued['user_id'] == user_id)
+            state = "queued"
+        if job is None:
+            return None
+        self._cancelled.set(job_id, True)
+        return dict(job, _state=state)
+
+    async def is_cancelled(self, job_id: int) -> bool:
+        return job_id in self._cancelled
+
+    async def pending_count(self) -> int:
+        return self._queue.qsize()
+
+    async def pending_jobs(self, limit: int) -> list:
+        return self._queue.ordered()[:limit]
+
+
+def create_job_store(maxsize: int = 0) -> JobStore:
+    if JOB_STORE == "memory":
+        return MemoryJobStore(maxsize)
+    return SqliteJobStore(JOB_DB_PATH, maxsize)
@@ -1,14 +1,257 @@
 import os
 import re
+import time
 import asyncio
+import tempfile
+import http.client
+import urllib.error
 import aiohttp
-import yt_dlp
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
+import metrics
+from audio_quality import DEFAULT_QUALITY, QUALITY_KBPS, UPLOAD_MAX_BYTES, TrackTooLarge, pick_mp3_bitrate, plan_download
+from audio_store import AudioStore
+from job_control import JobCancelled, check_cancelled, report_progress, run_in_executor
+from matching import pick_best
+from ranged_download import RANGED_CONNECTIONS, RangeNotSupported, download_ranged
+from ttl_cache import TTLCache
+from ydl_pool import YoutubeDLPool
+
+YANDEX_BASE_URL = os.getenv("YANDEX_BASE_URL", "https://music.yandex.ru")
+YANDEX_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Referer': 'https://music.yandex.ru/',
+}
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 20))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 15))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", 0.5))
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", 4096))
+METADATA_CACHE_TTL = float(os.getenv("METADATA_CACHE_TTL", 6 * 3600))
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", 8))
+# Concurrent ffmpeg encodes
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", os.cpu_count() or 1))
+# Send m4a as-is instead of re-encoding to mp3 (Telegram's sendAudio accepts mp3 and m4a)
+TRANSCODE_PASSTHROUGH = os.getenv("TRANSCODE_PASSTHROUGH", "1") == "1"
+PASSTHROUGH_EXTS = ('mp3', 'm4a') if TRANSCODE_PASSTHROUGH else ('mp3',)
+# Encode seconds per second of audio, until the first transcodes have been measured
+DEFAULT_TRANSCODE_RATE = 0.03
+# Sources searched concurrently; results are scored against the Yandex metadata
+SEARCH_SOURCES = (
+    ("YouTube", "ytsearch{n}:{query} audio"),
+    ("SoundCloud", "scsearch{n}:{query}"),
+)
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", 5))
+GOOD_MATCH_SCORE = float(os.getenv("GOOD_MATCH_SCORE", 0.9))
+MIN_MATCH_SCORE = float(os.getenv("MIN_MATCH_SCORE", 0.3))
+# Pipe ffmpeg output straight into the Telegram upload; only tracks above STREAM_MAX_BYTES go through the disk.
+# Off by default: a streamed track isn't kept in the audio store and a cut transfer can't resume from
+# partial/, so a failed upload or an interrupted source is fetched and encoded again from the start
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "0") == "1"
+STREAM_MAX_BYTES = int(os.getenv("STREAM_MAX_BYTES", 20 * 1024 * 1024))
+# A job whose source another job is fetching waits this long for it before fetching a copy of its own
+PARTIAL_WAIT_SECONDS = float(os.getenv("PARTIAL_WAIT_SECONDS", 120))
+PARTIAL_WAIT_INTERVAL = 0.5
+
+# Finished audio files are kept on disk (see audio_store.py) up to this many bytes
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ymbot-audio"))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+AUDIO_CACHE_POLICY = os.getenv("AUDIO_CACHE_POLICY", "lru")
+
+COLLECTION_MAX_TRACKS = int(os.getenv("COLLECTION_MAX_TRACKS", 50))
+
+COLLECTION_PATTERNS = (
+    ('playlist', re.compile(r'users/([^/?#]+)/playlists/(\d+)')),
+    ('album', re.compile(r'album/(\d+)')),
+    ('artist', re.compile(r'artist/(\d+)')),
+)
+
+def parse_collection_link(url: str) -> Optional[tuple]:
+    """Returns (kind, ids) for album/playlist/artist links, None for single tracks and anything else."""
+    if re.search(r'track/\d+', url):
+        return None
+    for kind, pattern in COLLECTION_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return kind, match.groups()
+    return None
+
+# Time spent per pipeline stage, used to size FETCH_WORKERS and TRANSCODE_WORKERS
+stage_stats = {}
+
+def record_stage(stage: str, seconds: float):
+    stats = stage_stats.setdefault(stage, {'count': 0, 'seconds': 0.0})
+    stats['count'] += 1
+    stats['seconds'] += seconds
+    metrics.observe_stage(stage, seconds)
+
+# Measured encode speed, used to estimate the encode time a passthrough or an early rejection saves
+transcode_rate = {'audio_seconds': 0.0, 'seconds': 0.0}
+
+def estimate_transcode_seconds(duration: Optional[float]) -> float:
+    if not duration:
+        return 0.0
+    if transcode_rate['audio_seconds']:
+        return duration * transcode_rate['seconds'] / transcode_rate['audio_seconds']
+    return duration * DEFAULT_TRANSCODE_RATE
+
+class DownloadInterrupted(Exception):
+    """The transfer broke off; a retry of the job resumes from the partial file."""
+
+def is_transfer_interruption(error: BaseException) -> bool:
+    """Whether a download broke off mid-transfer, so that retrying it can resume.
+
+    Refused requests (403, 404), unavailable videos and local errors are not.
+    """
+    from yt_dlp.networking.exceptions import HTTPError, TransportError
+    from yt_dlp.utils import ContentTooShortError, DownloadError
+
+    if isinstance(error, DownloadError) and error.exc_info:
+        error = error.exc_info[1]
+    if isinstance(error, (HTTPError, urllib.error.HTTPError)):
+        return False
+    return isinstance(error, (
+        TransportError, ContentTooShortError, http.client.IncompleteRead, ConnectionError, TimeoutError, urllib.error.URLError
+    ))
+
+async def transcode_to_mp3(source_path: str, target_path: str, bitrate: str) -> bool:
+    """Transcode stage. ffmpeg is killed if the job is cancelled."""
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-y', '-loglevel', 'error', '-i', source_path, '-vn', '-codec:a', 'libmp3lame', '-b:a', bitrate, target_path,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await process.communicate()
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    if process.returncode != 0:
+        print(f"ffmpeg failed: {stderr.decode(errors='replace')[-500:]}")
+    return process.returncode == 0
+
+def ydl_progress_hook(status: dict):
+    """Reports yt-dlp's progress to the current job and aborts the download once the job is cancelled."""
+    check_cancelled()
+    if status.get('status') == 'downloading':
+        report_progress(status.get('downloaded_bytes') or 0, status.get('total_bytes') or status.get('total_bytes_estimate'))
+
+def make_cache_key(query_or_url: str, is_link: bool, quality: str = DEFAULT_QUALITY) -> Optional[str]:
+    """Normalized track identity used to look up already uploaded audio.
+
+    Copies encoded for a non-default quality setting are cached separately.
+    """
+    if is_link:
+        match = re.search(r'track/(\d+)', query_or_url)
+        key = f"ym:{match.group(1)}" if match else None
+    else:
+        normalized = " ".join(query_or_url.lower().split())
+        key = f"q:{normalized}" if normalized else None
+    if key and quality != DEFAULT_QUALITY:
+        key = f"{key}@{quality}"
+    return key
+
+def parse_cache_key(cache_key: str) -> tuple:
+    """Inverse of make_cache_key: (query_or_url, is_link, quality)."""
+    key, _, quality = cache_key.partition('@')
+    kind, _, value = key.partition(':')
+    if kind == 'ym':
+        return f"https://music.yandex.ru/track/{value}", True, quality or DEFAULT_QUALITY
+    return value, False, quality or DEFAULT_QUALITY
+
 class YandexMusicHandler:
-    def __init__(self):
+    def __init__(self, base_url: str = YANDEX_BASE_URL):
         # We no longer need yandex-music-python or a token
-        pass
+        self.base_url = base_url.rstrip('/')
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.metadata_cache = TTLCache(maxsize=METADATA_CACHE_SIZE, ttl=METADATA_CACHE_TTL)
+        # Network-bound yt-dlp fetches and CPU-bound encodes are sized separately
+        self._fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="fetch")
+        self._transcode_slots = asyncio.Semaphore(TRANSCODE_WORKERS)
+        self.audio_store = AudioStore(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, AUDIO_CACHE_POLICY)
+        self._audio_store_loaded = False
+        # yt-dlp instances are expensive to build, so they are kept per kind of call
+        self.ydl_pool = YoutubeDLPool({
+            'search': self._ydl_opts(extract_flat='in_playlist'),
+            # Prefer m4a so it can be sent without re-encoding
+            'fetch': self._ydl_opts(
+                format='bestaudio[ext=m4a]/bestaudio/best' if TRANSCODE_PASSTHROUGH else 'bestaudio/best',
+                progress_hooks=[ydl_progress_hook],
+                # Formats download_ranged can't take (DASH/HLS): fragments in parallel, HTTP in resumable chunks
+                concurrent_fragment_downloads=RANGED_CONNECTIONS,
+                http_chunk_size=10 * 1024 * 1024,
+            ),
+            'resolve': self._ydl_opts(),
+        })
+
+    async def start(self):
+        """Opens the shared HTTP session and indexes the audio cache. Called from the app lifespan."""
+        if not self._audio_store_loaded:
+            await asyncio.get_running_loop().run_in_executor(None, self.audio_store.load)
+            self._audio_store_loaded = True
+        if self._session and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, limit_per_host=HTTP_POOL_SIZE, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=5)
+        self._session = aiohttp.ClientSession(headers=YANDEX_HEADERS, connector=connector, timeout=timeout)
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+        self.ydl_pool.close()
+
+    async def warm_up(self):
+        """Imports yt-dlp and builds its instances ahead of the first download."""
+        started = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._fetch_pool, self.ydl_pool.warm_up)
+        except Exception as e:
+            print(f"yt-dlp warm-up failed: {e}")
+            return
+        print(f"yt-dlp warmed up in {time.perf_counter() - started:.2f}s")
+
+    async def _get_json(self, path: str, params: dict) -> Optional[dict]:
+        """GET a Yandex handler, retrying 429/5xx and connection errors with exponential backoff."""
+        await self.start()
+        url = f"{self.base_url}{path}"
+        for attempt in range(HTTP_RETRIES + 1):
+            delay = HTTP_BACKOFF * 2 ** attempt
+            try:
+                async with self._session.get(url, params=params) as resp:
+                    if resp.status == 200:
+                        return await resp.json(content_type=None)
+                    if resp.status != 429 and resp.status < 500:
+                        print(f"Error: Yandex API status {resp.status}")
+                        return None
+                    print(f"Yandex API status {resp.status}, attempt {attempt + 1}/{HTTP_RETRIES + 1}")
+                    retry_after = resp.headers.get('Retry-After', '')
+                    if retry_after.isdigit():
+                        delay = max(delay, int(retry_after))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Yandex API request failed: {e!r}, attempt {attempt + 1}/{HTTP_RETRIES + 1}")
+            if attempt < HTTP_RETRIES:
+                await asyncio.sleep(delay)
+        return None
+
+    @staticmethod
+    def _parse_track(track: dict, track_id: str) -> dict:
+        title = track.get('title', 'Unknown Title')
+        artists = [a.get('name') for a in track.get('artists', [])]
+        artist_str = ", ".join(artists) if artists else "Unknown Artist"
+
+        # Clean up title (remove ' (Remix)' etc if needed, but better keep it)
+
+        query = f"{artist_str} - {title}"
+        return {
+            'track_id': track_id,
+            'query': query,
+            'title': title,
+            'artist': artist_str,
+            'duration': (track.get('durationMs') or 0) / 1000 or None,
+            'filename': f"{artist_str} - {title}.mp3".replace('/', '_').replace('\\', '_')
+        }
 
     async def get_track_info(self, url: str) -> Optional[dict]:
         # Extract track ID
@@ -17,57 +260,105 @@ class YandexMusicHandler:
             return None
         
         track_id = match.group(1)
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Referer': 'https://music.yandex.ru/',
-        }
-        
+        cached = self.metadata_cache.get(track_id)
+        metrics.record_cache_lookup('metadata', cached is not None)
+        if cached:
+            return cached
+
         try:
-            api_url = f"https://music.yandex.ru/handlers/track.jsx?track={track_id}"
-            async with aiohttp.ClientSession(headers=headers) as session:
-                async with session.get(api_url) as resp:
-                    if resp.status != 200:
-                        print(f"Error: Yandex API status {resp.status}")
-                        return None
-                    data = await resp.json()
-                    
-                    # Track info is in 'track' key
-                    track = data.get('track', {})
-                    if not track:
-                         # Sometimes it's in root if single track request?
-                         track = data
-                    
-                    title = track.get('title', 'Unknown Title')
-                    artists = [a.get('name') for a in track.get('artists', [])]
-                    artist_str = ", ".join(artists) if artists else "Unknown Artist"
-                    
-                    # Clean up title (remove ' (Remix)' etc if needed, but better keep it)
-                    
-            print(f"Extracted: {artist_str} - {title}")
-            
-            query = f"{artist_str} - {title}"
-            return {
-                'query': query,
-                'title': title,
-                'artist': artist_str,
-                'filename': f"{artist_str} - {title}.mp3".replace('/', '_').replace('\\', '_')
-            }
+            data = await self._get_json("/handlers/track.jsx", {'track': track_id})
+            if not data:
+                return None
+
+            # Track info is in 'track' key
+            track = data.get('track', {})
+            if not track:
+                 # Sometimes it's in root if single track request?
+                 track = data
+
+            info = self._parse_track(track, track_id)
+            print(f"Extracted: {info['query']}")
+            self.metadata_cache.set(track_id, info)
+            return info
         except Exception as e:
             print(f"Exception in get_track_info: {e}")
             return None
 
-    async def download_track(self, query: str, filename: str) -> str:
-        temp_path = os.path.join('/tmp' if os.name != 'nt' else '.', filename)
-        
+    async def _get_tracks_batch(self, track_ids: list) -> list:
+        """Fetches metadata for many tracks in a single request."""
+        if not track_ids:
+            return []
+        data = await self._get_json("/handlers/track-entries.jsx", {'entries': ",".join(track_ids)})
+        if isinstance(data, dict):
+            data = data.get('tracks', [])
+        return data or []
+
+    async def get_collection_info(self, url: str) -> Optional[dict]:
+        """Expands an album, playlist or artist link into its tracks (at most COLLECTION_MAX_TRACKS)."""
+        parsed = parse_collection_link(url)
+        if not parsed:
+            return None
+        kind, ids = parsed
+
+        try:
+            if kind == 'album':
+                data = await self._get_json("/handlers/album.jsx", {'album': ids[0]})
+                if not data:
+                    return None
+                title = data.get('title', 'Album')
+                # Album handler returns full track objects grouped by disc
+                tracks = [t for volume in data.get('volumes', []) for t in volume]
+            elif kind == 'playlist':
+                data = await self._get_json("/handlers/playlist.jsx", {'owner': ids[0], 'kinds': ids[1]})
+                playlist = (data or {}).get('playlist')
+                if not playlist:
+                    return None
+                title = playlist.get('title', 'Playlist')
+                tracks = playlist.get('tracks', [])
+                # Long playlists only embed the first tracks, the rest come as bare IDs
+                known = {str(t.get('id')) for t in tracks}
+                missing = [str(t).split(':')[0] for t in playlist.get('trackIds', []) if str(t).split(':')[0] not in known]
+                tracks += await self._get_tracks_batch(missing[:max(0, COLLECTION_MAX_TRACKS - len(tracks))])
+            else:
+                data = await self._get_json("/handlers/artist.jsx", {'artist': ids[0], 'what': 'tracks'})
+                if not data:
+                    return None
+                title = data.get('artist', {}).get('name', 'Artist')
+                tracks = data.get('tracks', [])
+
+            infos = []
+            for track in tracks[:COLLECTION_MAX_TRACKS]:
+                track_id = str(track.get('id', ''))
+                if not track_id or not track.get('title'):
+                    continue
+                info = self._parse_track(track, track_id)
+                self.metadata_cache.set(track_id, info)
+                infos.append(info)
+
+            print(f"Expanded {kind} '{title}': {len(infos)} tracks")
+            return {'kind': kind, 'title': title, 'tracks': infos} if infos else None
+        except Exception as e:
+            print(f"Exception in get_collection_info: {e}")
+            return None
+
+    async def search_tracks(self, text: str, limit: int = 10) -> list:
+        """Yandex Music track search, used for inline queries. Parsed tracks go to the metadata cache."""
+        data = await self._get_json("/handlers/music-search.jsx", {'text': text, 'type': 'tracks', 'page': 0})
+        items = ((data or {}).get('tracks') or {}).get('items') or []
+        infos = []
+        for track in items[:limit]:
+            track_id = str(track.get('id', ''))
+            if not track_id or not track.get('title'):
+                continue
+            info = self._parse_track(track, track_id)
+            self.metadata_cache.set(track_id, info)
+            infos.append(info)
+        return infos
+
+    def _ydl_opts(self, **overrides) -> dict:
         # Enhanced options to mitigate bot detection
         ydl_opts = {
             'format': 'bestaudio/best',
-            'outtmpl': temp_path.replace('.mp3', ''),
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
             'quiet': True,
             'no_warnings': True,
             'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -81,36 +372,257 @@ class YandexMusicHandler:
             'noprogress': True,
             'no_color': True,
         }
+        ydl_opts.update(overrides)
+        return ydl_opts
 
-        def run_ydl():
-            # Attempt 1: YouTube
-            try:
-                print(f"Searching YouTube for: {query}")
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([f"ytsearch1:{query} audio"])
-                return temp_path
-            except Exception as e:
-                print(f"YouTube download failed: {e}")
-            
-            # Attempt 2: SoundCloud
+    def _search_source(self, search: str) -> list:
+        """Metadata-only search on one source; returns the flat result entries."""
+        with self.ydl_pool.acquire('search') as ydl:
+            info = ydl.extract_info(search, download=False)
+        return [e for e in (info or {}).get('entries') or [] if e]
+
+    async def find_best_match(self, query: str, artist: str = None, title: str = None, duration: float = None) -> Optional[dict]:
+        """Searches all sources concurrently and returns the best scoring candidate.
+
+        As soon as one source yields a candidate scoring at least GOOD_MATCH_SCORE
+        the remaining searches are abandoned. yt-dlp can't be interrupted
+        mid-request, so an abandoned search finishes in its thread but its
+        result is dropped.
+        """
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        pending = {}
+        for source, template in SEARCH_SOURCES:
+            search = template.format(n=SEARCH_RESULTS, query=query)
+            pending[loop.run_in_executor(self._fetch_pool, self._search_source, search)] = source
+
+        best = None
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    source = pending.pop(future)
+                    try:
+                        candidates = future.result()
+                    except Exception as e:
+                        print(f"{source} search failed: {e}")
+                        continue
+                    picked = pick_best(candidates, query, artist, title, duration)
+                    if picked and (best is None or picked[0] > best[0]):
+                        best = picked
+                if best and best[0] >= GOOD_MATCH_SCORE:
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            record_stage('search', time.perf_counter() - started)
+
+        if not best or best[0] < MIN_MATCH_SCORE:
+            print(f"No acceptable match for: {query}")
+            return None
+        score, candidate = best
+        print(f"Best match for {query}: {candidate.get('title')} ({score:.2f})")
+        return candidate
+
+    @staticmethod
+    def _candidate_url(candidate: dict) -> str:
+        return candidate.get('webpage_url') or candidate.get('url')
+
+    def _fetch_audio(self, url: str, base_path: str, preferred_kbps: int) -> tuple:
+        """I/O stage: extracts the candidate, picks a format that will fit and downloads it as-is.
+
+        Returns (path, plan) where plan comes from audio_quality.plan_download,
+        or ("", None) on failure. Raises TrackTooLarge before downloading
+        anything if the track can't fit, JobCancelled when the job is
+        cancelled and DownloadInterrupted when the transfer breaks off. The
+        file is downloaded into the audio store's partial/ under a name a
+        retry of the same track reuses, so the retry resumes it: plain HTTP
+        formats with several ranged connections, others through yt-dlp,
+        which continues its own .part file. A finished file stays there for
+        a while, and a job that waited for the claim on it takes it instead
+        of fetching it again. The returned path is the job's own, next to
+        ``base_path``.
+        """
+        try:
+            with self.ydl_pool.acquire('fetch') as ydl:
+                info = ydl.extract_info(url, download=False)
+        except Exception as e:
+            print(f"Download failed for {url}: {e}")
+            return "", None
+        if not info:
+            return "", None
+        check_cancelled()
+
+        plan = plan_download(info, preferred_kbps, PASSTHROUGH_EXTS)
+        fmt = plan['format']
+        partial_name = f"{info.get('extractor_key')}-{info.get('id')}-{fmt.get('format_id')}"
+        self.audio_store.sweep_partials()
+        gave_up_waiting = time.monotonic() + PARTIAL_WAIT_SECONDS
+        while True:
+            with self.audio_store.claim_partial(partial_name) as partial_base:
+                if partial_base:
+                    path = self._fetch_format(url, info, fmt, partial_base)
+                    if not path:
+                        return "", None
+                    # Hand the job a copy of its own: once the claim is released another job may take the file
+                    own_path = f"{base_path}{os.path.splitext(path)[1]}"
+                    os.link(path, own_path)
+                    return own_path, plan
+                if time.monotonic() >= gave_up_waiting:
+                    # Another job has been fetching the same file for too long; get a copy of our own
+                    path = self._fetch_format(url, info, fmt, base_path)
+                    return (path, plan) if path else ("", None)
+            check_cancelled()
+            time.sleep(PARTIAL_WAIT_INTERVAL)
+
+    def _fetch_format(self, url: str, info: dict, fmt: dict, base: str) -> str:
+        """Downloads ``fmt`` of ``info`` to ``base`` plus its extension; returns the path or ""."""
+        if fmt.get('protocol') in ('http', 'https') and fmt.get('url'):
+            path = f"{base}.{fmt['ext']}"
+            if os.path.exists(path):
+                return path  # finished by an earlier job
             try:
-                print(f"Searching SoundCloud for: {query}")
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([f"scsearch1:{query}"])
-                return temp_path
-            except Exception as e:
-                print(f"SoundCloud download failed: {e}")
+                download_ranged(fmt['url'], path, fmt.get('http_headers'), fmt.get('filesize'))
+                return path
+            except RangeNotSupported as e:
+                print(f"{e}, downloading in one piece")
+            except OSError as e:
+                if is_transfer_interruption(e):
+                    raise DownloadInterrupted(f"{url}: {e}") from e
+                print(f"Download failed for {url}: {e}")
+                return ""
+
+        # What yt-dlp itself does for each selected format; it skips a file it finished before
+        chosen = {**info, **fmt}
+        chosen.pop('requested_formats', None)
+        chosen.pop('requested_downloads', None)
+        try:
+            with self.ydl_pool.acquire('fetch', outtmpl=f"{base}.%(ext)s") as ydl:
+                ydl.process_info(chosen)
+                path = chosen.get('filepath') or ydl.prepare_filename(chosen)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            if is_transfer_interruption(e):
+                raise DownloadInterrupted(f"{url}: {e}") from e
+            print(f"Download failed for {url}: {e}")
+            return ""
+        return path if path and os.path.exists(path) else ""
+
+    def _resolve_stream(self, url: str) -> Optional[dict]:
+        """Resolves the chosen candidate's direct audio stream without downloading it."""
+        try:
+            with self.ydl_pool.acquire('resolve') as ydl:
+                info = ydl.extract_info(url, download=False)
+            if info and info.get('url'):
+                return info
+        except Exception as e:
+            print(f"Stream lookup failed for {url}: {e}")
+        return None
+
+    async def open_stream(self, query: str, artist: str = None, title: str = None, duration: float = None,
+                          quality: str = DEFAULT_QUALITY) -> Optional[dict]:
+        """Returns an ffmpeg command that writes the track as mp3 to stdout.
+
+        Returns None when nothing was found or the estimated size is above
+        STREAM_MAX_BYTES, in which case the caller should spill to disk via
+        download_track.
+        """
+        candidate = await self.find_best_match(query, artist, title, duration)
+        if not candidate:
+            return None
+
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        entry = await loop.run_in_executor(self._fetch_pool, self._resolve_stream, self._candidate_url(candidate))
+        record_stage('resolve', time.perf_counter() - started)
+        if not entry:
+            return None
+
+        duration = entry.get('duration') or 0
+        if not duration:
+            return None
+        bitrate = pick_mp3_bitrate(duration, QUALITY_KBPS[quality])
+        estimated_bytes = int(duration * bitrate * 125)
+        if estimated_bytes > STREAM_MAX_BYTES:
+            print(f"Not streaming {query}: estimated {estimated_bytes} bytes")
+            return None
+
+        headers = "".join(f"{key}: {value}\r\n" for key, value in (entry.get('http_headers') or {}).items())
+        argv = ['ffmpeg', '-loglevel', 'error']
+        if headers:
+            argv += ['-headers', headers]
+        argv += ['-i', entry['url'], '-vn', '-codec:a', 'libmp3lame', '-b:a', f"{bitrate}k", '-f', 'mp3', 'pipe:1']
+        return {'argv': argv, 'duration': duration, 'estimated_bytes': estimated_bytes}
+
+    async def download_track(self, query: str, filename: str, artist: str = None, title: str = None,
+                             duration: float = None, cache_key: str = None, quality: str = DEFAULT_QUALITY) -> str:
+        """Returns the path of the track's audio file in the audio cache, or "".
+
+        The file belongs to the cache and must not be removed by the caller.
+        ``filename`` is only the display name; files on disk are named by content.
+        Raises TrackTooLarge when the track can't fit into a Telegram upload,
+        as early as its duration is known.
+        """
+        loop = asyncio.get_running_loop()
+        if cache_key:
+            cached_path = await loop.run_in_executor(None, self.audio_store.get, cache_key)
+            metrics.record_cache_lookup('audio_file', cached_path is not None)
+            if cached_path:
+                return cached_path
+
+        preferred_kbps = QUALITY_KBPS[quality]
+        try:
+            pick_mp3_bitrate(duration, preferred_kbps)
+            candidate = await self.find_best_match(query, artist, title, duration)
+            if not candidate:
                 return ""
+            # Flat search results usually carry the duration too
+            pick_mp3_bitrate(candidate.get('duration'), preferred_kbps)
+
+            base_path = self.audio_store.temp_path()
+            started = time.perf_counter()
+            source_path, plan = await run_in_executor(
+                self._fetch_pool, self._fetch_audio, self._candidate_url(candidate), base_path, preferred_kbps
+            )
+            record_stage('fetch', time.perf_counter() - started)
+        except TrackTooLarge as e:
+            metrics.record_transfer(encode_seconds_saved=estimate_transcode_seconds(e.duration))
+            raise
+        if not source_path:
+            return ""
+
+        audio_seconds = duration or candidate.get('duration')
+        source_bytes = os.path.getsize(source_path)
+        if not plan['transcode']:
+            metrics.record_transfer(source_bytes, estimate_transcode_seconds(audio_seconds))
+            record_stage('passthrough', 0.0)
+            if source_bytes > UPLOAD_MAX_BYTES:
+                os.remove(source_path)
+                raise TrackTooLarge(audio_seconds or 0)
+            return await loop.run_in_executor(None, self.audio_store.put, cache_key, source_path)
 
-        # Run in thread pool
-        path = await asyncio.to_thread(run_ydl)
-        # Verify file exists (yt-dlp might fail silently or produce file with different name)
-        # yt-dlp handling of outtmpl usually ensures correct name, but let's check
-        if os.path.exists(temp_path):
-             return temp_path
-             
-        # Check if file with .mp3 exists (in case conversion happened)
-        if os.path.exists(temp_path):
-            return temp_path
-            
-        return ""
+        metrics.record_transfer(source_bytes)
+        mp3_path = f"{base_path}.mp3"
+        started = time.perf_counter()
+        ok = False
+        try:
+            async with self._transcode_slots:
+                ok = await transcode_to_mp3(source_path, mp3_path, f"{plan['bitrate']}k")
+        except Exception as e:
+            print(f"Transcode failed: {e}")
+        finally:
+            elapsed = time.perf_counter() - started
+            record_stage('transcode', elapsed)
+            if ok and audio_seconds:
+                transcode_rate['audio_seconds'] += audio_seconds
+                transcode_rate['seconds'] += elapsed
+            os.remove(source_path)
+        if not ok:
+            if os.path.exists(mp3_path):
+                os.remove(mp3_path)
+            return ""
+        if os.path.getsize(mp3_path) > UPLOAD_MAX_BYTES:
+            os.remove(mp3_path)
+            raise TrackTooLarge(audio_seconds or 0)
+        return await loop.run_in_executor(None, self.audio_store.put, cache_key, mp3_path)
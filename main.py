@@ -1,112 +1,808 @@
 import os
+import hmac
+import time
+import uuid
+import socket
 import asyncio
 import logging
+import contextvars
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.types import FSInputFile, LabeledPrice, PreCheckoutQuery, Message
+from aiogram.types import (
+    CallbackQuery, FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle,
+    InlineQueryResultCachedAudio, InputMediaAudio, InputTextMessageContent, LabeledPrice, PreCheckoutQuery, Message,
+)
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest
 from dotenv import load_dotenv
 
-from logic import YandexMusicHandler
+from audio_quality import DEFAULT_QUALITY, QUALITY_KBPS, UPLOAD_MAX_BYTES, TrackTooLarge
+from logic import DownloadInterrupted, YandexMusicHandler, STREAM_UPLOADS, make_cache_key, parse_collection_link, stage_stats
+from job_store import JOB_LEASE_SECONDS, create_job_store
+from prefetch import PREFETCH_TOP_K, Prefetcher
+from inline_search import InlineSearch
+from job_control import JobCancelled, JobControl, current_job
+from rate_limit import RateLimitMiddleware, create_token_buckets
+from singleflight import SingleFlight
+from streaming import ProcessStreamInputFile
+from ttl_cache import TTLCache
 import database
+import metrics
 
 load_dotenv()
 
 API_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 WEBHOOK_PATH = f"/bot/{API_TOKEN}"
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token on every webhook call
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 BASE_URL = WEBHOOK_URL
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 
+# Worker pool configuration
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 3))
+QUEUE_MAXSIZE = int(os.getenv("QUEUE_MAXSIZE", 200))
+# Only the head of the queue gets live position updates (each one is an edit_message_text call)
+POSITION_UPDATE_LIMIT = int(os.getenv("POSITION_UPDATE_LIMIT", 20))
+POSITION_UPDATE_INTERVAL = 2.0
+# Albums/playlists are sent as media groups; Telegram allows at most 10 items per group
+MEDIA_GROUP_SIZE = 10
+BATCH_PROGRESS_INTERVAL = 2.0
+# A batch none of whose tracks finished for this long sends what it has and is dropped
+BATCH_STALL_SECONDS = float(os.getenv("BATCH_STALL_SECONDS", 1800))
+BATCH_CHECK_INTERVAL = 30.0
+QUEUE_FULL_TEXT = "🚦 Очередь переполнена, попробуйте чуть позже."
+TOO_LARGE_TEXT = f"❌ Трек слишком длинный: даже в низком качестве он больше {UPLOAD_MAX_BYTES // 2**20} МБ, а больше Telegram не принимает."
+QUALITY_NAMES = {'low': "низкое", 'standard': "обычное", 'high': "высокое"}
+CANCELLED_TEXT = "🚫 Отменено."
+FAILED_TEXT = "⚠️ Ошибка при обработке. Попробуйте еще раз."
+# Download progress is edited into the status message at most this often
+PROGRESS_EDIT_INTERVAL = 2.0
+DOWNLOAD_PRICE_STARS = 3
+ADMIN_USAGE_TEXT = (
+    "Использование:\n"
+    "`/admin <ID или @username> <количество>`\n"
+    "`/admin grant <количество> <ID или @username> ...`\n"
+    "`/admin revoke <количество> <ID или @username> ...`"
+)
+# Inline queries arrive on every keystroke; answers must be quick rather than complete
+INLINE_BUDGET = float(os.getenv("INLINE_BUDGET", 0.3))
+INLINE_RESULTS = 10
+INLINE_CACHE_TIME = 300
+# New download requests are turned away above this queue depth or expected wait (seconds)
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", 150))
+SHED_MAX_WAIT = float(os.getenv("SHED_MAX_WAIT", 900))
+JOB_SECONDS_SMOOTHING = 0.1
+# The webhook only buffers updates; dispatcher tasks run the handlers
+UPDATE_BUFFER_SIZE = int(os.getenv("UPDATE_BUFFER_SIZE", 1000))
+DISPATCHER_COUNT = int(os.getenv("DISPATCHER_COUNT", 32))
+UPDATE_DRAIN_TIMEOUT = 10.0
+# Build yt-dlp instances in the background right after startup instead of on the first download
+YDL_WARMUP = os.getenv("YDL_WARMUP", "1") == "1"
+
 # Initialize bot and dispatcher
 bot = Bot(token=API_TOKEN)
 dp = Dispatcher()
 ym_handler = YandexMusicHandler()
-download_queue = asyncio.Queue()
+# Durable, shared between processes (see job_store.py); the worker name identifies lease holders
+job_store = create_job_store(maxsize=QUEUE_MAXSIZE)
+WORKER_NAME = f"{socket.gethostname()}:{os.getpid()}"
+queue_changed = asyncio.Event()
+in_flight_downloads = SingleFlight()
+worker_tasks = []
+# Album/playlist batches being assembled by this process, by batch_id
+active_batches = {}
+# job id -> JobControl of the jobs this process is working on, for the cancel button
+running_jobs = {}
+# (received_at, raw update) waiting for a dispatcher
+update_buffer = asyncio.Queue(maxsize=UPDATE_BUFFER_SIZE)
+# Telegram redelivers an update until it gets a 200 for it
+recent_update_ids = TTLCache(maxsize=10_000, ttl=3600)
+token_buckets = create_token_buckets()
+# Moving average of how long a job takes, for the expected wait
+avg_job_seconds = 30.0
+busy_workers = 0
+inline_search = InlineSearch(lambda text: ym_handler.search_tracks(text, INLINE_RESULTS), budget=INLINE_BUDGET)
+
+async def has_user_work() -> bool:
+    return busy_workers > 0 or await job_store.pending_count() > 0
+
+# Fills the audio cache with popular tracks while the workers are idle (see prefetch.py)
+prefetcher = Prefetcher(ym_handler, has_user_work)
+
+def make_job(chat_id: int, query_or_url: str, status_msg_id: int, user_id: int,
+             charge: str = None, payment_charge_id: str = None, quality: str = DEFAULT_QUALITY) -> dict:
+    """``charge`` is what the user spent on the job ("free" or "stars"), refunded if it delivers nothing."""
+    return {
+        'chat_id': chat_id,
+        'query': query_or_url,
+        'status_msg_id': status_msg_id,
+        'user_id': user_id,
+        'is_link': "music.yandex.ru/" in query_or_url,
+        'charge': charge,
+        'payment_charge_id': payment_charge_id,
+        'quality': quality,
+    }
+
+def cancel_keyboard(job_id: int, batch_id: str = None) -> InlineKeyboardMarkup:
+    """Cancel button of a job; for an expanded album also of its track jobs."""
+    data = f"cancel:{job_id}:{batch_id}" if batch_id else f"cancel:{job_id}"
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✖️ Отменить", callback_data=data)]])
+
+def status_keyboard():
+    """Cancel button of the job being worked on; every status edit must repeat it or Telegram drops it."""
+    control = current_job.get()
+    return cancel_keyboard(control.job_id) if control else None
+
+async def refund_job(job: dict):
+    charge = job.get('charge')
+    if not charge:
+        return
+    try:
+        if charge == "free":
+            await database.add_free_downloads(job['user_id'], 1)
+            text = "↩️ Скачивание не засчитано."
+        else:
+            await bot.refund_star_payment(job['user_id'], job['payment_charge_id'])
+            database.record_stat("stars_refunded", DOWNLOAD_PRICE_STARS)
+            text = "↩️ Звёзды возвращены."
+        await bot.send_message(job['chat_id'], text)
+    except Exception as e:
+        logging.error(f"Refund failed for job {job.get('_id')}: {e}")
+        return
+    metrics.REFUNDS.labels(kind=charge).inc()
+    logging.info(f"Refunded {charge} download to user {job['user_id']}")
+
+async def is_overloaded() -> bool:
+    """Load shedding: too many queued jobs, or too long an expected wait for a new one."""
+    pending = await job_store.pending_count()
+    estimated_wait = pending * avg_job_seconds / WORKER_COUNT
+    metrics.ESTIMATED_WAIT.set(estimated_wait)
+    return pending >= SHED_QUEUE_DEPTH or estimated_wait >= SHED_MAX_WAIT
+
+dp.message.middleware(RateLimitMiddleware(token_buckets, is_overloaded))
 
-# Queue Worker
-async def download_worker():
-    logging.info("👷 Queue worker started")
+# Update Dispatchers
+async def update_dispatcher(dispatcher_id: int):
     while True:
-        chat_id, query_or_url, status_msg_id, user_id, is_link = await download_queue.get()
+        received_at, data = await update_buffer.get()
+        metrics.UPDATE_WAIT.observe(time.monotonic() - received_at)
         try:
-            await process_track_download(chat_id, query_or_url, status_msg_id, is_link)
+            update = types.Update.model_validate(data, context={"bot": bot})
+            await dp.feed_update(bot, update)
         except Exception as e:
-            logging.error(f"Error in worker: {e}")
+            metrics.UPDATES.labels(result="failed").inc()
+            logging.error(f"Error in dispatcher {dispatcher_id} handling update {data.get('update_id')}: {e}")
         finally:
-            download_queue.task_done()
+            update_buffer.task_done()
+
+# Queue Workers
+async def keep_leased(job_id: int, control: JobControl):
+    """Extends the job lease while a long download is running.
+
+    Also notices jobs cancelled through another process.
+    """
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        if not await job_store.extend(job_id, WORKER_NAME):
+            if await job_store.is_cancelled(job_id):
+                control.cancel()
+            else:
+                logging.warning(f"Lost lease on job {job_id}")
+            return
+
+async def process_job(job: dict) -> bool:
+    if 'batch_id' in job:
+        return await process_batch_track(job)
+    if job['is_link'] and parse_collection_link(job['query']):
+        return await process_collection(job)
+    return await process_track_download(
+        job['chat_id'], job['query'], job['status_msg_id'], job['is_link'], job.get('quality', DEFAULT_QUALITY)
+    )
+
+async def run_job(job: dict, control: JobControl) -> bool:
+    """Runs the job in a task of its own that the cancel button can stop; raises JobCancelled then."""
+    context = contextvars.copy_context()
+    context.run(current_job.set, control)
+    control.task = asyncio.create_task(process_job(job), context=context)
+    try:
+        return await control.task
+    except asyncio.CancelledError:
+        # Only the job's task was cancelled, not the worker (as on shutdown)
+        if control.cancelled.is_set() and not asyncio.current_task().cancelling():
+            raise JobCancelled(f"job {job['_id']} cancelled") from None
+        raise
+
+async def download_worker(worker_id: int):
+    global avg_job_seconds, busy_workers
+    logging.info(f"👷 Queue worker {worker_id} started")
+    while True:
+        job = await job_store.lease(WORKER_NAME)
+        if job is None:
+            await job_store.wait_for_jobs()
+            continue
+        queue_changed.set()
+        if job.get('_dead'):
+            # The workers that held it before all died on it; don't try again
+            logging.error(f"Job {job['_id']} given up after {job['_attempts'] - 1} lost leases")
+            trace = metrics.start_trace(user_id=job['user_id'], query=job['query'], job_id=job['_id'], attempt=job['_attempts'])
+            metrics.record_error("lease_expired")
+            metrics.finish_trace(trace, False)
+            database.record_job(job['user_id'], job['query'], trace.outcome, trace.duration)
+            await refund_job(job)
+            batch = active_batches.get(job.get('batch_id'))
+            if batch is not None:
+                await batch.track_finished(job['index'], {})
+                if batch.finished == len(batch.tracks):
+                    active_batches.pop(job['batch_id'], None)
+            if 'status_msg_id' in job:
+                try:
+                    await bot.edit_message_text(chat_id=job['chat_id'], message_id=job['status_msg_id'], text=FAILED_TEXT)
+                except Exception:
+                    pass
+            continue
+        trace = metrics.start_trace(user_id=job['user_id'], query=job['query'], job_id=job['_id'], attempt=job['_attempts'])
+        logging.info(f"[{trace.trace_id}] Worker {worker_id} picked up job {job['_id']} (attempt {job['_attempts']})")
+        metrics.WORKERS_BUSY.inc()
+        busy_workers += 1
+        control = running_jobs[job['_id']] = JobControl(job['_id'])
+        heartbeat = asyncio.create_task(keep_leased(job['_id'], control))
+        delivered = False
+        # Only a job's last attempt goes into the history: not one that is retried or that another worker took over
+        ended = False
+        try:
+            delivered = await run_job(job, control)
+            ended = await job_store.complete(job['_id'], WORKER_NAME)
+            if ended and not delivered:
+                await refund_job(job)
+        except JobCancelled:
+            ended = True
+            metrics.record_error("cancelled")
+            logging.info(f"[{trace.trace_id}] Job {job['_id']} cancelled by the user")
+            await refund_job(job)
+            if 'status_msg_id' in job:
+                try:
+                    await bot.edit_message_text(chat_id=job['chat_id'], message_id=job['status_msg_id'], text=CANCELLED_TEXT)
+                except Exception:
+                    pass
+        except Exception as e:
+            metrics.record_error(type(e).__name__)
+            logging.error(f"Error in worker {worker_id}: {e}")
+            retried = await job_store.fail(job['_id'], WORKER_NAME, repr(e))
+            ended = retried is False
+            if ended:
+                await refund_job(job)
+            if 'status_msg_id' in job and retried is not None:
+                text = "⚠️ Ошибка при обработке, попробую ещё раз..." if retried else FAILED_TEXT
+                try:
+                    await bot.edit_message_text(chat_id=job['chat_id'], message_id=job['status_msg_id'], text=text)
+                except Exception:
+                    pass
+        finally:
+            heartbeat.cancel()
+            running_jobs.pop(job['_id'], None)
+            metrics.WORKERS_BUSY.dec()
+            busy_workers -= 1
+            metrics.finish_trace(trace, delivered)
+            if ended:
+                database.record_job(job['user_id'], job['query'], trace.outcome, trace.duration)
+            logging.info(trace.summary())
+            avg_job_seconds += JOB_SECONDS_SMOOTHING * (trace.duration - avg_job_seconds)
+
+async def queue_position_notifier():
+    """Keeps the "in queue" status messages up to date as jobs move forward."""
+    shown = {}  # job id -> last position shown
+    while True:
+        try:
+            await asyncio.wait_for(queue_changed.wait(), POSITION_UPDATE_INTERVAL * 5)
+        except asyncio.TimeoutError:
+            pass  # also pick up jobs moved by other processes
+        queue_changed.clear()
+        metrics.QUEUE_DEPTH.set(await job_store.pending_count())
+        await is_overloaded()  # keeps the estimated wait gauge current
+        pending = await job_store.pending_jobs(POSITION_UPDATE_LIMIT)
+        current = {}
+        for position, job in enumerate(pending, start=1):
+            current[job['_id']] = position
+            # Album tracks report progress on the album's message instead
+            if 'status_msg_id' not in job or shown.get(job['_id']) == position:
+                continue
+            try:
+                await bot.edit_message_text(
+                    chat_id=job['chat_id'], message_id=job['status_msg_id'], text=f"⏳ В очереди, позиция: {position}",
+                    reply_markup=cancel_keyboard(job['_id']),
+                )
+            except Exception as e:
+                logging.warning(f"Failed to update queue position: {e}")
+        shown = current
+        await asyncio.sleep(POSITION_UPDATE_INTERVAL)
+
+async def enqueue_download(message: Message, query_or_url: str, status_text: str, idempotency_key: str,
+                           force: bool = False, charge: str = None, payment_charge_id: str = None) -> bool:
+    status_msg = await message.answer(status_text)
+    user = await database.get_user(message.from_user.id)
+    job = make_job(
+        message.chat.id, query_or_url, status_msg.message_id, message.from_user.id, charge, payment_charge_id,
+        user.get('quality') or DEFAULT_QUALITY,
+    )
+    try:
+        job_id = await job_store.enqueue(job, idempotency_key=idempotency_key, force=force)
+    except asyncio.QueueFull:
+        await bot.edit_message_text(chat_id=message.chat.id, message_id=status_msg.message_id, text=QUEUE_FULL_TEXT)
+        return False
+    queue_changed.set()
+    if job_id is not None:
+        try:
+            await bot.edit_message_reply_markup(
+                chat_id=message.chat.id, message_id=status_msg.message_id, reply_markup=cancel_keyboard(job_id)
+            )
+        except TelegramBadRequest:
+            pass  # a worker already finished the job
+    return True
+
+async def send_cached_audio(chat_id: int, cache_key: str, status_msg_id: int) -> bool:
+    """Re-sends an already uploaded track by its Telegram file_id. Returns False on a cache miss."""
+    cached = await database.get_cached_audio(cache_key)
+    if not cached:
+        return False
+    try:
+        await bot.send_audio(chat_id=chat_id, audio=cached['file_id'], title=cached['title'], performer=cached['performer'])
+    except TelegramBadRequest as e:
+        # file_id is no longer valid for this bot, fall back to a fresh download
+        metrics.record_recovered("stale_file_id")
+        logging.warning(f"Cached file_id rejected for {cache_key}: {e}")
+        await database.invalidate_cached_audio(cache_key)
+        return False
+    await bot.delete_message(chat_id=chat_id, message_id=status_msg_id)
+    logging.info(f"Track sent from cache: {cache_key}")
+    return True
+
+async def report_download_progress(chat_id: int, status_msg_id: int, display_name: str, control: JobControl):
+    """Edits the progress the fetch threads report into the status message, at most every PROGRESS_EDIT_INTERVAL."""
+    shown = None
+    while True:
+        await asyncio.sleep(PROGRESS_EDIT_INTERVAL)
+        if not control.total or control.downloaded == shown:
+            continue
+        shown = control.downloaded
+        percent = min(100, shown * 100 // control.total)
+        try:
+            await bot.edit_message_text(
+                chat_id=chat_id, message_id=status_msg_id, reply_markup=cancel_keyboard(control.job_id),
+                text=f"📥 Скачиваю: {display_name}... {percent}% ({shown / 2**20:.1f} из {control.total / 2**20:.1f} МБ)",
+            )
+        except Exception as e:
+            logging.warning(f"Failed to update download progress: {e}")
+
+@asynccontextmanager
+async def progress_edits(chat_id: int, status_msg_id: int, display_name: str):
+    control = current_job.get()
+    reporter = control and asyncio.create_task(report_download_progress(chat_id, status_msg_id, display_name, control))
+    try:
+        yield
+    finally:
+        if reporter:
+            reporter.cancel()
 
-async def process_track_download(chat_id: int, query_or_url: str, status_msg_id: int, is_link: bool):
+def upload_filename(filename: str, file_path: str) -> str:
+    """Display filename with the extension of the file actually produced (mp3 or passthrough m4a)."""
+    return os.path.splitext(filename)[0] + os.path.splitext(file_path)[1]
+
+async def download_and_send(chat_id: int, status_msg_id: int, track: dict, cache_key: str = None,
+                            quality: str = DEFAULT_QUALITY) -> str:
+    """Downloads a track, uploads it to the chat and returns its Telegram file_id ("" on failure)."""
+    audio = None
+    file_path = ""
+    on_disk = bool(cache_key) and ym_handler.audio_store.contains(cache_key)
     try:
-        if is_link:
-            logging.info(f"Processing Yandex link: {query_or_url}")
+        # A copy left in the disk cache is cheaper than streaming it again
+        if STREAM_UPLOADS and not (cache_key and ym_handler.audio_store.get(cache_key)):
+            stream = await ym_handler.open_stream(track['query'], track['performer'], track['title'], track['duration'], quality)
+            if stream:
+                audio = ProcessStreamInputFile(stream['argv'], filename=os.path.splitext(track['filename'])[0] + ".mp3")
+        if audio is None:
+            async with progress_edits(chat_id, status_msg_id, track['display_name']):
+                file_path = await ym_handler.download_track(
+                    track['query'], track['filename'], track['performer'], track['title'], track['duration'], cache_key, quality
+                )
+            if file_path and os.path.exists(file_path):
+                audio = FSInputFile(file_path, filename=upload_filename(track['filename'], file_path))
+    except TrackTooLarge as e:
+        metrics.record_error("too_large")
+        logging.info(f"Rejected {track['query']}: {e}")
+        await bot.edit_message_text(chat_id=chat_id, message_id=status_msg_id, text=TOO_LARGE_TEXT)
+        return ""
+
+    if audio is None:
+        metrics.record_error("download_failed")
+        await bot.edit_message_text(chat_id=chat_id, message_id=status_msg_id, text="❌ Ошибка при скачивании (не найдено на YouTube/SoundCloud).")
+        logging.error(f"Download failed for query: {track['query']}")
+        return ""
+
+    try:
+        with metrics.timed_stage("upload"):
+            sent = await bot.send_audio(
+                chat_id=chat_id,
+                audio=audio,
+                title=track['title'],
+                performer=track['performer']
+            )
+    except Exception:
+        metrics.record_error("upload_failed")
+        raise
+    await bot.delete_message(chat_id=chat_id, message_id=status_msg_id)
+    metrics.record_served("disk" if on_disk else "download")
+    logging.info(f"Track sent successfully: {track['display_name']}")
+    if not sent.audio:
+        return ""
+    if cache_key:
+        await database.save_cached_audio(cache_key, sent.audio.file_id, track['title'], track['performer'])
+    return sent.audio.file_id
+
+async def process_track_download(chat_id: int, query_or_url: str, status_msg_id: int, is_link: bool,
+                                 quality: str = DEFAULT_QUALITY) -> bool:
+    """Returns whether the track was delivered.
+
+    Failures propagate to the worker, which decides whether the job is retried.
+    """
+    cache_key = make_cache_key(query_or_url, is_link, quality)
+    if cache_key:
+        database.record_track_request(cache_key)
+    if cache_key and await send_cached_audio(chat_id, cache_key, status_msg_id):
+        metrics.record_served("file_id")
+        return True
+
+    if is_link:
+        logging.info(f"Processing Yandex link: {query_or_url}")
+        with metrics.timed_stage("metadata"):
             track_info = await ym_handler.get_track_info(query_or_url)
-            if not track_info:
-                await bot.edit_message_text(chat_id=chat_id, message_id=status_msg_id, text="❌ Не удалось найти информацию о треке по ссылке.")
+        if not track_info:
+            metrics.record_error("metadata_not_found")
+            await bot.edit_message_text(chat_id=chat_id, message_id=status_msg_id, text="❌ Не удалось найти информацию о треке по ссылке.")
+            return False
+        track = {
+            'query': track_info['query'],
+            'filename': track_info['filename'],
+            'display_name': f"{track_info['artist']} - {track_info['title']}",
+            'title': track_info['title'],
+            'performer': track_info['artist'],
+            'duration': track_info.get('duration'),
+        }
+    else:
+        logging.info(f"Processing search query: {query_or_url}")
+        # Clean filename
+        safe_name = "".join([c for c in query_or_url if c.isalnum() or c in (' ', '-', '_')]).strip()
+        track = {
+            'query': query_or_url,
+            'filename': f"{safe_name}.mp3",
+            'display_name': query_or_url,
+            'title': query_or_url,
+            'performer': None,
+            'duration': None,
+        }
+
+    await bot.edit_message_text(
+        chat_id=chat_id, message_id=status_msg_id, text=f"📥 Скачиваю: {track['display_name']}...", reply_markup=status_keyboard()
+    )
+
+    if not cache_key:
+        return bool(await download_and_send(chat_id, status_msg_id, track, quality=quality))
+
+    # Identical tracks requested at the same time are downloaded once and fanned out by file_id
+    file_id, shared = await in_flight_downloads.do(
+        cache_key, lambda: download_and_send(chat_id, status_msg_id, track, cache_key, quality)
+    )
+    if not shared:
+        return bool(file_id)
+    if not file_id:
+        await bot.edit_message_text(chat_id=chat_id, message_id=status_msg_id, text="❌ Ошибка при скачивании (не найдено на YouTube/SoundCloud).")
+        return False
+    await bot.send_audio(chat_id=chat_id, audio=file_id, title=track['title'], performer=track['performer'])
+    await bot.delete_message(chat_id=chat_id, message_id=status_msg_id)
+    metrics.record_served("shared")
+    logging.info(f"Track sent from shared download: {track['display_name']}")
+    return True
+
+class CollectionBatch:
+    """Tracks of one album/playlist/artist link being downloaded by several workers.
+
+    Finished tracks are collected in order and flushed as media groups of
+    MEDIA_GROUP_SIZE as soon as a whole group is ready, while a single status
+    message shows aggregated progress.
+
+    The track jobs are enqueued with this process as their owner, but another
+    process may still take one that waited too long and send it on its own.
+    ``watch`` therefore gives up on tracks that never come: after
+    BATCH_STALL_SECONDS without progress the batch is closed, the groups are
+    sent without the missing tracks, and tracks finishing later are sent
+    one by one.
+
+    The link's ``job`` is refunded if the batch ends (or gives up on the
+    missing tracks) without having sent a single track.
+    """
+
+    def __init__(self, job: dict, chat_id: int, status_msg_id: int, title: str, tracks: list,
+                 keyboard: InlineKeyboardMarkup = None):
+        self.job = job
+        self.chat_id = chat_id
+        self.status_msg_id = status_msg_id
+        self.title = title
+        self.tracks = tracks
+        self.keyboard = keyboard
+        self.job_ids = []  # of the track jobs, by index
+        self.results = [None] * len(tracks)  # {'file_id': ...} | {'path': ..., 'cache_key': ...} | {} for failures
+        self.finished = 0
+        self.sent = 0
+        self.next_group = 0
+        self.last_progress = 0.0
+        self.last_finished = time.monotonic()
+        self.closed = False
+        self.cancelled = False
+        self.settled = False
+        self.watcher: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+
+    async def track_finished(self, index: int, result: dict):
+        async with self.lock:
+            self.results[index] = result
+            self.finished += 1
+            self.last_finished = time.monotonic()
+            if self.cancelled:
+                return
+            if self.closed:
+                await self._send_group([index])
+                return
+            await self._flush_ready_groups()
+            await self._report_progress()
+            if self.finished == len(self.tracks):
+                await self._settle()
+
+    async def watch(self, batch_id: str):
+        while self.finished < len(self.tracks) and not self.closed:
+            await asyncio.sleep(BATCH_CHECK_INTERVAL)
+            pending = [job_id for job_id, result in zip(self.job_ids, self.results) if result is None]
+            if pending and await job_store.is_cancelled(pending[0]):
+                # Cancelled through another process
+                await self.cancel()
+            elif time.monotonic() - self.last_finished >= BATCH_STALL_SECONDS:
+                logging.warning(f"Batch {self.title} stalled at {self.finished}/{len(self.tracks)}, sending what is ready")
+                await self.close()
+        active_batches.pop(batch_id, None)
+
+    async def close(self):
+        async with self.lock:
+            self.closed = True
+            await self._flush_ready_groups()
+            await self._report_progress()
+            await self._settle()
+
+    async def cancel(self):
+        """Stops sending: tracks finishing from now on are dropped."""
+        async with self.lock:
+            self.closed = self.cancelled = True
+            await self._report_progress()
+            await self._settle()
+
+    async def _settle(self):
+        """Refunds the link once if nothing was sent."""
+        if self.settled:
+            return
+        self.settled = True
+        # A cancelled link job is refunded by whoever cancelled it
+        if self.sent == 0 and not await job_store.is_cancelled(self.job['_id']):
+            await refund_job(self.job)
+
+    async def _flush_ready_groups(self):
+        while self.next_group * MEDIA_GROUP_SIZE < len(self.tracks):
+            start = self.next_group * MEDIA_GROUP_SIZE
+            group = range(start, min(start + MEDIA_GROUP_SIZE, len(self.tracks)))
+            if not self.closed and any(self.results[i] is None for i in group):
                 return
-            search_query = track_info['query']
-            filename = track_info['filename']
-            display_name = f"{track_info['artist']} - {track_info['title']}"
-            title = track_info['title']
-            performer = track_info['artist']
+            self.next_group += 1
+            await self._send_group([i for i in group if self.results[i]])
+
+    async def _send_group(self, indexes: list):
+        if not indexes:
+            return
+        media = []
+        for i in indexes:
+            track, result = self.tracks[i], self.results[i]
+            audio = result.get('file_id') or FSInputFile(result['path'], filename=upload_filename(track['filename'], result['path']))
+            media.append(InputMediaAudio(media=audio, title=track['title'], performer=track['artist']))
+        try:
+            with metrics.timed_stage("upload"):
+                if len(media) == 1:
+                    messages = [await bot.send_audio(chat_id=self.chat_id, audio=media[0].media, title=media[0].title, performer=media[0].performer)]
+                else:
+                    messages = await bot.send_media_group(chat_id=self.chat_id, media=media)
+            self.sent += len(indexes)
+            for i, sent in zip(indexes, messages):
+                if 'path' in self.results[i] and sent.audio:
+                    track = self.tracks[i]
+                    await database.save_cached_audio(self.results[i]['cache_key'], sent.audio.file_id, track['title'], track['artist'])
+        except Exception as e:
+            metrics.record_error("upload_failed")
+            logging.error(f"Failed to send media group for {self.title}: {e}")
+
+    async def _report_progress(self):
+        total = len(self.tracks)
+        keyboard = None
+        if self.cancelled:
+            text = f"🚫 {self.title}: отменено, отправлено {self.sent} из {total}."
+        elif self.finished == total or self.closed:
+            text = f"✅ {self.title}: отправлено {self.sent} из {total}."
+        elif time.monotonic() - self.last_progress >= BATCH_PROGRESS_INTERVAL:
+            text = f"📥 {self.title}: {self.finished}/{total}..."
+            keyboard = self.keyboard
         else:
-            logging.info(f"Processing search query: {query_or_url}")
-            search_query = query_or_url
-            # Clean filename
-            safe_name = "".join([c for c in query_or_url if c.isalnum() or c in (' ', '-', '_')]).strip()
-            filename = f"{safe_name}.mp3"
-            display_name = query_or_url
-            title = query_or_url
-            performer = None
-
-        await bot.edit_message_text(chat_id=chat_id, message_id=status_msg_id, text=f"📥 Скачиваю: {display_name}...")
-        
-        file_path = await ym_handler.download_track(search_query, filename)
-        
-        if file_path and os.path.exists(file_path):
-            audio = FSInputFile(file_path, filename=filename)
-            await bot.send_audio(
-                chat_id=chat_id,
-                audio=audio,
-                title=title,
-                performer=performer
+            return
+        self.last_progress = time.monotonic()
+        try:
+            await bot.edit_message_text(chat_id=self.chat_id, message_id=self.status_msg_id, text=text, reply_markup=keyboard)
+        except Exception as e:
+            logging.warning(f"Failed to update batch progress: {e}")
+
+async def process_collection(job: dict) -> bool:
+    """Expands an album/playlist/artist link and queues its tracks as individual jobs.
+
+    Returns True once they are queued; the batch settles the charge when its tracks are done.
+    """
+    chat_id, status_msg_id = job['chat_id'], job['status_msg_id']
+    logging.info(f"Processing Yandex collection: {job['query']}")
+    with metrics.timed_stage("metadata"):
+        collection = await ym_handler.get_collection_info(job['query'])
+    if not collection:
+        metrics.record_error("metadata_not_found")
+        await bot.edit_message_text(chat_id=chat_id, message_id=status_msg_id, text="❌ Не удалось получить список треков по ссылке.")
+        return False
+
+    batch_id = uuid.uuid4().hex
+    batch = CollectionBatch(
+        job, chat_id, status_msg_id, collection['title'], collection['tracks'], cancel_keyboard(job['_id'], batch_id)
+    )
+    active_batches[batch_id] = batch
+    batch.watcher = asyncio.create_task(batch.watch(batch_id))
+    await bot.edit_message_text(
+        chat_id=chat_id, message_id=status_msg_id, text=f"📥 {batch.title}: 0/{len(batch.tracks)}...", reply_markup=batch.keyboard
+    )
+    try:
+        for index, track in enumerate(batch.tracks):
+            child = {
+                'chat_id': chat_id,
+                'user_id': job['user_id'],
+                'query': track['query'],
+                'batch_id': batch_id,
+                'index': index,
+                'track': track,
+                'quality': job.get('quality', DEFAULT_QUALITY),
+            }
+            # The link was already admitted, so its tracks may exceed the queue bound
+            batch.job_ids.append(await job_store.enqueue(
+                child, idempotency_key=f"batch:{batch_id}:{index}", force=True, owner=WORKER_NAME
+            ))
+    except asyncio.CancelledError:
+        # Cancelled while queueing the tracks: take back the ones already queued
+        await cancel_batch_jobs(batch_id, job['user_id'])
+        await batch.cancel()
+        raise
+    return True
+
+async def cancel_batch_jobs(batch_id: str, user_id: int) -> list:
+    """Cancels the track jobs of an expanded album; returns the cancelled jobs."""
+    cancelled = []
+    index = 0
+    while (job_id := await job_store.find(f"batch:{batch_id}:{index}")) is not None:
+        job = await job_store.cancel(job_id, user_id)
+        if job is not None:
+            cancelled.append(job)
+        index += 1
+    return cancelled
+
+async def process_batch_track(job: dict) -> bool:
+    """Returns whether the track was downloaded; the batch sends it with the others."""
+    batch, index, track = active_batches.get(job['batch_id']), job['index'], job['track']
+    quality = job.get('quality', DEFAULT_QUALITY)
+    track_url = f"https://music.yandex.ru/track/{track['track_id']}"
+    if batch is None:
+        # The batch lived in a process that restarted, or in another replica: send this track on its own
+        status_msg = await bot.send_message(job['chat_id'], f"📥 Скачиваю: {track['artist']} - {track['title']}...")
+        return await process_track_download(job['chat_id'], track_url, status_msg.message_id, True, quality)
+
+    result = {}
+    retrying = False
+    cache_key = make_cache_key(track_url, True, quality)
+    database.record_track_request(cache_key)
+    try:
+        cached = await database.get_cached_audio(cache_key)
+        if cached:
+            result = {'file_id': cached['file_id']}
+            metrics.record_served("file_id")
+        else:
+            on_disk = ym_handler.audio_store.contains(cache_key)
+            file_path = await ym_handler.download_track(
+                track['query'], track['filename'], track['artist'], track['title'], track.get('duration'), cache_key, quality
             )
-            await bot.delete_message(chat_id=chat_id, message_id=status_msg_id)
-            os.remove(file_path)
-            logging.info(f"Track sent successfully: {display_name}")
+            if file_path and os.path.exists(file_path):
+                result = {'path': file_path, 'cache_key': cache_key}
+                metrics.record_served("disk" if on_disk else "download")
+            else:
+                metrics.record_error("download_failed")
+                logging.error(f"Download failed for query: {track['query']}")
+    except DownloadInterrupted:
+        if job['_attempts'] >= job_store.max_attempts:
+            metrics.record_error("DownloadInterrupted")
+            logging.error(f"Gave up resuming batch track {track['query']}")
         else:
-            await bot.edit_message_text(chat_id=chat_id, message_id=status_msg_id, text="❌ Ошибка при скачивании (не найдено на YouTube/SoundCloud).")
-            logging.error(f"Download failed for query: {search_query}")
+            # The job store retries the job, which resumes the partial file; the batch waits for it
+            retrying = True
+            raise
     except Exception as e:
-        logging.error(f"Error in background task: {e}")
-        try:
-            await bot.edit_message_text(chat_id=chat_id, message_id=status_msg_id, text="⚠️ Ошибка при обработке. Попробуйте еще раз.")
-        except:
-            pass
+        # Not retried: the batch already moved on without this track
+        metrics.record_error(type(e).__name__)
+        logging.error(f"Error downloading batch track {track['query']}: {e}")
+    finally:
+        if not retrying:
+            await batch.track_finished(index, result)
+            if batch.finished == len(batch.tracks):
+                active_batches.pop(job['batch_id'], None)
+    return bool(result)
 
 @dp.message(Command("start"))
 async def send_welcome(message: types.Message):
     await database.get_user(message.from_user.id, message.from_user.username)
     await message.reply(
-        "Привет! Пришли мне ссылку на Яндекс Музыку или просто название песни/текст.\n\n"
+        "Привет! Пришли мне ссылку на Яндекс Музыку (трек, альбом, плейлист или исполнителя) или просто название песни/текст.\n\n"
         "💎 Условия:\n"
         "- Первое скачивание бесплатно!\n"
-        "- Далее — 3 звезды за трек."
+        "- Далее — 3 звезды за трек.\n\n"
+        "🎚 /quality — качество звука."
     )
 
+@dp.message(Command("quality"))
+async def quality_command(message: types.Message):
+    user = await database.get_user(message.from_user.id, message.from_user.username)
+    args = message.text.split()
+    if len(args) < 2 or args[1] not in QUALITY_KBPS:
+        current = user.get('quality') or DEFAULT_QUALITY
+        options = "\n".join(f"`/quality {name}` — {QUALITY_NAMES[name]}, до {kbps} кбит/с" for name, kbps in QUALITY_KBPS.items())
+        await message.reply(
+            f"🎚 Сейчас качество: {QUALITY_NAMES[current]}.\n{options}\n\n"
+            "Длинные треки всё равно сжимаются сильнее, чтобы уложиться в лимит Telegram."
+        )
+        return
+    await database.set_user_quality(message.from_user.id, args[1])
+    await message.reply(f"✅ Качество: {QUALITY_NAMES[args[1]]}.")
+
+def parse_targets(args: list) -> list:
+    """User IDs and @usernames from command arguments."""
+    return [int(arg) if arg.isdigit() else arg for arg in args]
+
 @dp.message(Command("admin"))
 async def admin_command(message: types.Message):
     user = await database.get_user(message.from_user.id, message.from_user.username)
     if not user['is_whitelisted']:
         return
 
-    # Expecting /admin <user_id_or_username> <count>
+    # /admin <user_id_or_username> <count>, or /admin grant|revoke <count> <targets...>
     args = message.text.split()
+    if len(args) >= 4 and args[1] in ("grant", "revoke"):
+        try:
+            count = int(args[2])
+        except ValueError:
+            await message.reply("❌ Количество должно быть числом.")
+            return
+        changed = await database.adjust_free_downloads(parse_targets(args[3:]), count if args[1] == "grant" else -count)
+        action = "добавлено" if args[1] == "grant" else "снято"
+        await message.reply(f"✅ {changed} из {len(args) - 3} пользователей: {action} по {count} скачиваний.")
+        return
     if len(args) < 3:
-        await message.reply("Использование: `/admin <ID или @username> <количество>`")
+        await message.reply(ADMIN_USAGE_TEXT)
         return
 
     target = args[1]
@@ -127,15 +823,108 @@ async def admin_command(message: types.Message):
     except Exception as e:
         await message.reply(f"❌ Ошибка: {e}")
 
-@dp.message(F.text)
-async def handle_text_request(message: types.Message):
-    if message.text.startswith('/'):
+@dp.message(Command("stats"))
+async def stats_command(message: types.Message):
+    user = await database.get_user(message.from_user.id, message.from_user.username)
+    if not user['is_whitelisted']:
+        return
+
+    # /stats [hours] — totals from the hourly aggregates, /stats user <ID or @username> — one user's jobs
+    args = message.text.split()
+    if len(args) >= 3 and args[1] == "user":
+        target = await database.find_user(parse_targets(args[2:3])[0])
+        if not target:
+            await message.reply("Такого пользователя нет.")
+            return
+        lines = [f"👤 {target['user_id']} @{target['username']}: бесплатных скачиваний {target['free_downloads']}"]
+        for job in await database.get_user_history(target['user_id']):
+            finished = time.strftime("%d.%m %H:%M", time.localtime(job['finished_at']))
+            lines.append(f"{finished} {job['outcome']} {job['seconds']:.0f} с — {job['query']}")
+        await message.reply("\n".join(lines))
+        return
+
+    if len(args) >= 2 and not args[1].isdigit():
+        await message.reply("Использование: `/stats [часов]` или `/stats user <ID или @username>`")
+        return
+    hours = max(1, int(args[1])) if len(args) >= 2 else 24
+    stats = await database.get_admin_stats(hours)
+    failures = ", ".join(f"{outcome} {n}" for outcome, n in sorted(stats['failures'].items(), key=lambda item: -item[1]))
+    lines = [
+        f"📊 За {hours} ч: {stats['jobs']} запросов, {stats['jobs_per_hour']:.1f} в час",
+        f"Ошибки: {stats['failure_rate']:.1%}" + (f" ({failures})" if failures else ""),
+        f"🚫 Отменено: {stats['cancelled']}",
+        f"⭐️ Выручка: {stats['stars']} звёзд, возвращено {stats['stars_refunded']}",
+        "🔥 Популярные треки:",
+    ]
+    for track in stats['top_tracks']:
+        name = f"{track['performer']} - {track['title']}" if track['title'] else track['cache_key']
+        lines.append(f"{track['requests']} × {name}")
+    await message.reply("\n".join(lines))
+
+@dp.message(Command("cache"))
+async def cache_command(message: types.Message):
+    user = await database.get_user(message.from_user.id, message.from_user.username)
+    if not user['is_whitelisted']:
+        return
+
+    # /cache — stats, /cache drop <link or text> — invalidate one entry
+    args = message.text.split(maxsplit=2)
+    if len(args) >= 2 and args[1] == "drop":
+        if len(args) < 3:
+            await message.reply("Использование: `/cache drop <ссылка или название>`")
+            return
+        target = args[2]
+        is_link = "music.yandex.ru/" in target
+        cache_key = make_cache_key(target, is_link)
+        dropped = False
+        # Every quality of the track; drops the Telegram file_id and the copy on disk, unless another key shares that file
+        for quality in QUALITY_KBPS if cache_key else ():
+            variant = make_cache_key(target, is_link, quality)
+            dropped_file = ym_handler.audio_store.discard(variant)
+            dropped = await database.invalidate_cached_audio(variant) or dropped_file or dropped
+        if dropped:
+            await message.reply(f"🗑 Удалено из кэша: {cache_key}")
+        else:
+            await message.reply("Такого трека нет в кэше.")
+        return
+
+    stats = await database.get_cache_stats()
+    disk = ym_handler.audio_store.stats()
+    await message.reply(
+        f"📦 Кэш: {stats['entries']} треков\n"
+        f"Попадания: {stats['hits']}, промахи: {stats['misses']} ({stats['hit_ratio']:.0%})\n"
+        f"💽 На диске: {disk['files']} файлов, {disk['bytes'] / 2**20:.0f} из {disk['max_bytes'] / 2**20:.0f} МБ\n"
+        f"⚡️ Без скачивания: {metrics.served_without_download_ratio():.0%} запросов, предзагружено {prefetcher.prefetched} треков"
+    )
+
+@dp.message(Command("pipeline"))
+async def pipeline_command(message: types.Message):
+    user = await database.get_user(message.from_user.id, message.from_user.username)
+    if not user['is_whitelisted']:
+        return
+
+    lines = ["⚙️ Этапы загрузки:"]
+    for stage, stats in sorted(stage_stats.items()):
+        avg = stats['seconds'] / stats['count'] if stats['count'] else 0.0
+        lines.append(f"{stage}: {stats['count']} шт., всего {stats['seconds']:.1f} с, в среднем {avg:.2f} с")
+    await message.reply("\n".join(lines))
+
+@dp.message(F.text, ~F.text.startswith('/'), flags={"rate_limit": True})
+async def handle_text_request(message: types.Message, event_update: types.Update):
+    # Telegram redelivers updates it didn't get a timely 200 for; don't charge or queue twice
+    idempotency_key = f"update:{event_update.update_id}"
+    if await job_store.seen(idempotency_key):
+        return
+
+    if await job_store.is_full():
+        await message.reply(QUEUE_FULL_TEXT)
         return
 
     user = await database.get_user(message.from_user.id, message.from_user.username)
     
-    # Check limits
-    if not user['is_whitelisted'] and user['free_downloads'] <= 0:
+    # Check limits (check-and-decrement is a single atomic UPDATE)
+    is_free = not user['is_whitelisted']
+    if is_free and await database.try_consume_free_download(message.from_user.id) is None:
         # Prompt for payment
         await bot.send_invoice(
             chat_id=message.chat.id,
@@ -144,17 +933,71 @@ async def handle_text_request(message: types.Message):
             payload=f"download_{message.text}", 
             provider_token="", # Stars
             currency="XTR",
-            prices=[LabeledPrice(label="Скачивание", amount=3)]
+            prices=[LabeledPrice(label="Скачивание", amount=DOWNLOAD_PRICE_STARS)]
         )
         return
 
-    # Decrement free if applicable
-    if not user['is_whitelisted']:
-        await database.decrement_free_download(message.from_user.id)
+    charge = "free" if is_free else None
+    if not await enqueue_download(message, message.text, "⏳ Добавлено в очередь...", idempotency_key, charge=charge) and is_free:
+        # The queue filled up after the check above; give the free download back
+        await database.add_free_downloads(message.from_user.id, 1)
 
-    is_link = "music.yandex.ru/" in message.text
-    status_msg = await message.answer("⏳ Добавлено в очередь...")
-    await download_queue.put((message.chat.id, message.text, status_msg.message_id, message.from_user.id, is_link))
+@dp.inline_query()
+async def handle_inline_query(inline_query: types.InlineQuery):
+    started = time.perf_counter()
+    found = await inline_search.query(inline_query.from_user.id, inline_query.query)
+    if found is None:
+        return  # the user kept typing; only the newest query's answer is shown
+    tracks, complete = found
+
+    file_ids = await database.get_cached_file_ids([f"ym:{track['track_id']}" for track in tracks])
+    results = []
+    for track in tracks:
+        file_id = file_ids.get(f"ym:{track['track_id']}")
+        if file_id:
+            results.append(InlineQueryResultCachedAudio(id=f"a{track['track_id']}", audio_file_id=file_id))
+        else:
+            # Not uploaded yet: choosing it sends the track link, which the bot downloads as usual
+            results.append(InlineQueryResultArticle(
+                id=f"t{track['track_id']}",
+                title=track['title'],
+                description=track['artist'],
+                input_message_content=InputTextMessageContent(message_text=f"https://music.yandex.ru/track/{track['track_id']}"),
+            ))
+    # Partial answers must not be cached by Telegram
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME if complete else 0, is_personal=False)
+    metrics.observe_stage("inline", time.perf_counter() - started)
+
+@dp.callback_query(F.data.startswith("cancel:"))
+async def on_cancel(callback: CallbackQuery):
+    # cancel:<job id>, or cancel:<job id>:<batch id> once an album has been expanded into track jobs
+    _, job_id, *batch_id = callback.data.split(":")
+    jobs = []
+    job = await job_store.cancel(int(job_id), callback.from_user.id)
+    if job is not None:
+        jobs.append(job)
+    if batch_id:
+        jobs += await cancel_batch_jobs(batch_id[0], callback.from_user.id)
+        batch = active_batches.pop(batch_id[0], None)
+        if batch is not None:
+            # Elsewhere the owning process notices on its next check
+            await batch.cancel()
+    if not jobs:
+        await callback.answer("Уже нельзя отменить.")
+        return
+    queue_changed.set()
+    for job in jobs:
+        control = running_jobs.get(job['_id'])
+        if control:
+            # The worker refunds and reports once the job has stopped
+            control.cancel()
+        elif job['_state'] == "queued":
+            metrics.record_error("cancelled")
+            database.record_job(job['user_id'], job['query'], "cancelled", 0.0)
+            await refund_job(job)
+            if 'status_msg_id' in job:
+                await bot.edit_message_text(chat_id=job['chat_id'], message_id=job['status_msg_id'], text=CANCELLED_TEXT)
+    await callback.answer("Отменено.")
 
 @dp.pre_checkout_query()
 async def on_pre_checkout(query: PreCheckoutQuery):
@@ -163,15 +1006,22 @@ async def on_pre_checkout(query: PreCheckoutQuery):
 @dp.message(F.successful_payment)
 async def on_successful_payment(message: Message):
     payload = message.successful_payment.invoice_payload
+    database.record_stat("stars", message.successful_payment.total_amount)
     if payload.startswith("download_"):
         query_or_url = payload.replace("download_", "")
-        is_link = "music.yandex.ru/" in query_or_url
-        status_msg = await message.answer("✅ Оплата прошла! Добавляю в очередь...")
-        await download_queue.put((message.chat.id, query_or_url, status_msg.message_id, message.from_user.id, is_link))
+        # Paid jobs are accepted even when the queue is full
+        charge_id = message.successful_payment.telegram_payment_charge_id
+        await enqueue_download(
+            message, query_or_url, "✅ Оплата прошла! Добавляю в очередь...",
+            idempotency_key=f"payment:{charge_id}", force=True, charge="stars", payment_charge_id=charge_id
+        )
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await database.init_db()
+    await job_store.open()
+    await token_buckets.open()
+    await ym_handler.start()
     # Log configuration for debugging
     webhook_url = f"{BASE_URL}{WEBHOOK_PATH}"
     logging.info(f"🚀 Starting bot...")
@@ -183,18 +1033,37 @@ async def lifespan(app: FastAPI):
         logging.error("❌ CRITICAL: BOT_TOKEN or WEBHOOK_URL is missing!")
     
     try:
-        await bot.set_webhook(webhook_url)
+        await bot.set_webhook(webhook_url, secret_token=WEBHOOK_SECRET)
         logging.info("⭐ Webhook set successfully")
     except Exception as e:
         logging.error(f"❌ Failed to set webhook: {e}")
     
-    # Start worker
-    worker_task = asyncio.create_task(download_worker())
-        
+    # Start workers
+    metrics.WORKERS_TOTAL.set(WORKER_COUNT)
+    metrics.UPDATE_BUFFER_DEPTH.set_function(update_buffer.qsize)
+    worker_tasks[:] = [asyncio.create_task(download_worker(i)) for i in range(WORKER_COUNT)]
+    worker_tasks.extend(asyncio.create_task(update_dispatcher(i)) for i in range(DISPATCHER_COUNT))
+    worker_tasks.append(asyncio.create_task(queue_position_notifier()))
+    if PREFETCH_TOP_K > 0:
+        worker_tasks.append(asyncio.create_task(prefetcher.run()))
+    if YDL_WARMUP:
+        # Not awaited: /health shouldn't wait for it and a failed warm-up only costs the first download
+        asyncio.create_task(ym_handler.warm_up())
+
     yield
     logging.info("👋 Shutting down bot...")
-    worker_task.cancel()
+    # Updates in the buffer were already acknowledged to Telegram
+    try:
+        await asyncio.wait_for(update_buffer.join(), UPDATE_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning(f"Dropping {update_buffer.qsize()} buffered updates on shutdown")
+    for task in worker_tasks:
+        task.cancel()
+    await ym_handler.close()
     await bot.delete_webhook()
+    await job_store.close()
+    await token_buckets.close()
+    await database.close_db()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -204,14 +1073,48 @@ async def root():
 
 @app.api_route("/health", methods=["GET", "HEAD"])
 async def health():
-    return {"status": "healthy"}
+    dead = [task for task in worker_tasks if task.done()]
+    if dead:
+        return JSONResponse({"status": "unhealthy", "dead_tasks": len(dead)}, status_code=503)
+    return {"status": "healthy", "queue": await job_store.pending_count()}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/traces")
+async def slowest_traces(limit: int = 20):
+    traces = sorted(metrics.recent_traces, key=lambda t: t.duration, reverse=True)[:limit]
+    return [trace.as_dict() for trace in traces]
+
+@app.get("/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    trace = metrics.find_trace(trace_id)
+    if not trace:
+        raise HTTPException(status_code=404, detail="trace not found")
+    return trace.as_dict()
 
 @app.post(WEBHOOK_PATH)
 async def bot_webhook(request: Request):
+    if WEBHOOK_SECRET and not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+        metrics.UPDATES.labels(result="forbidden").inc()
+        raise HTTPException(status_code=403, detail="bad secret token")
+
     data = await request.json()
-    logging.info(f"Update received: {data}")
-    update = types.Update.model_validate(data, context={"bot": bot})
-    await dp.feed_update(bot, update)
+    update_id = data.get("update_id")
+    logging.debug(f"Update received: {data}")
+    if update_id in recent_update_ids:
+        metrics.UPDATES.labels(result="duplicate").inc()
+        return {"ok": True}
+
+    try:
+        update_buffer.put_nowait((time.monotonic(), data))
+    except asyncio.QueueFull:
+        # Telegram keeps the update and retries, which is the backpressure we want
+        metrics.UPDATES.labels(result="rejected").inc()
+        return JSONResponse({"ok": False}, status_code=503, headers={"Retry-After": "1"})
+    recent_update_ids.set(update_id, True)
+    metrics.UPDATES.labels(result="accepted").inc()
     return {"ok": True}
 
 if __name__ == "__main__":
@@ -0,0 +1,52 @@
+import re
+from difflib import SequenceMatcher
+from typing import Optional
+
+# Words that usually mean "not the original recording" unless the request asks for them
+UNWANTED_MARKERS = (
+    'cover', 'karaoke', 'instrumental', 'live', 'remix', 'nightcore', 'slowed', 'reverb',
+    'sped up', '8d', 'hours', 'hour', 'loop', 'reaction', 'tutorial', 'lyrics video', 'minus',
+)
+# A candidate this far off the Yandex duration is almost certainly something else
+MAX_DURATION_DRIFT = 0.25
+
+
+def normalize(text: str) -> str:
+    text = re.sub(r'[^\w\s]', ' ', (text or '').lower())
+    return " ".join(text.split())
+
+
+def score_candidate(candidate: dict, query: str, artist: str = None, title: str = None, duration: float = None) -> float:
+    """Scores a search result against what was requested, roughly in [-1, 1.2]."""
+    expected = normalize(" ".join(part for part in (artist, title) if part) or query)
+    found = normalize(f"{candidate.get('uploader') or candidate.get('channel') or ''} {candidate.get('title') or ''}")
+    if not expected or not found:
+        return -1.0
+
+    expected_words = set(expected.split())
+    found_words = set(found.split())
+    coverage = len(expected_words & found_words) / len(expected_words)
+    score = 0.6 * coverage + 0.4 * SequenceMatcher(None, expected, found).ratio()
+
+    for marker in UNWANTED_MARKERS:
+        if f" {marker} " in f" {found} " and f" {marker} " not in f" {expected} ":
+            score -= 0.3
+
+    candidate_duration = candidate.get('duration')
+    if duration and candidate_duration:
+        drift = abs(candidate_duration - duration) / duration
+        if drift <= 0.03:
+            score += 0.2
+        elif drift > MAX_DURATION_DRIFT:
+            score -= 0.6
+        else:
+            score -= drift
+    return score
+
+
+def pick_best(candidates: list, query: str, artist: str = None, title: str = None, duration: float = None) -> Optional[tuple]:
+    """Returns (score, candidate) for the best candidate, or None if there are none."""
+    scored = [(score_candidate(c, query, artist, title, duration), c) for c in candidates]
+    if not scored:
+        return None
+    return max(scored, key=lambda item: item[0])
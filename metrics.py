@@ -0,0 +1,170 @@
+import os
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# How many finished job traces are kept for /traces
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", 500))
+
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Jobs waiting in the download queue")
+WORKERS_TOTAL = Gauge("bot_workers_total", "Download workers started")
+WORKERS_BUSY = Gauge("bot_workers_busy", "Download workers currently processing a job")
+JOBS = Counter("bot_jobs_total", "Finished download jobs", ["outcome"])
+ERRORS = Counter("bot_errors_total", "Job failures by type", ["type"])
+RECOVERED = Counter("bot_recovered_total", "Failures a job got past, by type", ["type"])
+STAGE_LATENCY = Histogram(
+    "bot_stage_seconds", "Time spent per pipeline stage", ["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160),
+)
+CACHE_LOOKUPS = Counter("bot_cache_lookups_total", "Cache lookups", ["cache", "result"])
+CACHE_HIT_RATIO = Gauge("bot_cache_hit_ratio", "Share of cache lookups that were hits", ["cache"])
+ESTIMATED_WAIT = Gauge("bot_estimated_wait_seconds", "Expected wait for a job enqueued now")
+RATE_LIMITED = Counter("bot_rate_limited_total", "Download requests turned away", ["reason"])
+REFUNDS = Counter("bot_refunds_total", "Downloads given back after a job delivered nothing", ["kind"])
+TRANSFER_BYTES = Counter("bot_transfer_bytes_total", "Audio bytes downloaded from the sources")
+ENCODE_SECONDS_SAVED = Counter(
+    "bot_encode_seconds_saved_total", "Estimated encode time skipped by passthrough or by rejecting oversized tracks"
+)
+TRACK_REQUESTS = Counter("bot_track_requests_total", "Delivered track requests by what served them", ["served"])
+SERVED_WITHOUT_DOWNLOAD = Gauge(
+    "bot_served_without_download_ratio", "Share of delivered track requests that needed no download from the sources"
+)
+PREFETCHES = Counter("bot_prefetches_total", "Background prefetches of popular tracks", ["result"])
+UPDATE_BUFFER_DEPTH = Gauge("bot_update_buffer_depth", "Webhook updates waiting for a dispatcher")
+UPDATES = Counter("bot_updates_total", "Webhook updates by what happened to them", ["result"])
+UPDATE_WAIT = Histogram(
+    "bot_update_wait_seconds", "Time an update spent in the buffer before a dispatcher took it",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+_cache_counts = {}
+# served by -> delivered track requests, for the ratio gauge and /cache
+served_counts = {}
+
+
+class Trace:
+    """Per-job record of how long each stage took."""
+
+    def __init__(self, **attrs):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.attrs = attrs
+        self.started = time.time()
+        self.duration = None
+        self.outcome = None
+        self.error = None  # the last error recorded, the outcome if the job fails
+        self.stages = []
+
+    def as_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'started': self.started,
+            'duration': self.duration,
+            'outcome': self.outcome,
+            'stages': [{'stage': stage, 'seconds': round(seconds, 4)} for stage, seconds in self.stages],
+            **self.attrs,
+        }
+
+    def summary(self) -> str:
+        stages = " ".join(f"{stage}={seconds:.2f}s" for stage, seconds in self.stages)
+        return f"trace {self.trace_id} {self.outcome} in {self.duration:.2f}s: {stages}"
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+recent_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+
+
+def start_trace(**attrs) -> Trace:
+    trace = Trace(**attrs)
+    current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace: Trace, delivered: bool):
+    """Closes a trace; its outcome is "ok" if the job ``delivered``, otherwise the last recorded error type."""
+    trace.duration = time.time() - trace.started
+    trace.outcome = "ok" if delivered else trace.error or "not_delivered"
+    recent_traces.append(trace)
+    JOBS.labels(outcome=trace.outcome).inc()
+
+
+def find_trace(trace_id: str) -> Optional[Trace]:
+    for trace in recent_traces:
+        if trace.trace_id == trace_id:
+            return trace
+    return None
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_LATENCY.labels(stage=stage).observe(seconds)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.stages.append((stage, seconds))
+
+
+class timed_stage:
+    """``async with``/``with`` block that records its duration as a pipeline stage."""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe_stage(self.stage, time.perf_counter() - self.started)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        self.__exit__(*exc)
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    CACHE_LOOKUPS.labels(cache=cache, result="hit" if hit else "miss").inc()
+    hits, total = _cache_counts.get(cache, (0, 0))
+    hits, total = hits + hit, total + 1
+    _cache_counts[cache] = (hits, total)
+    CACHE_HIT_RATIO.labels(cache=cache).set(hits / total)
+
+
+def record_served(served: str):
+    """Counts a delivered track: "file_id", "shared" or "disk" needed no download, "download" did."""
+    TRACK_REQUESTS.labels(served=served).inc()
+    served_counts[served] = served_counts.get(served, 0) + 1
+    SERVED_WITHOUT_DOWNLOAD.set(served_without_download_ratio())
+
+
+def served_without_download_ratio() -> float:
+    total = sum(served_counts.values())
+    return 1 - served_counts.get("download", 0) / total if total else 0.0
+
+
+def record_transfer(transferred_bytes: int = 0, encode_seconds_saved: float = 0.0):
+    """Counts source bytes and skipped encode time, also per job on the current trace."""
+    TRANSFER_BYTES.inc(transferred_bytes)
+    ENCODE_SECONDS_SAVED.inc(encode_seconds_saved)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.attrs['bytes_transferred'] = trace.attrs.get('bytes_transferred', 0) + transferred_bytes
+        trace.attrs['encode_seconds_saved'] = round(trace.attrs.get('encode_seconds_saved', 0.0) + encode_seconds_saved, 2)
+
+
+def record_error(error_type: str):
+    ERRORS.labels(type=error_type).inc()
+    trace = current_trace.get()
+    if trace is not None:
+        trace.error = error_type
+
+
+def record_recovered(error_type: str):
+    """Counts a failure the job worked around (e.g. a stale file_id followed by a fresh download)."""
+    RECOVERED.labels(type=error_type).inc()
+    trace = current_trace.get()
+    if trace is not None:
+        trace.attrs.setdefault('recovered', []).append(error_type)
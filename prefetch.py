@@ -0,0 +1,145 @@
+"""Downloads popular and trending tracks into the audio cache while the bot is idle.
+
+A few chart tracks make up most requests. Every PREFETCH_INTERVAL seconds,
+if no job is queued or running, the PREFETCH_TOP_K tracks requested most in
+the last PREFETCH_WINDOW seconds and then the first PREFETCH_TOP_K tracks of
+PREFETCH_CHART_URL (any Yandex playlist or album link) are fetched into the
+disk cache one at a time. Tracks already on disk or uploaded to Telegram are
+skipped; a later request for a prefetched track only costs the upload.
+
+A prefetch is abandoned as soon as ``is_busy`` reports user work. It runs
+under a JobControl, so cancelling it also stops its fetch thread at the
+next block; what was downloaded stays in the store's partial/ dir, where a
+later request for the same track resumes it. Nothing is prefetched while the audio cache is above
+PREFETCH_DISK_SHARE of its size, so prefetching never evicts what users
+downloaded, or after PREFETCH_BYTES_PER_HOUR were prefetched in the last hour.
+"""
+import asyncio
+import contextvars
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+import database
+import metrics
+from job_control import JobControl, current_job
+from logic import make_cache_key, parse_cache_key
+from ttl_cache import TTLCache
+
+PREFETCH_INTERVAL = float(os.getenv("PREFETCH_INTERVAL", 60))
+# 0 turns prefetching off
+PREFETCH_TOP_K = int(os.getenv("PREFETCH_TOP_K", 20))
+PREFETCH_WINDOW = float(os.getenv("PREFETCH_WINDOW", 7 * 24 * 3600))
+PREFETCH_CHART_URL = os.getenv("PREFETCH_CHART_URL", "")
+PREFETCH_BYTES_PER_HOUR = int(os.getenv("PREFETCH_BYTES_PER_HOUR", 500 * 1024 * 1024))
+PREFETCH_DISK_SHARE = float(os.getenv("PREFETCH_DISK_SHARE", 0.5))
+# How often a running prefetch checks for user jobs
+PREFETCH_POLL_INTERVAL = 0.2
+# Tracks that failed aren't tried again for this long
+PREFETCH_RETRY_AFTER = 6 * 3600
+
+
+class Prefetcher:
+    """Fills ``handler``'s audio cache with likely requests while ``is_busy()`` is False."""
+
+    def __init__(self, handler, is_busy: Callable[[], Awaitable[bool]], top_k: int = PREFETCH_TOP_K,
+                 chart_url: str = PREFETCH_CHART_URL, bytes_per_hour: int = PREFETCH_BYTES_PER_HOUR,
+                 disk_share: float = PREFETCH_DISK_SHARE, window: float = PREFETCH_WINDOW):
+        self.handler = handler
+        self.is_busy = is_busy
+        self.top_k = top_k
+        self.chart_url = chart_url
+        self.bytes_per_hour = bytes_per_hour
+        self.disk_share = disk_share
+        self.window = window
+        self._fetched = deque()  # (time, bytes) of the last hour's prefetches
+        self._failed = TTLCache(maxsize=1024, ttl=PREFETCH_RETRY_AFTER)
+        self.prefetched = 0
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(PREFETCH_INTERVAL)
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Prefetch pass failed: {e}")
+
+    def bytes_last_hour(self) -> int:
+        cutoff = time.time() - 3600
+        while self._fetched and self._fetched[0][0] < cutoff:
+            self._fetched.popleft()
+        return sum(size for _, size in self._fetched)
+
+    def within_budget(self) -> bool:
+        store = self.handler.audio_store
+        return store.total_bytes < store.max_bytes * self.disk_share and self.bytes_last_hour() < self.bytes_per_hour
+
+    async def candidates(self) -> list:
+        """Cache keys worth prefetching, most requested first, then the chart."""
+        keys = await database.get_popular_tracks(self.top_k, time.time() - self.window)
+        if self.chart_url:
+            chart = await self.handler.get_collection_info(self.chart_url)
+            keys += [
+                make_cache_key(f"https://music.yandex.ru/track/{track['track_id']}", True)
+                for track in (chart or {}).get('tracks', [])[:self.top_k]
+            ]
+        keys = list(dict.fromkeys(keys))
+        uploaded = await database.get_cached_file_ids(keys)
+        return [
+            key for key in keys
+            if key not in uploaded and key not in self._failed and not self.handler.audio_store.contains(key)
+        ]
+
+    async def run_once(self) -> int:
+        """One pass over the candidates; returns how many tracks were prefetched."""
+        if self.top_k <= 0 or await self.is_busy():
+            return 0
+        prefetched = 0
+        for cache_key in await self.candidates():
+            if not self.within_budget() or await self.is_busy():
+                break
+            prefetched += await self.prefetch(cache_key)
+        return prefetched
+
+    async def prefetch(self, cache_key: str) -> bool:
+        query_or_url, is_link, quality = parse_cache_key(cache_key)
+        if is_link:
+            info = await self.handler.get_track_info(query_or_url)
+            if not info:
+                self._failed.set(cache_key, True)
+                return False
+            track = (info['query'], info['filename'], info['artist'], info['title'], info['duration'])
+        else:
+            track = (query_or_url, f"{query_or_url}.mp3", None, None, None)
+
+        control = JobControl()
+        context = contextvars.copy_context()
+        context.run(current_job.set, control)
+        control.task = asyncio.create_task(self.handler.download_track(*track, cache_key, quality), context=context)
+        try:
+            while not (await asyncio.wait({control.task}, timeout=PREFETCH_POLL_INTERVAL))[0]:
+                if await self.is_busy():
+                    control.cancel()
+                    metrics.PREFETCHES.labels(result="cancelled").inc()
+                    print(f"Prefetch of {cache_key} stopped for user jobs")
+                    return False
+        except asyncio.CancelledError:
+            control.cancel()
+            raise
+        try:
+            path = control.task.result()
+        except Exception as e:
+            print(f"Prefetch of {cache_key} failed: {e}")
+            path = ""
+        if not path:
+            self._failed.set(cache_key, True)
+            metrics.PREFETCHES.labels(result="failed").inc()
+            return False
+
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._fetched.append((time.time(), size))
+        self.prefetched += 1
+        metrics.PREFETCHES.labels(result="done").inc()
+        print(f"Prefetched {cache_key} ({size / 2**20:.1f} MB)")
+        return True
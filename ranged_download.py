@@ -0,0 +1,151 @@
+"""Multi-connection HTTP downloads that resume from partial files.
+
+The file is split into chunks of RANGED_CHUNK_BYTES that up to
+RANGED_CONNECTIONS threads fetch with Range requests and write in place
+into ``<path>.part``. Finished chunks are recorded in ``<path>.parts``, so
+a download that failed near the end is picked up again by the next call
+for the same path and only fetches what is missing. Servers that ignore
+Range get ``RangeNotSupported`` and the caller falls back to a plain
+download.
+
+Runs in a fetch thread; reports progress and checks for cancellation
+through job_control.
+"""
+import contextvars
+import http.client
+import json
+import os
+import queue
+import re
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from job_control import check_cancelled, report_progress
+
+RANGED_CONNECTIONS = int(os.getenv("RANGED_CONNECTIONS", 4))
+RANGED_CHUNK_BYTES = int(os.getenv("RANGED_CHUNK_BYTES", 1024 * 1024))
+RANGED_TIMEOUT = float(os.getenv("RANGED_TIMEOUT", 20))
+BLOCK_BYTES = 64 * 1024
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+def _open(url: str, headers: dict, start: int, end: int):
+    request = urllib.request.Request(url, headers=dict(headers, Range=f"bytes={start}-{end}"))
+    response = urllib.request.urlopen(request, timeout=RANGED_TIMEOUT)
+    if response.status != 206:
+        response.close()
+        raise RangeNotSupported(f"{url} answered a Range request with {response.status}")
+    return response
+
+
+def probe_size(url: str, headers: dict) -> int:
+    """Total size from the Content-Range of a one-byte request."""
+    with _open(url, headers, 0, 0) as response:
+        response.read()
+        match = re.search(r"/(\d+)$", response.headers.get("Content-Range", ""))
+    if not match:
+        raise RangeNotSupported(f"{url} sent no Content-Range")
+    return int(match.group(1))
+
+
+def _load_state(state_path: str, size: int) -> set:
+    try:
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    return set(state["done"]) if state.get("size") == size else set()
+
+
+def _save_state(state_path: str, size: int, done: set):
+    staged = f"{state_path}.tmp"
+    with open(staged, "w", encoding="utf-8") as f:
+        json.dump({"size": size, "done": sorted(done)}, f)
+    os.replace(staged, state_path)
+
+
+def download_ranged(url: str, path: str, headers: Optional[dict] = None, size: Optional[int] = None,
+                    connections: int = RANGED_CONNECTIONS, chunk_bytes: int = RANGED_CHUNK_BYTES) -> int:
+    """Downloads ``url`` to ``path`` and returns its size.
+
+    ``size``, when known from the extracted format, saves the probe request.
+    On an error the partial file is kept for the next attempt.
+    """
+    headers = headers or {}
+    if not size:
+        size = probe_size(url, headers)
+    part_path, state_path = f"{path}.part", f"{path}.parts"
+    done = _load_state(state_path, size) if os.path.exists(part_path) else set()
+    if not done:
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+    chunks = queue.SimpleQueue()
+    for index in range((size + chunk_bytes - 1) // chunk_bytes):
+        if index not in done:
+            chunks.put(index)
+
+    lock = threading.Lock()
+    failed = threading.Event()
+    downloaded = [sum(min(chunk_bytes, size - index * chunk_bytes) for index in done)]
+    report_progress(downloaded[0], size)
+
+    def fetch_chunks(fd: int):
+        while not failed.is_set():
+            try:
+                index = chunks.get_nowait()
+            except queue.Empty:
+                return
+            start = index * chunk_bytes
+            end = min(start + chunk_bytes, size) - 1
+            offset = start
+            try:
+                with _open(url, headers, start, end) as response:
+                    while offset <= end:
+                        check_cancelled()
+                        block = response.read(min(BLOCK_BYTES, end + 1 - offset))
+                        if not block:
+                            raise ConnectionError(f"chunk {index} ended at {offset - start} of {end + 1 - start} bytes")
+                        os.pwrite(fd, block, offset)
+                        offset += len(block)
+                        with lock:
+                            downloaded[0] += len(block)
+                            report_progress(downloaded[0], size)
+            except http.client.HTTPException as e:
+                # A body cut short; callers only need to handle OSError
+                failed.set()
+                with lock:
+                    downloaded[0] -= offset - start
+                raise ConnectionError(f"chunk {index}: {e!r}") from e
+            except BaseException:
+                failed.set()
+                with lock:
+                    downloaded[0] -= offset - start
+                raise
+            with lock:
+                done.add(index)
+                _save_state(state_path, size, done)
+
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, connections), thread_name_prefix="range") as pool:
+            # Each thread gets its own copy of the job context for cancellation and progress
+            futures = [pool.submit(contextvars.copy_context().run, fetch_chunks, fd) for _ in range(max(1, connections))]
+        for future in futures:
+            future.result()
+    except RangeNotSupported:
+        # The zero-filled file must not be mistaken for a partial download by whoever fetches it next
+        for leftover in (part_path, state_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    finally:
+        os.close(fd)
+    os.replace(part_path, path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return size
@@ -0,0 +1,147 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import aiosqlite
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message, TelegramObject
+
+import metrics
+from job_store import JOB_DB_PATH, JOB_STORE
+from ttl_cache import TTLCache
+
+# Download requests per user: a burst of USER_RATE_BURST, refilled at USER_RATE_PER_MINUTE
+USER_RATE_BURST = float(os.getenv("USER_RATE_BURST", 5))
+USER_RATE_PER_MINUTE = float(os.getenv("USER_RATE_PER_MINUTE", 6))
+# Download requests from everyone together
+GLOBAL_RATE_BURST = float(os.getenv("GLOBAL_RATE_BURST", 60))
+GLOBAL_RATE_PER_MINUTE = float(os.getenv("GLOBAL_RATE_PER_MINUTE", 120))
+
+RATE_LIMITED_TEXT = "🐢 Слишком много запросов. Попробуйте через {seconds} с."
+OVERLOADED_TEXT = "🚦 Бот сейчас перегружен, попробуйте через пару минут."
+
+
+class TokenBuckets(ABC):
+    """Token buckets keyed by name; ``take`` either spends ``cost`` tokens or says how long to wait."""
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def take(self, key: str, capacity: float, per_second: float, cost: float = 1) -> float:
+        """Returns 0 if the tokens were taken, otherwise the seconds until they will be available."""
+
+    @staticmethod
+    def _wait(tokens: float, per_second: float, cost: float) -> float:
+        return (cost - tokens) / per_second if per_second > 0 else float('inf')
+
+
+class SqliteTokenBuckets(TokenBuckets):
+    """Buckets in the job database, so that all processes share the same limits."""
+
+    def __init__(self, path: str = JOB_DB_PATH):
+        self.path = path
+        self._db: Optional[aiosqlite.Connection] = None
+
+    async def open(self):
+        self._db = await aiosqlite.connect(self.path, isolation_level=None)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute("PRAGMA busy_timeout=5000")
+        await self._db.execute("""
+            CREATE TABLE IF NOT EXISTS rate_buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def take(self, key: str, capacity: float, per_second: float, cost: float = 1) -> float:
+        now = time.time()
+        # Refill and spend in one statement; the WHERE leaves the row alone if there aren't enough tokens
+        async with self._db.execute(
+            """
+            INSERT INTO rate_buckets (key, tokens, updated_at) VALUES (:key, :capacity - :cost, :now)
+            ON CONFLICT(key) DO UPDATE SET
+                tokens = MIN(:capacity, tokens + (:now - updated_at) * :rate) - :cost,
+                updated_at = :now
+            WHERE MIN(:capacity, tokens + (:now - updated_at) * :rate) >= :cost
+            RETURNING tokens
+            """,
+            {'key': key, 'capacity': capacity, 'cost': cost, 'now': now, 'rate': per_second}
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is not None:
+            return 0.0
+        async with self._db.execute("SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)) as cursor:
+            tokens, updated_at = await cursor.fetchone()
+        return self._wait(min(capacity, tokens + (now - updated_at) * per_second), per_second, cost)
+
+
+class MemoryTokenBuckets(TokenBuckets):
+    """Per-process buckets, for tests and local runs with JOB_STORE=memory."""
+
+    def __init__(self):
+        self._buckets = TTLCache(maxsize=100_000, ttl=24 * 3600)  # key -> (tokens, updated_at)
+
+    async def take(self, key: str, capacity: float, per_second: float, cost: float = 1) -> float:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * per_second)
+        if tokens < cost:
+            return self._wait(tokens, per_second, cost)
+        self._buckets.set(key, (tokens - cost, now))
+        return 0.0
+
+
+def create_token_buckets() -> TokenBuckets:
+    if JOB_STORE == "memory":
+        return MemoryTokenBuckets()
+    return SqliteTokenBuckets(JOB_DB_PATH)
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """Admission control for handlers flagged with ``flags={"rate_limit": True}``.
+
+    A message is rejected when ``overloaded()`` says the queue is too long
+    (load shedding, checked first so it costs no tokens), or when the
+    sender's or the global token bucket is empty.
+    """
+
+    def __init__(self, buckets: TokenBuckets, overloaded: Callable[[], Awaitable[bool]]):
+        self.buckets = buckets
+        self.overloaded = overloaded
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not get_flag(data, "rate_limit") or not isinstance(event, Message):
+            return await handler(event, data)
+
+        if await self.overloaded():
+            metrics.RATE_LIMITED.labels(reason="shed").inc()
+            await event.reply(OVERLOADED_TEXT)
+            return None
+
+        for reason, key, capacity, per_minute in (
+            ("user", f"user:{event.from_user.id}", USER_RATE_BURST, USER_RATE_PER_MINUTE),
+            ("global", "global", GLOBAL_RATE_BURST, GLOBAL_RATE_PER_MINUTE),
+        ):
+            wait = await self.buckets.take(key, capacity, per_minute / 60)
+            if wait > 0:
+                metrics.RATE_LIMITED.labels(reason=reason).inc()
+                await event.reply(RATE_LIMITED_TEXT.format(seconds=max(1, round(wait))))
+                return None
+        return await handler(event, data)
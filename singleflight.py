@@ -0,0 +1,47 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Tuple
+
+
+class CallCancelled(Exception):
+    """The first caller was cancelled, so the call the others were waiting for never finished."""
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one.
+
+    The first caller for a key runs ``fn``; every caller that arrives while it
+    is still running waits for that same result (or exception) instead of
+    starting its own.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._calls
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Returns ``(result, shared)``; ``shared`` is True for callers that reused another call's result."""
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # The waiters weren't cancelled themselves; they get an error they can retry on
+            future.set_exception(CallCancelled(key))
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark as retrieved so a call without waiters doesn't log "exception never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
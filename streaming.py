@@ -0,0 +1,42 @@
+import asyncio
+from typing import AsyncGenerator
+
+from aiogram import Bot
+from aiogram.types import InputFile
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class ProcessStreamInputFile(InputFile):
+    """Uploads the stdout of a subprocess (normally ffmpeg) without touching the disk.
+
+    Chunks are pulled from the pipe only as fast as the multipart upload sends
+    them, so memory per job stays around a couple of chunks regardless of the
+    track length.
+    """
+
+    def __init__(self, argv: list, filename: str, chunk_size: int = STREAM_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.argv = argv
+        self.bytes_sent = 0
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        process = await asyncio.create_subprocess_exec(
+            *self.argv,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=self.chunk_size,
+        )
+        try:
+            while True:
+                chunk = await process.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                self.bytes_sent += len(chunk)
+                yield chunk
+            if await process.wait() != 0:
+                raise RuntimeError(f"{self.argv[0]} exited with code {process.returncode}")
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
@@ -0,0 +1,305 @@
+"""Local stand-ins for Yandex Music, YouTube/SoundCloud and the Telegram Bot API.
+
+Used by the offline tests and benchmarks. ``CatalogServer`` is one aiohttp
+app serving, from fixtures/offline_catalog.json:
+  /handlers/track.jsx, /handlers/album.jsx, /handlers/music-search.jsx
+      what YandexMusicHandler reads from music.yandex.ru
+  /search, /watch/<id>, /files/<id>.m4a
+      a video site, read through the yt-dlp extractors from
+      ``fake_extractors``: "ytsearch"/"scsearch" queries and watch pages
+      that offer one m4a audio format
+Every route waits its configured latency and audio is sent at a limited
+bandwidth. Requests are counted per route. Audio files honour
+Range requests; setting ``cut_after_bytes`` drops the connection once that
+many audio bytes were sent, to exercise resumed downloads.
+
+``offline_bot`` wires all of it into main: the handler, the Bot API session
+(``StubSession``), a job store and a database in a temporary directory.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import SendAudio, SendMediaGroup
+from aiogram.types import Message
+from aiohttp import web
+
+from matching import normalize
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "offline_catalog.json")
+AUDIO_CHUNK = 64 * 1024
+
+
+def load_catalog(path: str = CATALOG_PATH) -> dict:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class StubSession(BaseSession):
+    """Answers every Bot API method after a fixed delay without any network.
+
+    Calls are kept in ``requests``; sent audio gets a made-up file_id.
+    Sending one of ``rejected_file_ids`` fails the way an expired file_id does.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+        self.requests = []
+        self.rejected_file_ids = set()
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        self.requests.append(method)
+        await asyncio.sleep(self.latency)
+        if isinstance(method, SendAudio) and method.audio in self.rejected_file_ids:
+            raise TelegramBadRequest(method, "Bad Request: wrong file identifier/HTTP URL specified")
+        if method.__returning__ is bool:
+            return True
+        if isinstance(method, SendMediaGroup):
+            return [self._message(bot, method, i) for i in range(len(method.media))]
+        return self._message(bot, method)
+
+    def _message(self, bot, method, index: int = 0) -> Message:
+        data = {
+            'message_id': self.calls * 100 + index,
+            'date': int(time.time()),
+            'chat': {'id': getattr(method, 'chat_id', 1), 'type': 'private'},
+            'text': getattr(method, 'text', None),
+        }
+        if hasattr(method, 'audio') or hasattr(method, 'media'):
+            data['audio'] = {'file_id': f"stub-audio-{self.calls}-{index}", 'file_unique_id': f"u{self.calls}-{index}", 'duration': 1}
+        return Message.model_validate(data, context={"bot": bot})
+
+    def sent_audio(self) -> list:
+        return [method for method in self.requests if isinstance(method, (SendAudio, SendMediaGroup))]
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url: str, headers: Optional[dict] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True):
+        """Files downloaded from the Bot API are empty."""
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        yield b""
+
+
+class CatalogServer:
+    def __init__(self, catalog: dict, latency: Optional[dict] = None):
+        self.catalog = catalog
+        self.latency = dict(catalog['latency'], **(latency or {}))
+        self.tracks = {track['id']: track for track in catalog['tracks']}
+        self.albums = {album['id']: album for album in catalog['albums']}
+        self.audio = os.urandom(catalog['audio_bytes'])
+        self.requests = Counter()
+        self.audio_bytes_sent = 0
+        self.cut_after_bytes: Optional[int] = None
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get("/handlers/track.jsx", self.track_jsx)
+        app.router.add_get("/handlers/album.jsx", self.album_jsx)
+        app.router.add_get("/handlers/music-search.jsx", self.music_search_jsx)
+        app.router.add_get("/search", self.search)
+        app.router.add_get("/watch/{track_id}", self.watch)
+        app.router.add_get("/files/{track_id}.m4a", self.audio_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self.base_url
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _wait(self, route: str, latency_key: str):
+        self.requests[route] += 1
+        await asyncio.sleep(self.latency[latency_key])
+
+    @staticmethod
+    def _yandex_track(track: dict) -> dict:
+        return {
+            'id': track['id'],
+            'title': track['title'],
+            'artists': [{'name': name} for name in track['artist'].split(' & ')],
+            'durationMs': track['duration_ms'],
+        }
+
+    def _matching(self, text: str) -> list:
+        words = normalize(text).split()
+        return [
+            track for track in self.catalog['tracks']
+            if words and all(word in normalize(f"{track['artist']} {track['title']}").split() for word in words)
+        ]
+
+    async def track_jsx(self, request: web.Request):
+        await self._wait("track.jsx", "yandex")
+        track = self.tracks.get(request.query.get('track', ''))
+        if not track:
+            return web.json_response({'error': 'not-found'}, status=404)
+        return web.json_response({'track': self._yandex_track(track)})
+
+    async def album_jsx(self, request: web.Request):
+        await self._wait("album.jsx", "yandex")
+        album = self.albums.get(request.query.get('album', ''))
+        if not album:
+            return web.json_response({'error': 'not-found'}, status=404)
+        return web.json_response({
+            'title': album['title'],
+            'volumes': [[self._yandex_track(self.tracks[track_id]) for track_id in album['track_ids']]],
+        })
+
+    async def music_search_jsx(self, request: web.Request):
+        await self._wait("music-search.jsx", "yandex")
+        items = [self._yandex_track(track) for track in self._matching(request.query.get('text', ''))]
+        return web.json_response({'tracks': {'items': items}})
+
+    async def search(self, request: web.Request):
+        """Video search: the upload of each matching track, plus a cover nobody asked for."""
+        await self._wait("search", "search")
+        entries = []
+        for track in self._matching(request.query.get('q', '').removesuffix(' audio')):
+            duration = track['duration_ms'] / 1000
+            entries.append({'id': track['id'], 'title': f"{track['artist']} - {track['title']}", 'duration': duration})
+            entries.append({'id': track['id'], 'title': f"{track['title']} (cover)", 'duration': duration + 20})
+        return web.json_response(entries)
+
+    async def watch(self, request: web.Request):
+        await self._wait("watch", "extract")
+        track = self.tracks.get(request.match_info['track_id'])
+        if not track:
+            return web.json_response({'error': 'not-found'}, status=404)
+        duration = track['duration_ms'] / 1000
+        return web.json_response({
+            'id': track['id'],
+            'title': f"{track['artist']} - {track['title']}",
+            'duration': duration,
+            'formats': [{
+                'format_id': '140',
+                'url': f"{self.base_url}/files/{track['id']}.m4a",
+                'ext': 'm4a',
+                'vcodec': 'none',
+                'acodec': 'mp4a.40.2',
+                'abr': 129,
+                'filesize_approx': int(129 * 125 * duration),
+                'filesize': len(self.audio),
+            }],
+        })
+
+    async def audio_file(self, request: web.Request):
+        self.requests["files"] += 1
+        size = len(self.audio)
+        headers = {'Content-Type': 'audio/mp4', 'Accept-Ranges': 'bytes'}
+        start, end = 0, size
+        if 'Range' in request.headers:
+            self.requests["ranges"] += 1
+            requested = request.http_range
+            start, end = requested.start or 0, min(requested.stop or size, size)
+            headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+        headers['Content-Length'] = str(end - start)
+        response = web.StreamResponse(status=206 if 'Range' in request.headers else 200, headers=headers)
+        await response.prepare(request)
+        bandwidth = self.latency['bandwidth_bytes_per_second']
+        for offset in range(start, end, AUDIO_CHUNK):
+            chunk = self.audio[offset:min(offset + AUDIO_CHUNK, end)]
+            if self.cut_after_bytes is not None and self.audio_bytes_sent + len(chunk) > self.cut_after_bytes:
+                self.cut_after_bytes = None
+                request.transport.close()
+                return response
+            await asyncio.sleep(len(chunk) / bandwidth)
+            try:
+                await response.write(chunk)
+            except ConnectionResetError:
+                return response  # the client went away, e.g. on cancel
+            self.audio_bytes_sent += len(chunk)
+        await response.write_eof()
+        return response
+
+
+def fake_extractors(base_url: str) -> tuple:
+    """yt-dlp extractors for the video site of a running CatalogServer."""
+    from yt_dlp.extractor.common import InfoExtractor, SearchInfoExtractor
+
+    watch_pattern = rf"{base_url}/watch/(?P<id>\w+)".replace(".", r"\.")
+
+    class FakeWatchIE(InfoExtractor):
+        IE_NAME = 'fake:watch'
+        _VALID_URL = watch_pattern
+
+        def _real_extract(self, url):
+            video_id = self._match_id(url)
+            info = self._download_json(url, video_id)
+            return {**info, 'webpage_url': url}
+
+    class FakeSearchIE(SearchInfoExtractor):
+        def _search_results(self, query):
+            entries = self._download_json(f"{base_url}/search", query, query={'q': query})
+            for entry in entries:
+                yield self.url_result(
+                    f"{base_url}/watch/{entry['id']}", FakeWatchIE, entry['id'], entry['title'],
+                    duration=entry['duration'], webpage_url=f"{base_url}/watch/{entry['id']}",
+                )
+
+    # yt-dlp tells extractors apart by class name
+    class FakeYoutubeSearchIE(FakeSearchIE):
+        IE_NAME = 'fake:ytsearch'
+        _SEARCH_KEY = 'ytsearch'
+
+    class FakeSoundcloudSearchIE(FakeSearchIE):
+        IE_NAME = 'fake:scsearch'
+        _SEARCH_KEY = 'scsearch'
+
+    return FakeYoutubeSearchIE, FakeSoundcloudSearchIE, FakeWatchIE
+
+
+@asynccontextmanager
+async def offline_bot(tmp_dir: str, latency: Optional[dict] = None, api_latency: float = 0.0):
+    """Points main at a CatalogServer and a StubSession; yields (server, session).
+
+    main's module globals are restored afterwards.
+    """
+    import database
+    import main
+    from job_store import MemoryJobStore
+    from audio_store import AudioStore
+    from logic import AUDIO_CACHE_MAX_BYTES, YandexMusicHandler
+    from ydl_pool import YoutubeDLPool
+
+    server = CatalogServer(load_catalog(), latency)
+    base_url = await server.start()
+    handler = YandexMusicHandler(base_url)
+    handler.audio_store = AudioStore(os.path.join(tmp_dir, "audio"), AUDIO_CACHE_MAX_BYTES)
+    handler.ydl_pool = YoutubeDLPool(handler.ydl_pool.profiles, allowed_extractors=[], extra_extractors=fake_extractors(base_url))
+    session = StubSession(api_latency)
+
+    saved = main.ym_handler, main.bot, main.job_store, database.DB_PATH
+    main.ym_handler = handler
+    main.bot = Bot(token="123456:OFFLINE", session=session)
+    main.job_store = MemoryJobStore(retry_backoff=0.1)
+    database.DB_PATH = os.path.join(tmp_dir, "bot_data.db")
+    await database.init_db()
+    await handler.start()
+    try:
+        yield server, session
+    finally:
+        await handler.close()
+        await database.close_db()
+        await server.close()
+        main.ym_handler, main.bot, main.job_store, database.DB_PATH = saved
+        main.active_batches.clear()
+        main.running_jobs.clear()
@@ -0,0 +1,56 @@
+from audio_quality import TrackTooLarge, pick_mp3_bitrate, plan_download
+
+# What YouTube typically offers for a music video, audio-only formats first
+FORMATS = [
+    {'format_id': '139', 'ext': 'm4a', 'vcodec': 'none', 'abr': 48},
+    {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'abr': 129},
+    {'format_id': '251', 'ext': 'webm', 'vcodec': 'none', 'abr': 160},
+    {'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1', 'tbr': 600},
+]
+
+
+def test_song_is_sent_as_is():
+    plan = plan_download({'duration': 240, 'formats': FORMATS}, preferred_kbps=192)
+    assert plan['format']['format_id'] == '140'
+    assert not plan['transcode']
+    assert plan['estimated_bytes'] == 129 * 125 * 240
+
+
+def test_low_quality_preference_gets_a_smaller_file():
+    plan = plan_download({'duration': 240, 'formats': FORMATS}, preferred_kbps=96)
+    assert plan['transcode']
+    assert plan['bitrate'] == 96
+    # The smallest source that still carries 96 kbps, not the best one
+    assert plan['format']['format_id'] == '140'
+
+
+def test_long_mix_is_encoded_to_fit():
+    plan = plan_download({'duration': 3600, 'formats': FORMATS}, preferred_kbps=192)
+    assert plan['transcode']
+    assert plan['bitrate'] == 96
+    assert plan['estimated_bytes'] < 50 * 1024 * 1024
+
+
+def test_dj_set_is_rejected_before_download():
+    try:
+        plan_download({'duration': 3 * 3600, 'formats': FORMATS}, preferred_kbps=320)
+        assert False, "expected TrackTooLarge"
+    except TrackTooLarge as e:
+        assert e.duration == 3 * 3600
+    assert pick_mp3_bitrate(None, 192) == 192
+
+
+def test_direct_link_without_metadata_is_trusted():
+    info = {'ext': 'mp3', 'vcodec': 'none', 'format_id': 'mpeg'}
+    plan = plan_download(info, preferred_kbps=192)
+    assert plan['format'] is info
+    assert not plan['transcode']
+
+
+if __name__ == "__main__":
+    test_song_is_sent_as_is()
+    test_low_quality_preference_gets_a_smaller_file()
+    test_long_mix_is_encoded_to_fit()
+    test_dj_set_is_rejected_before_download()
+    test_direct_link_without_metadata_is_trusted()
+    print("OK")
@@ -0,0 +1,204 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from audio_store import AudioStore
+
+
+def write_temp(store: AudioStore, content: bytes, ext: str = ".mp3") -> str:
+    path = store.temp_path(ext)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def test_put_and_get_by_key():
+    with tempfile.TemporaryDirectory() as root:
+        store = AudioStore(root, max_bytes=10_000)
+        store.load()
+        path = store.put("ym:1", write_temp(store, b"a" * 100))
+
+        assert store.get("ym:1") == path
+        assert store.get("ym:2") is None
+        assert path.endswith(".mp3") and open(path, "rb").read() == b"a" * 100
+        assert os.listdir(store.tmp_dir) == []
+
+
+def test_equal_names_do_not_collide_and_equal_content_is_stored_once():
+    with tempfile.TemporaryDirectory() as root:
+        store = AudioStore(root, max_bytes=10_000)
+        store.load()
+        first = store.put("q:song", write_temp(store, b"first"))
+        second = store.put("ym:7", write_temp(store, b"second"))
+        same = store.put("ym:8", write_temp(store, b"first"))
+
+        assert first != second
+        assert same == first
+        assert store.stats()['files'] == 2
+        assert store.stats()['bytes'] == len(b"first") + len(b"second")
+
+
+def test_discarded_file_is_deleted_once_no_key_refers_to_it():
+    with tempfile.TemporaryDirectory() as root:
+        store = AudioStore(root, max_bytes=10_000)
+        store.load()
+        path = store.put("q:song", write_temp(store, b"audio"))
+        store.put("ym:7", write_temp(store, b"audio"))
+
+        assert store.discard("q:song")
+        assert os.path.exists(path) and store.get("ym:7") == path
+        assert store.discard("ym:7")
+        assert not os.path.exists(path)
+        assert store.stats() == {'files': 0, 'keys': 0, 'bytes': 0, 'max_bytes': 10_000, 'evictions': 0}
+        assert not store.discard("ym:7")
+
+
+def test_lru_eviction_keeps_recently_used_files():
+    with tempfile.TemporaryDirectory() as root:
+        store = AudioStore(root, max_bytes=250, grace_seconds=0)
+        store.load()
+        store.put("ym:1", write_temp(store, b"1" * 100))
+        store.put("ym:2", write_temp(store, b"2" * 100))
+        time.sleep(0.01)
+        store.get("ym:1")
+        store.put("ym:3", write_temp(store, b"3" * 100))
+
+        assert store.get("ym:2") is None
+        assert store.get("ym:1") and store.get("ym:3")
+        assert store.stats()['bytes'] == 200
+
+
+def test_lfu_eviction_keeps_frequently_used_files():
+    with tempfile.TemporaryDirectory() as root:
+        store = AudioStore(root, max_bytes=250, policy="lfu", grace_seconds=0)
+        store.load()
+        store.put("ym:1", write_temp(store, b"1" * 100))
+        for _ in range(3):
+            store.get("ym:1")
+        store.put("ym:2", write_temp(store, b"2" * 100))
+        store.put("ym:3", write_temp(store, b"3" * 100))
+
+        assert store.get("ym:1") is not None
+        assert store.get("ym:2") is None
+
+
+def test_recently_used_files_survive_eviction():
+    with tempfile.TemporaryDirectory() as root:
+        store = AudioStore(root, max_bytes=150, grace_seconds=60)
+        store.load()
+        store.put("ym:1", write_temp(store, b"1" * 100))
+        store.put("ym:2", write_temp(store, b"2" * 100))
+
+        # Both may still be uploading, so the budget is exceeded for now
+        assert store.get("ym:1") and store.get("ym:2")
+
+
+def test_index_is_rebuilt_from_disk():
+    with tempfile.TemporaryDirectory() as root:
+        store = AudioStore(root, max_bytes=10_000)
+        store.load()
+        path = store.put("ym:1", write_temp(store, b"x" * 10))
+        store.put("ym:2", write_temp(store, b"y" * 10))
+        write_temp(store, b"half-written download")
+        os.remove(store.get("ym:2"))
+
+        restarted = AudioStore(root, max_bytes=10_000)
+        restarted.load()
+        assert restarted.get("ym:1") == path
+        assert restarted.get("ym:2") is None
+        assert restarted.stats() == {'files': 1, 'keys': 1, 'bytes': 10, 'max_bytes': 10_000, 'evictions': 0}
+        assert os.listdir(restarted.tmp_dir) == []
+
+
+def test_partial_claim_is_exclusive_until_its_holder_is_gone():
+    with tempfile.TemporaryDirectory() as root:
+        store = AudioStore(root, max_bytes=10_000)
+        store.load()
+        with store.claim_partial("youtube-abc-140") as base:
+            assert base == os.path.join(store.partial_dir, "youtube-abc-140")
+            with store.claim_partial("youtube-abc-140") as second:
+                assert second is None
+            with store.claim_partial("youtube-xyz-140") as other:
+                assert other is not None
+        assert os.listdir(store.partial_dir) == []
+
+        # A process that died holding the claim leaves its lock file behind
+        def claim_and_die():
+            subprocess.run([sys.executable, "-c", (
+                "import fcntl, os, sys\n"
+                "fd = os.open(sys.argv[1], os.O_CREAT | os.O_WRONLY)\n"
+                "fcntl.flock(fd, fcntl.LOCK_EX)\n"
+                "os._exit(0)\n"
+            ), os.path.join(store.partial_dir, "youtube-abc-140.lock")], check=True)
+
+        claim_and_die()
+        with store.claim_partial("youtube-abc-140") as base:
+            assert base is not None
+        claim_and_die()
+        store.load()
+        assert os.listdir(store.partial_dir) == []
+
+
+def test_sweep_removes_partials_nobody_will_come_back_for():
+    with tempfile.TemporaryDirectory() as root:
+        store = AudioStore(root, max_bytes=10_000)
+        store.load()
+
+        def partial(name: str, age: float):
+            path = os.path.join(store.partial_dir, name)
+            with open(path, "wb") as f:
+                f.write(b"audio")
+            os.utime(path, (time.time() - age, time.time() - age))
+
+        partial("youtube-new-140.m4a", 60)  # finished just now
+        partial("youtube-done-140.m4a", 3600)  # finished an hour ago
+        partial("youtube-cut-140.m4a.part", 3600)  # interrupted, may still be resumed
+        partial("youtube-old-140.m4a.part", 2 * 24 * 3600)
+        partial("youtube-held-140.m4a", 3600)
+        with store.claim_partial("youtube-held-140"):
+            store.sweep_partials(force=True)
+            assert sorted(os.listdir(store.partial_dir)) == [
+                "youtube-cut-140.m4a.part", "youtube-held-140.lock", "youtube-held-140.m4a", "youtube-new-140.m4a"
+            ]
+
+
+def test_stores_sharing_a_directory_keep_their_tmp_files_and_one_budget():
+    with tempfile.TemporaryDirectory() as root:
+        first = AudioStore(root, max_bytes=250, grace_seconds=0)
+        first.load()
+        pending = write_temp(first, b"downloading")
+        first.put("ym:1", write_temp(first, b"a" * 100))
+        first.put("ym:2", write_temp(first, b"b" * 100))
+
+        second = AudioStore(root, max_bytes=250, grace_seconds=0)
+        second.load()
+        assert os.path.exists(pending)
+        assert second.get("ym:1") is not None
+
+        second._next_rescan = 0.0
+        second.put("ym:3", write_temp(second, b"c" * 100))
+        assert second.stats()['files'] == 2 and second.stats()['bytes'] == 200
+
+        first.close()
+        third = AudioStore(root, max_bytes=250)
+        third.load()
+        assert not os.path.exists(first.tmp_dir) and not os.path.exists(f"{first.tmp_dir}.lock")
+        assert os.path.exists(second.tmp_dir)
+        second.close()
+        third.close()
+
+
+if __name__ == "__main__":
+    test_put_and_get_by_key()
+    test_equal_names_do_not_collide_and_equal_content_is_stored_once()
+    test_discarded_file_is_deleted_once_no_key_refers_to_it()
+    test_lru_eviction_keeps_recently_used_files()
+    test_lfu_eviction_keeps_frequently_used_files()
+    test_recently_used_files_survive_eviction()
+    test_index_is_rebuilt_from_disk()
+    test_partial_claim_is_exclusive_until_its_holder_is_gone()
+    test_sweep_removes_partials_nobody_will_come_back_for()
+    print("OK")
+    test_stores_sharing_a_directory_keep_their_tmp_files_and_one_budget()
@@ -0,0 +1,132 @@
+import asyncio
+import os
+import tempfile
+import time
+
+import database
+
+
+def run_with_db(scenario):
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database.DB_PATH = os.path.join(tmp_dir, "bot_data.db")
+            await database.init_db()
+            try:
+                await scenario()
+            finally:
+                await database.close_db()
+
+    asyncio.run(run())
+
+
+async def query_plan(sql: str, params: tuple) -> str:
+    db = await database._conn()
+    async with db.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+        return " ".join(row['detail'] for row in await cursor.fetchall())
+
+
+def test_bulk_grant_and_revoke():
+    async def scenario():
+        for user_id in range(1, 6):
+            await database.get_user(user_id, f"user{user_id}")
+
+        assert await database.adjust_free_downloads([1, 2, "@user3", "user4", "nobody"], 5) == 4
+        assert [(await database.get_user(i))['free_downloads'] for i in range(1, 6)] == [6, 6, 6, 6, 1]
+
+        # Revoking never goes below zero
+        assert await database.adjust_free_downloads([1, "user5"], -3) == 2
+        assert (await database.get_user(1))['free_downloads'] == 3
+        assert (await database.find_user("@user5"))['free_downloads'] == 0
+
+    run_with_db(scenario)
+
+
+def test_lookups_by_username_and_user_history_use_indexes():
+    async def scenario():
+        assert "idx_users_username" in await query_plan("SELECT * FROM users WHERE username = ?", ("x",))
+        assert "idx_job_history_user" in await query_plan(
+            "SELECT * FROM job_history WHERE user_id = ? ORDER BY finished_at DESC LIMIT 10", (1,)
+        )
+
+    run_with_db(scenario)
+
+
+def test_admin_stats_come_from_hourly_aggregates():
+    async def scenario():
+        for outcome in ("ok", "ok", "ok", "download_failed"):
+            database.record_job(1, "Artist - Title", outcome, 2.0)
+        database.record_stat("stars", 3)
+        database.record_stat("stars", 3)
+        database.record_stat("stars_refunded", 3)
+        for _ in range(3):
+            database.record_track_request("ym:2")
+        database.record_track_request("ym:1")
+        await database.save_cached_audio("ym:2", "file-2", "Title", "Artist")
+
+        history = await database.get_user_history(1)
+        assert len(history) == 4 and history[0]['query'] == "Artist - Title"
+
+        # Stats don't read the history
+        db = await database._conn()
+        await db.execute("DELETE FROM job_history")
+        stats = await database.get_admin_stats(hours=24)
+        assert stats['jobs'] == 4
+        assert stats['failure_rate'] == 0.25 and stats['failures'] == {"download_failed": 1}
+        assert (stats['stars'], stats['stars_refunded']) == (6, 3)
+        assert [(track['cache_key'], track['requests'], track['title']) for track in stats['top_tracks']] == [
+            ("ym:2", 3, "Title"), ("ym:1", 1, None)
+        ]
+
+    run_with_db(scenario)
+
+
+def test_top_tracks_are_those_of_the_window():
+    async def scenario():
+        database.record_track_request("ym:1")
+        await database.flush_writes()
+        db = await database._conn()
+        # Popular two days ago only
+        await db.execute(
+            "INSERT INTO hourly_track_requests (hour, cache_key, requests) VALUES (?, ?, ?)",
+            (int(time.time() // 3600) - 48, "ym:2", 10)
+        )
+        await db.commit()
+
+        assert [track['cache_key'] for track in (await database.get_admin_stats(hours=24))['top_tracks']] == ["ym:1"]
+        assert [(track['cache_key'], track['requests']) for track in (await database.get_admin_stats(hours=72))['top_tracks']] == [
+            ("ym:2", 10), ("ym:1", 1)
+        ]
+
+    run_with_db(scenario)
+
+
+def test_failed_flush_keeps_batched_counts():
+    async def scenario():
+        database.record_job(1, "Artist - Title", "ok", 2.0)
+        database.record_stat("stars", 3)
+        database.record_track_request("ym:1")
+        db = await database._conn()
+        await db.execute("ALTER TABLE hourly_stats RENAME TO hourly_stats_away")
+        try:
+            await database.flush_writes()
+        except Exception:
+            pass
+        else:
+            raise AssertionError("flush should have failed")
+        await db.execute("ALTER TABLE hourly_stats_away RENAME TO hourly_stats")
+
+        stats = await database.get_admin_stats(hours=24)
+        assert (stats['jobs'], stats['stars']) == (1, 3)
+        assert [track['requests'] for track in stats['top_tracks']] == [1]
+        assert len(await database.get_user_history(1)) == 1
+
+    run_with_db(scenario)
+
+
+if __name__ == "__main__":
+    test_bulk_grant_and_revoke()
+    test_lookups_by_username_and_user_history_use_indexes()
+    test_admin_stats_come_from_hourly_aggregates()
+    test_top_tracks_are_those_of_the_window()
+    test_failed_flush_keeps_batched_counts()
+    print("OK")
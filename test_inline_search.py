@@ -0,0 +1,70 @@
+import asyncio
+
+from inline_search import InlineSearch
+
+CATALOG = [
+    {'track_id': '1', 'artist': 'Кино', 'title': 'Группа крови'},
+    {'track_id': '2', 'artist': 'Кино', 'title': 'Кукушка'},
+    {'track_id': '3', 'artist': 'Linkin Park', 'title': 'Numb'},
+]
+
+
+class SlowSearch:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = []
+
+    async def __call__(self, text: str) -> list:
+        self.calls.append(text)
+        await asyncio.sleep(self.latency)
+        return [track for track in CATALOG if all(part in f"{track['artist']} {track['title']}".lower() for part in text.split())]
+
+
+def test_results_are_memoized():
+    async def run():
+        backend = SlowSearch(0.01)
+        search = InlineSearch(backend, budget=0.3, debounce=0)
+        first = await search.query(1, "Кино")
+        second = await search.query(2, "  кино ")
+        assert first == second == (CATALOG[:2], True)
+        assert backend.calls == ["кино"]
+
+    asyncio.run(run())
+
+
+def test_superseded_keystrokes_are_dropped():
+    async def run():
+        backend = SlowSearch(0.01)
+        search = InlineSearch(backend, budget=0.3, debounce=0.05)
+        results = await asyncio.gather(search.query(1, "lin"), search.query(1, "link"))
+        assert results[0] is None
+        assert results[1] == ([CATALOG[2]], True)
+        assert backend.calls == ["link"]
+
+    asyncio.run(run())
+
+
+def test_slow_backend_gets_partial_answer_from_prefix():
+    async def run():
+        backend = SlowSearch(0.2)
+        search = InlineSearch(backend, budget=0.1, debounce=0)
+        search.results.set("кино", CATALOG[:2])
+
+        started = asyncio.get_running_loop().time()
+        tracks, complete = await search.query(1, "кино ку")
+        assert asyncio.get_running_loop().time() - started < 0.15
+        assert not complete
+        assert tracks == [CATALOG[1]]
+
+        # The search kept running and the next identical keystroke is served from cache
+        await asyncio.sleep(0.15)
+        assert await search.query(1, "кино ку") == ([CATALOG[1]], True)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_results_are_memoized()
+    test_superseded_keystrokes_are_dropped()
+    test_slow_backend_gets_partial_answer_from_prefix()
+    print("OK")
@@ -0,0 +1,257 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from job_store import MemoryJobStore, SqliteJobStore
+
+LEASE = 0.5
+
+# Leases one job, reports it on stdout and then hangs as if stuck in a download
+WORKER_SCRIPT = """
+import asyncio, sys
+from job_store import SqliteJobStore
+
+async def run():
+    store = SqliteJobStore(sys.argv[1], lease_seconds=float(sys.argv[2]))
+    await store.open()
+    job = await store.lease("doomed-worker")
+    print(job['_id'], flush=True)
+    await asyncio.sleep(3600)
+
+asyncio.run(run())
+"""
+
+
+def job(user_id: int, query: str = "track") -> dict:
+    return {'chat_id': user_id, 'user_id': user_id, 'query': query}
+
+
+def test_killed_worker_job_is_redelivered_once():
+    async def run(path):
+        store = SqliteJobStore(path, lease_seconds=LEASE, retry_backoff=0)
+        await store.open()
+        job_id = await store.enqueue(job(1), idempotency_key="update:1")
+
+        worker = subprocess.Popen(
+            [sys.executable, "-c", WORKER_SCRIPT, path, str(LEASE)],
+            stdout=subprocess.PIPE, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        leased_id = int(worker.stdout.readline())
+        worker.send_signal(signal.SIGKILL)
+        worker.wait()
+        assert leased_id == job_id
+
+        # Still leased by the dead worker
+        assert await store.lease("survivor-0") is None
+
+        await asyncio.sleep(LEASE * 1.5)
+        # Several workers race for the expired lease; exactly one gets it
+        leased = await asyncio.gather(*[store.lease(f"survivor-{i}") for i in range(5)])
+        delivered = [j for j in leased if j is not None]
+        assert len(delivered) == 1
+        assert delivered[0]['_id'] == job_id
+        assert delivered[0]['_attempts'] == 2
+
+        winner = next(f"survivor-{i}" for i, j in enumerate(leased) if j is not None)
+        assert await store.complete(job_id, winner)
+        await asyncio.sleep(LEASE * 1.5)
+        assert await store.lease("survivor-0") is None
+        # The killed worker's lease is gone for good
+        assert not await store.complete(job_id, "doomed-worker")
+        await store.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(os.path.join(tmp_dir, "jobs.db")))
+
+
+def test_failed_jobs_back_off_and_give_up():
+    async def run(path):
+        store = SqliteJobStore(path, max_attempts=2, retry_backoff=0.2)
+        await store.open()
+        job_id = await store.enqueue(job(1))
+
+        first = await store.lease("w")
+        assert await store.fail(job_id, "w", "boom")
+        assert await store.lease("w") is None  # backing off
+        await asyncio.sleep(0.3)
+        second = await store.lease("w")
+        assert (first['_attempts'], second['_attempts']) == (1, 2)
+        assert await store.fail(job_id, "w", "boom again") is False
+        await asyncio.sleep(0.5)
+        assert await store.lease("w") is None
+        await store.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(os.path.join(tmp_dir, "jobs.db")))
+
+
+def test_memory_store_backs_off_like_sqlite():
+    async def run():
+        store = MemoryJobStore(max_attempts=2, retry_backoff=0.2)
+        job_id = await store.enqueue(job(1))
+        await store.lease("w")
+        assert await store.fail(job_id, "w", "boom")
+        assert await store.lease("w") is None  # backing off
+        await asyncio.sleep(0.3)
+        assert (await store.lease("w"))['_attempts'] == 2
+
+    asyncio.run(run())
+
+
+def test_job_whose_holders_died_is_handed_out_dead_once():
+    async def run(path):
+        store = SqliteJobStore(path, lease_seconds=0.1, max_attempts=2)
+        await store.open()
+        job_id = await store.enqueue(job(1))
+        for attempt in (1, 2):
+            leased = await store.lease(f"doomed-{attempt}")
+            assert leased['_attempts'] == attempt and '_dead' not in leased
+            await asyncio.sleep(0.15)
+
+        # Given to one more worker only so it can refund the job
+        leased = await store.lease("w")
+        assert leased['_id'] == job_id and leased['_dead']
+        await asyncio.sleep(0.15)
+        assert await store.lease("w") is None
+        await store.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(os.path.join(tmp_dir, "jobs.db")))
+
+
+def test_ended_jobs_are_purged():
+    async def run(path):
+        store = SqliteJobStore(path, retention_days=0)
+        await store.open()
+        done = await store.enqueue(job(1), idempotency_key="update:1")
+        await store.enqueue(job(2), idempotency_key="update:2")
+        await store.lease("w")
+        await store.complete(done, "w")
+        await store.purge()
+        assert not await store.seen("update:1")
+        assert await store.seen("update:2")  # still queued
+        await store.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(os.path.join(tmp_dir, "jobs.db")))
+
+
+def test_duplicate_updates_are_enqueued_once():
+    async def run(store):
+        await store.open()
+        assert await store.enqueue(job(1), idempotency_key="update:7") is not None
+        assert await store.enqueue(job(1), idempotency_key="update:7") is None
+        assert await store.seen("update:7")
+        assert not await store.seen("update:8")
+        assert await store.pending_count() == 1
+        await store.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(SqliteJobStore(os.path.join(tmp_dir, "jobs.db"))))
+    asyncio.run(run(MemoryJobStore()))
+
+
+def test_users_are_served_round_robin():
+    async def run(path):
+        store = SqliteJobStore(path, maxsize=5)
+        await store.open()
+        for i in range(3):
+            await store.enqueue(job(1, f"heavy-{i}"))
+        await store.enqueue(job(2, "light"))
+        assert [j['query'] for j in await store.pending_jobs(10)] == ["heavy-0", "light", "heavy-1", "heavy-2"]
+
+        await store.enqueue(job(3))
+        try:
+            await store.enqueue(job(3))
+            assert False, "expected QueueFull"
+        except asyncio.QueueFull:
+            pass
+        assert await store.enqueue(job(3), force=True) is not None
+        await store.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(os.path.join(tmp_dir, "jobs.db")))
+
+
+def test_user_jobs_stay_in_order_after_some_are_done():
+    async def run(path):
+        store = SqliteJobStore(path)
+        await store.open()
+        for i in range(6):
+            await store.enqueue(job(1, f"A{i}"))
+        for _ in range(3):
+            leased = await store.lease("worker")
+            assert await store.complete(leased['_id'], "worker")
+        await store.enqueue(job(1, "A-new"))
+        await store.enqueue(job(2, "B0"))
+
+        order = []
+        while (leased := await store.lease("worker")) is not None:
+            order.append(leased['query'])
+        assert order == ["A3", "B0", "A4", "A5", "A-new"]
+        await store.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(os.path.join(tmp_dir, "jobs.db")))
+
+
+def test_owned_jobs_wait_for_their_owner():
+    async def run(path):
+        store = SqliteJobStore(path, owner_wait=0.3)
+        await store.open()
+        job_id = await store.enqueue(job(1), owner="owner")
+        assert await store.lease("other") is None
+        assert (await store.lease("owner"))['_id'] == job_id
+
+        # The owner may be gone; after a while anyone takes its jobs
+        job_id = await store.enqueue(job(1), owner="owner")
+        await asyncio.sleep(0.4)
+        assert (await store.lease("other"))['_id'] == job_id
+        await store.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(os.path.join(tmp_dir, "jobs.db")))
+
+
+def test_cancelled_jobs_are_not_handed_out():
+    async def run(store):
+        await store.open()
+        running = await store.enqueue(job(1, "running"))
+        queued = await store.enqueue(job(1, "queued"))
+        await store.enqueue(job(2, "other"))
+        assert await store.cancel(running, user_id=2) is None  # not that user's job
+        assert (await store.lease("w"))['_id'] == running
+        assert (await store.cancel(running, user_id=1))['_state'] == "leased"
+        assert (await store.cancel(queued, user_id=1))['_state'] == "queued"
+        assert await store.cancel(queued, user_id=1) is None
+        assert await store.is_cancelled(running) and await store.is_cancelled(queued)
+
+        # The worker holding the cancelled job has lost it
+        assert not await store.extend(running, "w")
+        assert not await store.complete(running, "w")
+        assert [j['query'] for j in await store.pending_jobs(10)] == ["other"]
+        assert (await store.lease("w"))['query'] == "other"
+        await store.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(SqliteJobStore(os.path.join(tmp_dir, "jobs.db"))))
+    asyncio.run(run(MemoryJobStore()))
+
+
+if __name__ == "__main__":
+    started = time.perf_counter()
+    test_killed_worker_job_is_redelivered_once()
+    test_failed_jobs_back_off_and_give_up()
+    test_memory_store_backs_off_like_sqlite()
+    test_job_whose_holders_died_is_handed_out_dead_once()
+    test_ended_jobs_are_purged()
+    test_duplicate_updates_are_enqueued_once()
+    test_users_are_served_round_robin()
+    test_user_jobs_stay_in_order_after_some_are_done()
+    test_owned_jobs_wait_for_their_owner()
+    test_cancelled_jobs_are_not_handed_out()
+    print(f"OK in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,347 @@
+import asyncio
+import os
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, SendAudio, SendMediaGroup, SendMessage
+from aiogram.types import CallbackQuery, Chat, Message, User
+
+import bench_offline
+import database
+import main
+import metrics
+from job_store import SqliteJobStore
+from stubs import offline_bot
+
+
+def run_offline(scenario, **kwargs):
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            async with offline_bot(tmp_dir, **kwargs) as (server, session):
+                await scenario(server, session)
+
+    asyncio.run(run())
+
+
+async def run_workers_until(done, workers: int = 3):
+    tasks = [asyncio.create_task(main.download_worker(i)) for i in range(workers)]
+    try:
+        for _ in range(200):
+            if done():
+                return
+            await asyncio.sleep(0.05)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def press_cancel(data: str, user_id: int = 1):
+    callback = CallbackQuery(
+        id="1", from_user=User(id=user_id, is_bot=False, first_name="User"), chat_instance="1", data=data
+    )
+    await main.on_cancel(callback.as_(main.bot))
+
+
+async def wait_for(condition, timeout: float = 10):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError("timed out")
+
+
+def test_track_link_is_downloaded_once_then_served_from_cache():
+    async def scenario(server, session):
+        assert await main.process_track_download(1, "https://music.yandex.ru/album/9/track/1003", 10, True)
+        sent = session.sent_audio()
+        assert len(sent) == 1 and isinstance(sent[0], SendAudio)
+        assert (sent[0].performer, sent[0].title) == ("Земфира", "Хочешь?")
+        assert server.requests['track.jsx'] == 1 and server.requests['files'] == 1
+        assert server.audio_bytes_sent == len(server.audio)
+        assert await database.get_cached_audio("ym:1003")
+
+        assert await main.process_track_download(2, "https://music.yandex.ru/track/1003", 11, True)
+        assert len(session.sent_audio()) == 2
+        assert server.requests['files'] == 1
+
+    run_offline(scenario)
+
+
+def test_text_query_is_matched_on_the_video_site():
+    async def scenario(server, session):
+        assert await main.process_track_download(1, "Miyagi Captain", 10, False)
+        assert server.requests['search'] == 2  # YouTube and SoundCloud
+        assert server.requests['track.jsx'] == 0
+        assert server.requests['files'] == 1
+
+    run_offline(scenario)
+
+
+def test_stale_file_id_is_replaced_and_the_job_counts_as_delivered():
+    async def scenario(server, session):
+        url = "https://music.yandex.ru/track/1003"
+        await database.save_cached_audio(main.make_cache_key(url, True), "stale", "Title", "Artist")
+        session.rejected_file_ids.add("stale")
+        metrics.recent_traces.clear()
+        job_id = await main.job_store.enqueue(main.make_job(1, url, 10, 1))
+        traces = lambda: [trace for trace in metrics.recent_traces if trace.attrs['job_id'] == job_id]
+        await run_workers_until(traces)
+        assert server.requests['files'] == 1
+        assert [method.audio != "stale" for method in session.sent_audio()] == [False, True]
+        (trace,) = traces()
+        assert trace.outcome == "ok" and trace.attrs['recovered'] == ["stale_file_id"]
+
+    run_offline(scenario)
+
+
+def test_retried_job_is_recorded_once():
+    async def scenario(server, session):
+        server.cut_after_bytes = len(server.audio) // 2
+        await main.job_store.enqueue(main.make_job(1, "https://music.yandex.ru/track/1003", 10, 1))
+        metrics.recent_traces.clear()
+        await run_workers_until(lambda: len(metrics.recent_traces) == 2)
+        assert [trace.outcome for trace in metrics.recent_traces] == ["DownloadInterrupted", "ok"]
+        assert [job['outcome'] for job in await database.get_user_history(1)] == ["ok"]
+        stats = await database.get_admin_stats(hours=1)
+        assert stats['jobs'] == 1 and stats['failure_rate'] == 0
+
+    run_offline(scenario)
+
+
+def test_source_fetched_by_another_job_is_reused():
+    async def scenario(server, session):
+        url = "https://music.yandex.ru/track/1003"
+        # Two qualities of one track need the same source file
+        assert all(await asyncio.gather(
+            main.process_track_download(1, url, 10, True, "standard"),
+            main.process_track_download(2, url, 20, True, "low"),
+        ))
+        assert server.requests['files'] == 1
+        assert len(session.sent_audio()) == 2
+
+    run_offline(scenario, latency={'bandwidth_bytes_per_second': 256 * 1024})
+
+
+def test_album_is_sent_as_one_media_group():
+    async def scenario(server, session):
+        await main.job_store.enqueue(main.make_job(1, "https://music.yandex.ru/album/300", 10, 1))
+        await run_workers_until(lambda: session.sent_audio() and not main.active_batches)
+        groups = [method for method in session.requests if isinstance(method, SendMediaGroup)]
+        assert len(groups) == 1 and len(groups[0].media) == 4
+        assert server.requests['album.jsx'] == 1 and server.requests['files'] == 4
+
+    run_offline(scenario)
+
+
+def test_interrupted_album_track_is_retried_into_the_same_group():
+    async def scenario(server, session):
+        server.cut_after_bytes = len(server.audio) // 2
+        await main.job_store.enqueue(main.make_job(1, "https://music.yandex.ru/album/300", 10, 1))
+        await run_workers_until(lambda: session.sent_audio() and not main.active_batches)
+        groups = [method for method in session.requests if isinstance(method, SendMediaGroup)]
+        assert len(groups) == 1 and len(groups[0].media) == 4
+        assert server.requests['files'] == 5
+
+    run_offline(scenario)
+
+
+def test_album_with_a_track_taken_elsewhere_is_sent_without_it():
+    async def scenario(server, session):
+        await main.job_store.enqueue(main.make_job(1, "https://music.yandex.ru/album/300", 10, 1))
+        collection = await main.job_store.lease(main.WORKER_NAME)
+        assert await main.process_collection(collection)
+        # Another process took the first track and will send it on its own
+        taken = await main.job_store.lease("other-process")
+        assert taken['index'] == 0
+        await run_workers_until(lambda: not main.active_batches)
+        groups = [method for method in session.requests if isinstance(method, SendMediaGroup)]
+        assert len(groups) == 1 and len(groups[0].media) == 3
+
+    saved = main.BATCH_STALL_SECONDS, main.BATCH_CHECK_INTERVAL
+    main.BATCH_STALL_SECONDS, main.BATCH_CHECK_INTERVAL = 2.0, 0.1
+    try:
+        run_offline(scenario)
+    finally:
+        main.BATCH_STALL_SECONDS, main.BATCH_CHECK_INTERVAL = saved
+
+
+def test_album_with_no_track_sent_is_refunded():
+    async def scenario(server, session):
+        free_downloads = (await database.get_user(1, "user"))['free_downloads']
+        # The album is listed, but none of its tracks can be found on the video site
+        server.catalog['tracks'] = []
+        await main.job_store.enqueue(main.make_job(1, "https://music.yandex.ru/album/300", 10, 1, charge="free"))
+
+        def refunds():
+            return [method for method in session.requests if isinstance(method, SendMessage) and method.text.startswith("↩️")]
+
+        await run_workers_until(lambda: refunds() and not main.running_jobs)
+
+        assert session.sent_audio() == []
+        assert (await database.get_user(1))['free_downloads'] == free_downloads + 1
+        assert len(refunds()) == 1 and not main.active_batches
+
+    run_offline(scenario)
+
+
+def test_cancelled_queued_job_never_runs_and_is_refunded():
+    async def scenario(server, session):
+        free_downloads = (await database.get_user(1, "user"))['free_downloads']
+        job_id = await main.job_store.enqueue(main.make_job(1, "https://music.yandex.ru/track/1003", 10, 1, charge="free"))
+        await press_cancel(f"cancel:{job_id}")
+        # Someone else's button does nothing
+        await press_cancel(f"cancel:{job_id}", user_id=2)
+        worker = asyncio.create_task(main.download_worker(0))
+        await asyncio.sleep(0.3)
+        worker.cancel()
+
+        assert server.requests['track.jsx'] == 0 and server.requests['files'] == 0
+        assert (await database.get_user(1))['free_downloads'] == free_downloads + 1
+        edits = [method for method in session.requests if isinstance(method, EditMessageText)]
+        assert edits[-1].text == main.CANCELLED_TEXT
+        answers = [method.text for method in session.requests if isinstance(method, AnswerCallbackQuery)]
+        assert answers == ["Отменено.", "Уже нельзя отменить."]
+
+    run_offline(scenario)
+
+
+def test_cancelled_running_job_stops_its_download_and_is_refunded():
+    async def scenario(server, session):
+        free_downloads = (await database.get_user(1, "user"))['free_downloads']
+        job_id = await main.job_store.enqueue(main.make_job(1, "https://music.yandex.ru/track/1003", 10, 1, charge="free"))
+        workers = [asyncio.create_task(main.download_worker(0))]
+        try:
+            await wait_for(lambda: server.audio_bytes_sent > 0)
+            await press_cancel(f"cancel:{job_id}")
+            await wait_for(lambda: not main.running_jobs)
+            # Long enough for the whole file, had the fetch thread gone on
+            await asyncio.sleep(len(server.audio) / (64 * 1024))
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+        assert server.audio_bytes_sent < len(server.audio)
+        assert session.sent_audio() == []
+        assert (await database.get_user(1))['free_downloads'] == free_downloads + 1
+        edits = [method for method in session.requests if isinstance(method, EditMessageText)]
+        assert edits[-1].text == main.CANCELLED_TEXT
+        assert any(isinstance(method, SendMessage) and method.text.startswith("↩️") for method in session.requests)
+
+    run_offline(scenario, latency={'bandwidth_bytes_per_second': 64 * 1024})
+
+
+def test_job_given_up_after_lost_leases_is_refunded():
+    async def scenario(server, session):
+        free_downloads = (await database.get_user(1, "user"))['free_downloads']
+        store = main.job_store = SqliteJobStore(database.DB_PATH, lease_seconds=0.1, max_attempts=1)
+        await store.open()
+        try:
+            await store.enqueue(main.make_job(1, "https://music.yandex.ru/track/1003", 10, 1, charge="free"))
+            await store.lease("crashed-worker")
+            await asyncio.sleep(0.15)
+            worker = asyncio.create_task(main.download_worker(0))
+            await wait_for(lambda: any(isinstance(method, EditMessageText) for method in session.requests))
+            worker.cancel()
+        finally:
+            await store.close()
+
+        assert server.requests['track.jsx'] == 0
+        assert (await database.get_user(1))['free_downloads'] == free_downloads + 1
+        edits = [method for method in session.requests if isinstance(method, EditMessageText)]
+        assert edits[-1].text == main.FAILED_TEXT
+        assert [job['outcome'] for job in await database.get_user_history(1)] == ["lease_expired"]
+
+    run_offline(scenario)
+
+
+def test_cancelled_album_stops_its_track_jobs():
+    async def scenario(server, session):
+        await main.job_store.enqueue(main.make_job(1, "https://music.yandex.ru/album/300", 10, 1))
+        workers = [asyncio.create_task(main.download_worker(i)) for i in range(2)]
+        try:
+            await wait_for(lambda: server.audio_bytes_sent > 0)
+            (batch,) = main.active_batches.values()
+            button = batch.keyboard.inline_keyboard[0][0]
+            await press_cancel(button.callback_data)
+            await wait_for(lambda: not main.running_jobs)
+            # Long enough for both running downloads to finish, had their fetch threads gone on
+            await asyncio.sleep(len(server.audio) / (64 * 1024) + 0.5)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        assert await main.job_store.pending_count() == 0
+        assert server.audio_bytes_sent < 2 * len(server.audio)
+        assert session.sent_audio() == []
+        edits = [method for method in session.requests if isinstance(method, EditMessageText)]
+        assert edits[-1].text.startswith("🚫") and edits[-1].reply_markup is None
+        answers = [method for method in session.requests if isinstance(method, AnswerCallbackQuery)]
+        assert [answer.text for answer in answers] == ["Отменено."]
+
+    run_offline(scenario, latency={'bandwidth_bytes_per_second': 64 * 1024})
+
+
+def test_oversized_track_is_rejected_before_any_download():
+    async def scenario(server, session):
+        assert not await main.process_track_download(1, "https://music.yandex.ru/track/2000", 10, True)
+        assert server.requests['search'] == 0 and server.requests['files'] == 0
+        edits = [method for method in session.requests if isinstance(method, EditMessageText)]
+        assert edits[-1].text == main.TOO_LARGE_TEXT
+
+    run_offline(scenario)
+
+
+def test_cache_drop_removes_every_quality_of_a_track():
+    async def scenario(server, session):
+        store = main.ym_handler.audio_store
+        for cache_key in ("ym:1003", "ym:1003@low"):
+            await database.save_cached_audio(cache_key, f"file-{cache_key}")
+            path = store.temp_path(".mp3")
+            with open(path, "wb") as f:
+                f.write(cache_key.encode())
+            store.put(cache_key, path)
+
+        message = Message(
+            message_id=1, date=0, chat=Chat(id=1, type="private"),
+            from_user=User(id=1, is_bot=False, first_name="Admin", username="exsslx"),
+            text="/cache drop https://music.yandex.ru/track/1003",
+        )
+        await main.cache_command(message.as_(main.bot))
+
+        for cache_key in ("ym:1003", "ym:1003@low"):
+            assert await database.get_cached_audio(cache_key) is None
+            assert store.get(cache_key) is None
+        replies = [method.text for method in session.requests if isinstance(method, SendMessage)]
+        assert replies == ["🗑 Удалено из кэша: ym:1003"]
+
+    run_offline(scenario)
+
+
+def test_pipeline_has_not_regressed():
+    # Timings depend on the machine, so they are only compared with BENCH_TIMING=1 where the baseline was recorded
+    jobs, concurrency = 16, 4
+    baseline = bench_offline.load_baseline()[bench_offline.baseline_key(jobs, concurrency)]
+    result = asyncio.run(bench_offline.run_benchmark(jobs, concurrency))
+    assert result['downloads'] <= baseline['downloads']
+    if os.getenv("BENCH_TIMING") == "1":
+        assert not bench_offline.find_regressions(result, baseline)
+
+
+if __name__ == "__main__":
+    test_track_link_is_downloaded_once_then_served_from_cache()
+    test_text_query_is_matched_on_the_video_site()
+    test_stale_file_id_is_replaced_and_the_job_counts_as_delivered()
+    test_retried_job_is_recorded_once()
+    test_source_fetched_by_another_job_is_reused()
+    test_album_is_sent_as_one_media_group()
+    test_interrupted_album_track_is_retried_into_the_same_group()
+    test_album_with_a_track_taken_elsewhere_is_sent_without_it()
+    test_album_with_no_track_sent_is_refunded()
+    test_cancelled_queued_job_never_runs_and_is_refunded()
+    test_cancelled_running_job_stops_its_download_and_is_refunded()
+    test_job_given_up_after_lost_leases_is_refunded()
+    test_cancelled_album_stops_its_track_jobs()
+    test_oversized_track_is_rejected_before_any_download()
+    test_cache_drop_removes_every_quality_of_a_track()
+    test_pipeline_has_not_regressed()
+    print("OK")
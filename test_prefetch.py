@@ -0,0 +1,111 @@
+import asyncio
+import os
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import database
+import main
+import metrics
+from prefetch import Prefetcher
+from stubs import offline_bot
+
+
+async def never_busy():
+    return False
+
+
+def run_offline(scenario, **kwargs):
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            async with offline_bot(tmp_dir, **kwargs) as (server, session):
+                await scenario(server, session)
+
+    asyncio.run(run())
+
+
+def test_most_requested_track_is_prefetched_and_then_served_without_download():
+    async def scenario(server, session):
+        for _ in range(3):
+            database.record_track_request("ym:1003")
+        database.record_track_request("ym:1004")
+        prefetcher = Prefetcher(main.ym_handler, never_busy, top_k=1)
+
+        assert await prefetcher.run_once() == 1
+        assert server.requests['files'] == 1
+        assert main.ym_handler.audio_store.contains("ym:1003")
+        assert not main.ym_handler.audio_store.contains("ym:1004")
+        # Already on disk: nothing left to do
+        assert await prefetcher.run_once() == 0
+
+        served_from_disk = metrics.served_counts.get("disk", 0)
+        assert await main.process_track_download(1, "https://music.yandex.ru/track/1003", 10, True)
+        assert server.requests['files'] == 1
+        assert metrics.served_counts["disk"] == served_from_disk + 1
+
+    run_offline(scenario)
+
+
+def test_chart_tracks_are_prefetched_after_popular_ones():
+    async def scenario(server, session):
+        database.record_track_request("ym:1010")
+        prefetcher = Prefetcher(main.ym_handler, never_busy, top_k=2, chart_url="https://music.yandex.ru/album/300")
+
+        assert await prefetcher.candidates() == ["ym:1010", "ym:1000", "ym:1001"]
+        assert await prefetcher.run_once() == 3
+        assert server.requests['files'] == 3
+
+    run_offline(scenario)
+
+
+def test_prefetch_stops_when_user_jobs_arrive():
+    async def scenario(server, session):
+        database.record_track_request("ym:1003")
+        checks = []
+
+        async def busy_after_start():
+            checks.append(True)
+            return len(checks) > 2
+
+        prefetcher = Prefetcher(main.ym_handler, busy_after_start, top_k=5)
+        assert await prefetcher.run_once() == 0
+        assert not main.ym_handler.audio_store.contains("ym:1003")
+
+    run_offline(scenario)
+
+
+def test_stopped_prefetch_stops_its_download():
+    async def scenario(server, session):
+        database.record_track_request("ym:1003")
+
+        async def busy_once_downloading():
+            return server.audio_bytes_sent > 0
+
+        prefetcher = Prefetcher(main.ym_handler, busy_once_downloading, top_k=1)
+        assert await prefetcher.run_once() == 0
+        stopped_at = server.audio_bytes_sent
+        # Long enough for the whole file at the server's bandwidth
+        await asyncio.sleep(len(server.audio) / (64 * 1024) + 1)
+        assert server.audio_bytes_sent <= stopped_at + 64 * 1024 < len(server.audio)
+        assert any(name.endswith(".part") for name in os.listdir(main.ym_handler.audio_store.partial_dir))
+
+    run_offline(scenario, latency={'bandwidth_bytes_per_second': 64 * 1024})
+
+
+def test_nothing_is_prefetched_over_budget():
+    async def scenario(server, session):
+        database.record_track_request("ym:1003")
+        assert await Prefetcher(main.ym_handler, never_busy, bytes_per_hour=0).run_once() == 0
+        assert await Prefetcher(main.ym_handler, never_busy, disk_share=0).run_once() == 0
+        assert server.requests['track.jsx'] == 0 and server.requests['files'] == 0
+
+    run_offline(scenario)
+
+
+if __name__ == "__main__":
+    test_most_requested_track_is_prefetched_and_then_served_without_download()
+    test_chart_tracks_are_prefetched_after_popular_ones()
+    test_prefetch_stops_when_user_jobs_arrive()
+    test_stopped_prefetch_stops_its_download()
+    test_nothing_is_prefetched_over_budget()
+    print("OK")
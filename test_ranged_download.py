@@ -0,0 +1,104 @@
+import asyncio
+import os
+import tempfile
+
+from job_control import JobCancelled, JobControl, current_job, run_in_executor
+from logic import is_transfer_interruption
+from ranged_download import RangeNotSupported, download_ranged
+from stubs import CatalogServer, load_catalog
+
+CHUNK = 32 * 1024
+
+
+def run_with_server(scenario, **latency):
+    async def run():
+        server = CatalogServer(load_catalog(), latency)
+        await server.start()
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                await scenario(server, os.path.join(tmp_dir, "track.m4a"))
+        finally:
+            await server.close()
+
+    asyncio.run(run())
+
+
+def download(server: CatalogServer, path: str, **kwargs):
+    url = f"{server.base_url}/files/1003.m4a"
+    return run_in_executor(None, lambda: download_ranged(url, path, chunk_bytes=CHUNK, **kwargs))
+
+
+def test_download_is_split_into_ranges():
+    async def scenario(server, path):
+        assert await download(server, path, connections=4) == len(server.audio)
+        with open(path, "rb") as f:
+            assert f.read() == server.audio
+        # One request to learn the size, then one per chunk
+        assert server.requests['ranges'] == 1 + len(server.audio) // CHUNK
+        assert not os.path.exists(f"{path}.part") and not os.path.exists(f"{path}.parts")
+
+    run_with_server(scenario)
+
+
+def test_cut_transfer_resumes_from_the_partial_file():
+    async def scenario(server, path):
+        size = len(server.audio)
+        server.cut_after_bytes = size // 2
+        try:
+            await download(server, path, size=size, connections=1)
+        except OSError as e:
+            assert is_transfer_interruption(e)
+        else:
+            raise AssertionError("the transfer should have been cut")
+        assert os.path.exists(f"{path}.part")
+        sent_before = server.audio_bytes_sent
+
+        assert await download(server, path, size=size, connections=2) == size
+        with open(path, "rb") as f:
+            assert f.read() == server.audio
+        # Only the chunks that were missing came again
+        assert server.audio_bytes_sent - sent_before <= size - size // 2 + CHUNK
+
+    run_with_server(scenario)
+
+
+def test_server_without_ranges_is_reported():
+    async def scenario(server, path):
+        url = f"{server.base_url}/watch/1003"  # answers 200 to a Range request
+        try:
+            await run_in_executor(None, download_ranged, url, path)
+            assert False, "expected RangeNotSupported"
+        except RangeNotSupported:
+            pass
+        assert os.listdir(os.path.dirname(path)) == []
+
+    run_with_server(scenario)
+
+
+def test_cancelled_job_stops_the_download():
+    async def scenario(server, path):
+        control = JobControl(1)
+        current_job.set(control)
+        fetch = download(server, path, size=len(server.audio), connections=2)
+        while control.downloaded == 0:
+            await asyncio.sleep(0.05)
+        assert control.total == len(server.audio)
+        control.cancel()
+        try:
+            await fetch
+            assert False, "expected JobCancelled"
+        except JobCancelled:
+            pass
+        assert server.audio_bytes_sent < len(server.audio)
+        # What was downloaded is kept for a retry
+        assert os.path.exists(f"{path}.part")
+
+    run_with_server(scenario, bandwidth_bytes_per_second=64 * 1024)
+
+
+if __name__ == "__main__":
+    test_download_is_split_into_ranges()
+    test_cut_transfer_resumes_from_the_partial_file()
+    test_server_without_ranges_is_reported()
+    test_cancelled_job_stops_the_download()
+    print("OK")
@@ -0,0 +1,113 @@
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+from aiogram import Bot
+from aiogram.types import Message
+
+import database
+import main
+from job_store import MemoryJobStore
+from rate_limit import MemoryTokenBuckets, RateLimitMiddleware, SqliteTokenBuckets
+from stubs import StubSession
+
+
+def text_message(bot: Bot, user_id: int, text: str = "song") -> Message:
+    return Message.model_validate({
+        'message_id': 1, 'date': int(time.time()), 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'},
+    }, context={"bot": bot})
+
+
+def test_sqlite_buckets_are_shared_between_processes():
+    async def run(path):
+        # Two connections to one file stand in for two worker processes
+        first, second = SqliteTokenBuckets(path), SqliteTokenBuckets(path)
+        await first.open()
+        await second.open()
+        assert await first.take("user:1", capacity=3, per_second=0.5) == 0
+        assert await second.take("user:1", capacity=3, per_second=0.5) == 0
+        assert await first.take("user:1", capacity=3, per_second=0.5) == 0
+        wait = await second.take("user:1", capacity=3, per_second=0.5)
+        assert 0 < wait <= 2
+        assert await first.take("user:2", capacity=3, per_second=0.5) == 0
+
+        await asyncio.sleep(wait)
+        assert await second.take("user:1", capacity=3, per_second=0.5) == 0
+        await first.close()
+        await second.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(os.path.join(tmp_dir, "jobs.db")))
+
+
+def test_middleware_limits_only_flagged_handlers():
+    async def run():
+        bot = Bot(token="123456:TEST", session=StubSession())
+        overloaded = False
+
+        async def is_overloaded():
+            return overloaded
+
+        middleware = RateLimitMiddleware(MemoryTokenBuckets(), is_overloaded)
+        handled = []
+
+        async def handler(event, data):
+            handled.append(event.from_user.id)
+
+        limited = {'handler': type("Handler", (), {'flags': {'rate_limit': True}})()}
+        free = {'handler': type("Handler", (), {'flags': {}})()}
+
+        for _ in range(10):
+            await middleware(handler, text_message(bot, 1), dict(limited))
+        assert handled.count(1) == 5  # USER_RATE_BURST
+        for _ in range(3):
+            await middleware(handler, text_message(bot, 1), dict(free))
+        assert handled.count(1) == 8
+
+        overloaded = True
+        await middleware(handler, text_message(bot, 2), dict(limited))
+        assert 2 not in handled
+
+    asyncio.run(run())
+
+
+def test_failed_download_refunds_free_quota():
+    async def run(tmp_dir):
+        database.DB_PATH = os.path.join(tmp_dir, "bot_data.db")
+        await database.init_db()
+        await database.get_user(7, "someone")
+        assert await database.try_consume_free_download(7) == 0
+
+        async def nothing_found(*args):
+            return False
+
+        saved = main.job_store, main.bot, main.process_track_download
+        main.job_store = MemoryJobStore()
+        main.bot = Bot(token="123456:TEST", session=StubSession())
+        main.process_track_download = nothing_found
+        try:
+            await main.job_store.enqueue(main.make_job(7, "song", 10, 7, charge="free"))
+            worker = asyncio.create_task(main.download_worker(0))
+            await asyncio.sleep(0.2)
+            worker.cancel()
+        finally:
+            main.job_store, main.bot, main.process_track_download = saved
+
+        user = await database.get_user(7)
+        assert user['free_downloads'] == 1
+        await database.close_db()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(tmp_dir))
+
+
+if __name__ == "__main__":
+    test_sqlite_buckets_are_shared_between_processes()
+    test_middleware_limits_only_flagged_handlers()
+    test_failed_download_refunds_free_quota()
+    print("OK")
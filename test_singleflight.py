@@ -0,0 +1,129 @@
+import asyncio
+import os
+import tempfile
+from types import SimpleNamespace
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import database
+import main
+from singleflight import CallCancelled, SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    async def run():
+        flight = SingleFlight()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return "file-id"
+
+        results = await asyncio.gather(*[flight.do("ym:1", fetch) for _ in range(10)])
+        assert calls == 1
+        assert all(result == "file-id" for result, _ in results)
+        assert sum(1 for _, shared in results if not shared) == 1
+        assert not flight.in_flight("ym:1")
+
+    asyncio.run(run())
+
+
+def test_errors_reach_every_waiter():
+    async def run():
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("boom")
+
+        results = await asyncio.gather(*[flight.do("ym:2", fail) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+    asyncio.run(run())
+
+
+def test_waiters_of_a_cancelled_call_get_call_cancelled():
+    async def run():
+        flight = SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(10)
+
+        leader = asyncio.create_task(flight.do("ym:3", slow))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(flight.do("ym:3", slow))
+        await asyncio.sleep(0)
+        leader.cancel()
+        results = await asyncio.gather(leader, waiter, return_exceptions=True)
+        assert isinstance(results[0], asyncio.CancelledError)
+        assert isinstance(results[1], CallCancelled)
+        assert not flight.in_flight("ym:3")
+
+    asyncio.run(run())
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_audio(self, chat_id, audio, title=None, performer=None):
+        self.sent.append((chat_id, audio))
+        return SimpleNamespace(audio=SimpleNamespace(file_id=f"file-{len(self.sent)}"))
+
+    async def edit_message_text(self, **kwargs):
+        pass
+
+    async def delete_message(self, **kwargs):
+        pass
+
+
+class CountingHandler:
+    def __init__(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+        self.downloads = 0
+        self.audio_store = SimpleNamespace(contains=lambda key: False)
+
+    async def get_track_info(self, url):
+        return {'track_id': '1', 'query': 'Artist - Title', 'title': 'Title', 'artist': 'Artist', 'filename': 'Artist - Title.mp3'}
+
+    async def download_track(self, query, filename, *args):
+        self.downloads += 1
+        await asyncio.sleep(0.05)
+        path = os.path.join(self.tmp_dir, filename)
+        with open(path, 'wb') as f:
+            f.write(b"ID3")
+        return path
+
+
+def test_identical_links_download_once():
+    async def run(tmp_dir):
+        database.DB_PATH = os.path.join(tmp_dir, "bot_data.db")
+        await database.init_db()
+        main.bot = FakeBot()
+        main.ym_handler = CountingHandler(tmp_dir)
+        try:
+            k = 8
+            url = "https://music.yandex.ru/album/5/track/1"
+            await asyncio.gather(*[main.process_track_download(chat_id, url, 100 + chat_id, True) for chat_id in range(k)])
+
+            assert main.ym_handler.downloads == 1
+            assert sorted(chat_id for chat_id, _ in main.bot.sent) == list(range(k))
+        finally:
+            await database.close_db()
+
+    saved = main.bot, main.ym_handler, database.DB_PATH
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            asyncio.run(run(tmp_dir))
+    finally:
+        main.bot, main.ym_handler, database.DB_PATH = saved
+
+
+if __name__ == "__main__":
+    test_concurrent_calls_share_one_execution()
+    test_errors_reach_every_waiter()
+    test_waiters_of_a_cancelled_call_get_call_cancelled()
+    test_identical_links_download_once()
+    print("OK")
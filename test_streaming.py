@@ -0,0 +1,90 @@
+import asyncio
+import sys
+import tracemalloc
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from streaming import ProcessStreamInputFile
+
+# 60 minutes of 192 kbps mp3
+TRACK_BYTES = 60 * 60 * 192_000 // 8
+# Python-side allocations at any one time while the whole track goes through
+MAX_TRACED_PEAK = 8 * 1024 * 1024
+
+# Stands in for ffmpeg writing mp3 to stdout
+FAKE_ENCODER = [
+    sys.executable, '-c',
+    "import sys\n"
+    f"left = {TRACK_BYTES}\n"
+    "chunk = b'\\xff' * 65536\n"
+    "while left > 0:\n"
+    "    n = min(left, len(chunk))\n"
+    "    sys.stdout.buffer.write(chunk[:n])\n"
+    "    left -= n\n",
+]
+
+
+def make_stub_bot_api(received: dict) -> web.Application:
+    async def send_audio(request):
+        reader = await request.multipart()
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            # aiogram sends the file as a separate part referenced by audio=attach://<name>
+            if part.filename:
+                while True:
+                    chunk = await part.read_chunk()
+                    if not chunk:
+                        break
+                    received['bytes'] += len(chunk)
+            else:
+                await part.read()
+        return web.json_response({'ok': True, 'result': {
+            'message_id': 1,
+            'date': 0,
+            'chat': {'id': 1, 'type': 'private'},
+            'audio': {'file_id': 'streamed', 'file_unique_id': 'streamed', 'duration': 3600},
+        }})
+
+    app = web.Application(client_max_size=2 * TRACK_BYTES)
+    app.router.add_post('/bot{token}/sendAudio', send_audio)
+    return app
+
+
+def test_hour_long_track_streams_with_bounded_memory():
+    async def run():
+        received = {'bytes': 0}
+        runner = web.AppRunner(make_stub_bot_api(received))
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}"))
+        bot = Bot(token="123456:TEST", session=session)
+        try:
+            # Peak RSS only ever grows over the process's life, so count what this upload allocates instead
+            tracemalloc.start()
+            audio = ProcessStreamInputFile(FAKE_ENCODER, filename="set.mp3")
+            sent = await bot.send_audio(chat_id=1, audio=audio)
+            _, traced_peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            await session.close()
+            await runner.cleanup()
+
+        assert sent.audio.file_id == 'streamed'
+        assert audio.bytes_sent == TRACK_BYTES
+        assert received['bytes'] == TRACK_BYTES
+        assert traced_peak < MAX_TRACED_PEAK, f"{traced_peak / 2**20:.1f} MiB allocated at the peak"
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_hour_long_track_streams_with_bounded_memory()
+    print("OK")
@@ -0,0 +1,34 @@
+from ydl_pool import YoutubeDLPool
+
+PROFILES = {'search': {'quiet': True, 'extract_flat': 'in_playlist'}, 'fetch': {'quiet': True}}
+
+
+def test_instances_are_restricted_and_reused():
+    pool = YoutubeDLPool(PROFILES, allowed_extractors=['youtube', 'soundcloud:search'])
+    with pool.acquire('search') as first:
+        assert sorted(first._ies) == ['SoundcloudSearch', 'Youtube']
+        assert first.params['extract_flat'] == 'in_playlist'
+    with pool.acquire('search') as second:
+        assert second is first
+    with pool.acquire('fetch') as other:
+        assert other is not first
+    pool.close()
+
+
+def test_failed_instance_is_not_reused():
+    pool = YoutubeDLPool(PROFILES)
+    try:
+        with pool.acquire('fetch', outtmpl="/tmp/track.%(ext)s") as broken:
+            assert broken.params['outtmpl']['default'] == "/tmp/track.%(ext)s"
+            raise RuntimeError("download failed")
+    except RuntimeError:
+        pass
+    with pool.acquire('fetch') as ydl:
+        assert ydl is not broken
+    pool.close()
+
+
+if __name__ == "__main__":
+    test_instances_are_restricted_and_reused()
+    test_failed_instance_is_not_reused()
+    print("OK")
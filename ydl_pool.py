@@ -0,0 +1,99 @@
+"""Reusable YoutubeDL instances.
+
+A fresh ``yt_dlp.YoutubeDL`` registers every extractor yt-dlp ships (about
+1700) and the first URL it sees is matched against all of their regexes.
+It also starts without the YouTube player cache or open HTTP connections.
+The pool builds instances restricted to YDL_EXTRACTORS, hands each one to
+a single thread at a time and keeps it for the next call. yt_dlp itself
+is only imported when the first instance is built.
+"""
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import metrics
+
+# Regexes matched against yt-dlp extractor names; "default" allows all of them
+YDL_EXTRACTORS = [name for name in os.getenv(
+    "YDL_EXTRACTORS", "youtube,youtube:search,soundcloud,soundcloud:search"
+).split(",") if name]
+
+_import_lock = threading.Lock()
+_yt_dlp = None
+
+
+def import_yt_dlp():
+    """Imports yt_dlp on first use; it isn't needed until the first download."""
+    global _yt_dlp
+    if _yt_dlp is None:
+        with _import_lock:
+            if _yt_dlp is None:
+                started = time.perf_counter()
+                import yt_dlp
+                metrics.observe_stage('ydl_import', time.perf_counter() - started)
+                _yt_dlp = yt_dlp
+    return _yt_dlp
+
+
+class YoutubeDLPool:
+    """Idle YoutubeDL instances per options profile.
+
+    ``profiles`` maps a name to the options its instances are built with.
+    ``extra_extractors`` are InfoExtractor classes registered on every
+    instance after the allowed built-in ones; an empty ``allowed_extractors``
+    leaves only those. An instance is only ever used by one thread at a
+    time; one that raised is closed instead of being returned, since yt-dlp
+    may have left it half-way through a download.
+    """
+
+    def __init__(self, profiles: Dict[str, dict], allowed_extractors: Optional[list] = None, extra_extractors: tuple = ()):
+        self.profiles = profiles
+        self.allowed_extractors = YDL_EXTRACTORS if allowed_extractors is None else allowed_extractors
+        self.extra_extractors = extra_extractors
+        self._idle = {name: queue.SimpleQueue() for name in profiles}
+
+    def _build(self, profile: str):
+        yt_dlp = import_yt_dlp()
+        started = time.perf_counter()
+        options = dict(self.profiles[profile], allowed_extractors=self.allowed_extractors)
+        ydl = yt_dlp.YoutubeDL(options, auto_init=False)
+        if self.allowed_extractors:
+            ydl.add_default_info_extractors()
+        for extractor in self.extra_extractors:
+            ydl.add_info_extractor(extractor())
+        metrics.observe_stage('ydl_init', time.perf_counter() - started)
+        return ydl
+
+    @contextmanager
+    def acquire(self, profile: str, outtmpl: Optional[str] = None):
+        """Yields an instance of ``profile``; ``outtmpl`` overrides the output template for this call."""
+        try:
+            ydl = self._idle[profile].get_nowait()
+        except queue.Empty:
+            ydl = self._build(profile)
+        if outtmpl is not None:
+            ydl.params['outtmpl'] = dict(ydl.params['outtmpl'], default=outtmpl)
+        try:
+            yield ydl
+        except BaseException:
+            ydl.close()
+            raise
+        self._idle[profile].put(ydl)
+
+    def warm_up(self):
+        """Builds one instance per profile and runs a first URL match, which compiles the extractor regexes."""
+        for profile in self.profiles:
+            with self.acquire(profile) as ydl:
+                for ie in ydl._ies.values():
+                    ie.suitable("https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+
+    def close(self):
+        for idle in self._idle.values():
+            while True:
+                try:
+                    idle.get_nowait().close()
+                except queue.Empty:
+                    break